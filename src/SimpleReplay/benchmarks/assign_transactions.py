@@ -0,0 +1,78 @@
+"""
+Assignment of the transactions of a workload to their connections by replay, bisecting the
+start times of the connections of each database, user and pid, against the scan of every
+connection of the key it replaces. The connections come from a few pooled users whose
+sessions reuse a handful of pids, so each key has hundreds of sessions or more:
+
+    python benchmarks/assign_transactions.py --connections 5000 --pids 4 --transactions 50000
+"""
+import argparse
+import datetime
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import replay
+from tests.test_replay import assign_transactions_reference, connection_log, transaction
+
+START_TIME = datetime.datetime(2021, 9, 2, 20, 0, tzinfo=datetime.timezone.utc)
+
+
+def workload(args):
+    """ Connections sorted by their start, as parse_connections returns them, and transactions
+        sorted by theirs, as parse_transactions does """
+    rng = random.Random(args.seed)
+    duration = args.duration_minutes * 60
+    users = [f"bi_pool_{idx}" for idx in range(args.users)]
+    connection_logs = sorted(
+        (connection_log(START_TIME + datetime.timedelta(seconds=rng.uniform(0, duration)),
+                        pid=rng.randrange(args.pids), username=rng.choice(users))
+         for _ in range(args.connections)),
+        key=lambda c: c.session_initiation_time,
+    )
+    transactions = sorted(
+        (transaction(xid, START_TIME + datetime.timedelta(seconds=rng.randrange(duration)),
+                     pid=rng.randrange(args.pids), username=rng.choice(users))
+         for xid in range(args.transactions)),
+        key=lambda t: (t.start_time(), t.xid),
+    )
+    return connection_logs, transactions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--connections", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=2)
+    parser.add_argument("--pids", type=int, default=4, help="pids reused by the sessions of each user")
+    parser.add_argument("--transactions", type=int, default=50000)
+    parser.add_argument("--duration-minutes", type=int, default=60)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    # transactions before the first session of their key are skipped with a warning
+    replay.logger = logging.getLogger("SimpleReplayLogger")
+    replay.logger.setLevel(logging.ERROR)
+
+    connection_logs, transactions = workload(args)
+    start = time.perf_counter()
+    expected = assign_transactions_reference(connection_logs, transactions)
+    baseline = time.perf_counter() - start
+    expected_transactions = [[t.xid for t in c.transactions] for c in connection_logs]
+
+    connection_logs, transactions = workload(args)
+    start = time.perf_counter()
+    assert expected == replay.assign_transactions(connection_logs, transactions)
+    bisected = time.perf_counter() - start
+    assert expected_transactions == [[t.xid for t in c.transactions] for c in connection_logs]
+
+    print(f"{args.transactions} transactions, {args.connections} connections, "
+          f"{args.connections / (args.users * args.pids):.0f} per key")
+    print(f"  scan: {baseline:8.2f} s")
+    print(f"  bisect: {bisected:6.2f} s ({baseline / bisected:.0f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""
+Throughput of extract and replay on a synthetic workload, stage by stage: parsing the audit
+logs (get_local_logs), writing the workload (save_logs), and loading it for replay
+(parse_connections and parse_transactions). For each stage, reports records and MB per second
+and the peak RSS during the stage. MB are of the decompressed input of the stage: the audit
+logs for parsing, and the workload files for the others.
+
+The audit logs are written by synthetic_workload.py, which takes the same options. Results
+can be saved with --output to compare runs:
+
+    python benchmarks/extract_replay.py --connections 2000 --transactions-per-connection 20 --output run.json
+"""
+import argparse
+import datetime
+import gzip
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import extract
+import replay
+from benchmarks.synthetic_workload import START_TIME, add_arguments, synthetic_logs_kwargs, write_synthetic_logs
+
+
+def reset_peak_rss():
+    """ Start measuring the peak RSS again, where the OS allows it (linux). Otherwise the peak
+        is the peak of the process so far """
+    try:
+        with open("/proc/self/clear_refs", "w") as fp:
+            fp.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as fp:
+            for line in fp:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024 / 1024 if sys.platform == "darwin" else maxrss / 1024
+
+
+def decompressed_size(path):
+    size = 0
+    with gzip.open(path, "rb") as fp:
+        while True:
+            data = fp.read(1024 * 1024)
+            if not data:
+                return size
+            size += len(data)
+
+
+def workload_sql_files(workload_directory):
+    """ The gzipped transaction and text files of a workload, including its shards """
+    paths = []
+    for root, _, filenames in os.walk(workload_directory):
+        paths += [os.path.join(root, filename) for filename in filenames
+                  if filename.startswith("SQL") and filename.endswith(".gz")]
+    return paths
+
+
+def run_stage(name, stage, records, size_bytes):
+    """ Run stage() and return its measurements. records and size_bytes may be callables of the
+        result of the stage, for stages whose output is what is counted """
+    reset_peak_rss()
+    start = time.perf_counter()
+    result = stage()
+    elapsed = time.perf_counter() - start
+    peak_rss = peak_rss_mb()
+    records = records(result) if callable(records) else records
+    size_bytes = size_bytes(result) if callable(size_bytes) else size_bytes
+    return result, {
+        "stage": name,
+        "seconds": elapsed,
+        "records": records,
+        "records_per_second": records / elapsed,
+        "mb": size_bytes / 1024 / 1024,
+        "mb_per_second": size_bytes / 1024 / 1024 / elapsed,
+        "peak_rss_mb": peak_rss,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    parser.add_argument("--num-workers", type=int, default=None, help="processes used by get_local_logs")
+    parser.add_argument("--workload-format", default="ndjson", choices=["ndjson", "json", "ndjson_texts"])
+    parser.add_argument("--shard-minutes", type=int, default=None, help="write the workload in shards")
+    parser.add_argument("--output", help="file to save the results to, as json")
+    args = parser.parse_args()
+
+    extract.logger = logging.getLogger("SimpleReplayLogger")
+    replay.logger = logging.getLogger("SimpleReplayLogger")
+    extract.g_disable_progress_bar = True
+    replay.g_config = {"filters": {
+        "include": {f: ["*"] for f in replay.Transaction.supported_filters()},
+        "exclude": {f: [] for f in replay.Transaction.supported_filters()},
+    }}
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        log_directory = f"{tmp}/logs"
+        workload_directory = f"{tmp}/workload"
+        written = write_synthetic_logs(log_directory, **synthetic_logs_kwargs(args))
+        end_time = START_TIME + datetime.timedelta(minutes=args.duration_minutes)
+
+        parsed_logs, stats = run_stage(
+            "get_local_logs",
+            lambda: extract.get_local_logs(log_directory, START_TIME, end_time, args.num_workers),
+            sum(_["records"] for _ in written.values()),
+            sum(_["bytes"] for _ in written.values()),
+        )
+        results.append(stats)
+
+        connections, logs, databases, last_connections = parsed_logs
+        num_queries = sum(len(queries) for queries in logs.values())
+        _, stats = run_stage(
+            "save_logs",
+            lambda: extract.save_logs(logs, last_connections, workload_directory, connections, START_TIME, end_time,
+                                      workload_format=args.workload_format, shard_minutes=args.shard_minutes),
+            num_queries,
+            lambda _: sum(decompressed_size(path) for path in workload_sql_files(workload_directory)),
+        )
+        results.append(stats)
+        del parsed_logs, connections, logs, databases, last_connections
+
+        _, stats = run_stage(
+            "parse_connections",
+            lambda: replay.parse_connections(workload_directory, "", ""),
+            lambda result: result[1],
+            os.path.getsize(f"{workload_directory}/connections.json"),
+        )
+        results.append(stats)
+
+        workload_bytes = sum(decompressed_size(path) for path in workload_sql_files(workload_directory))
+        _, stats = run_stage(
+            "parse_transactions",
+            lambda: replay.parse_transactions(workload_directory),
+            lambda transactions: sum(len(transaction.queries) for transaction in transactions),
+            workload_bytes,
+        )
+        results.append(stats)
+
+    print(f"{'stage':>18} {'seconds':>8} {'records':>9} {'records/s':>10} {'MB':>7} {'MB/s':>7} {'peak RSS MB':>12}")
+    for stats in results:
+        print(f"{stats['stage']:>18} {stats['seconds']:8.2f} {stats['records']:9d} {stats['records_per_second']:10.0f} "
+              f"{stats['mb']:7.1f} {stats['mb_per_second']:7.1f} {stats['peak_rss_mb']:12.1f}")
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump({"options": vars(args), "stages": results}, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
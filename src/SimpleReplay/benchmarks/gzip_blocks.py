@@ -0,0 +1,79 @@
+"""
+Compression of the workload written by extract, with a single GzipFile as before and with
+BlockGzipFile compressing blocks on several threads, at a few compression levels. Reports the
+wall time, MB per second and compression ratio of each.
+
+The workload is the SQLs.ndjson of a synthetic workload written by synthetic_workload.py, which
+takes the same options, repeated --copies times to reach the size of a large extraction:
+
+    python benchmarks/gzip_blocks.py --connections 2000 --transactions-per-connection 20 --levels 1 6 9 --threads 4
+"""
+import argparse
+import datetime
+import gzip
+import io
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import extract
+from benchmarks.synthetic_workload import START_TIME, add_arguments, synthetic_logs_kwargs, write_synthetic_logs
+
+
+def workload_ndjson(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        write_synthetic_logs(f"{tmp}/logs", **synthetic_logs_kwargs(args))
+        end_time = START_TIME + datetime.timedelta(minutes=args.duration_minutes)
+        connections, logs, databases, last_connections = extract.get_local_logs(f"{tmp}/logs", START_TIME, end_time)
+        extract.save_logs(logs, last_connections, f"{tmp}/workload", connections, START_TIME, end_time)
+        with gzip.open(f"{tmp}/workload/SQLs.ndjson.gz", "rb") as fp:
+            return fp.read()
+
+
+def compress(content, open_gzip):
+    """ Write content to an in-memory gzip file in chunks, as save_logs does, and return the
+        compressed size and the wall time """
+    output = io.BytesIO()
+    start = time.perf_counter()
+    with open_gzip(output) as fp:
+        for idx in range(0, len(content), 64 * 1024):
+            fp.write(content[idx:idx + 64 * 1024])
+    elapsed = time.perf_counter() - start
+    assert gzip.decompress(output.getvalue()) == content
+    return len(output.getvalue()), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    parser.add_argument("--copies", type=int, default=4, help="times the workload is repeated")
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 6, 9])
+    parser.add_argument("--threads", type=int, nargs="+", default=[2, 4, 8])
+    parser.add_argument("--block-size-kb", type=int, default=extract.g_compress_block_size // 1024)
+    args = parser.parse_args()
+
+    extract.logger = logging.getLogger("SimpleReplayLogger")
+    extract.g_disable_progress_bar = True
+    content = workload_ndjson(args) * args.copies
+    megabytes = len(content) / 1024 / 1024
+    print(f"SQLs.ndjson: {megabytes:.1f} MB, {os.cpu_count()} CPUs")
+
+    print(f"{'level':>5} {'writer':>14} {'seconds':>8} {'MB/s':>7} {'ratio':>6}")
+    for level in args.levels:
+        writers = [("GzipFile", lambda fp: gzip.GzipFile(fileobj=fp, mode="wb", compresslevel=level))]
+        writers += [
+            (f"{threads} threads", lambda fp, threads=threads: extract.BlockGzipFile(
+                fp, level, threads, block_size=args.block_size_kb * 1024))
+            for threads in args.threads
+        ]
+        for name, open_gzip in writers:
+            size, elapsed = compress(content, open_gzip)
+            print(f"{level:5d} {name:>14} {elapsed:8.2f} {megabytes / elapsed:7.1f} {len(content) / size:6.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Peak memory used by extract to parse a large user activity log.
+
+Writes a synthetic useractivitylog of the requested (decompressed) size, then parses it
+in a fresh process with the old readlines() reader and with the streaming reader, and
+reports the peak RSS of each:
+
+    python benchmarks/parse_memory.py --size-mb 1024
+"""
+import argparse
+import datetime
+import gzip
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import extract
+from tests.synthetic_logs import user_activity_log_record
+
+RECORD_TIME = datetime.datetime(2021, 9, 2, 20, 0, tzinfo=datetime.timezone.utc)
+
+QUERY_TEXT = "select o.id,\n       o.total\n  from orders o\n  join customers c on c.id = o.customer_id\n" + \
+             "".join(f" where o.c{i} = {i} -- filter {i}\n" for i in range(20)) + ";"
+
+
+def write_log(path, size_mb):
+    target = size_mb * 1024 * 1024
+    written = 0
+    xid = 0
+    with gzip.open(path, "wb", compresslevel=1) as fp:
+        while written < target:
+            xid += 1
+            record = user_activity_log_record(
+                RECORD_TIME + datetime.timedelta(seconds=xid // 100), "dev", "user", 1000 + xid % 50, xid, QUERY_TEXT
+            ).encode("utf-8")
+            fp.write(record)
+            written += len(record)
+    return xid
+
+
+def readlines(file):
+    """ The reader extract used before streaming: the whole file as a list of lines """
+    return (line.decode("utf-8") for line in file.readlines())
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024 / 1024 if sys.platform == "darwin" else maxrss / 1024
+
+
+def parse(path, mode):
+    extract.logger = logging.getLogger("SimpleReplayLogger")
+    if mode == "readlines":
+        extract.read_lines = readlines
+
+    # every record is before the extraction window, so records are parsed and dropped and
+    # the memory measured is the memory used to read the file
+    start_time = RECORD_TIME + datetime.timedelta(days=1)
+    logs = {}
+    with gzip.open(path, "r") as log_file:
+        extract.parse_user_activity_log(log_file, logs, set(), start_time, "")
+    print(f"{peak_rss_mb():.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=1024, help="Decompressed size of the synthetic log.")
+    parser.add_argument("--parse", nargs=2, metavar=("MODE", "PATH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.parse:
+        parse(args.parse[1], args.parse[0])
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = f"{tmp}/useractivitylog_2021-09-02T20:00.gz"
+        records = write_log(path, args.size_mb)
+        print(f"Wrote {records} records ({args.size_mb} MB decompressed, "
+              f"{os.path.getsize(path) / 1024 / 1024:.1f} MB compressed)")
+
+        for mode in ("readlines", "streaming"):
+            output = subprocess.run([sys.executable, __file__, "--parse", mode, path],
+                                    check=True, capture_output=True, text=True).stdout
+            print(f"{mode:>10}: peak RSS {float(output.strip().splitlines()[-1]):.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Benchmark of the problem keyword check done by is_valid_log for every record, on short queries,
+reporting queries and large generated multi-row INSERTs. It is compared with the checks it
+replaced, and with a single pass over the text using one regex alternation of all the keywords.
+Substring search is much faster per byte than the regex engine, so the single pass only pays
+off on short texts:
+
+    python benchmarks/problem_keywords.py --large-mb 4 --repeat 5
+"""
+import argparse
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import extract
+
+
+def keyword_scans(text):
+    """ The checks of is_valid_log before the single pass matcher """
+    problem_keywords = [
+        "SPECTRUM INTERNAL QUERY", "context: SQL", "ERROR:", "CONTEXT:  SQL", "show ", "Undoing transaction",
+        "Undo on", "pg_terminate_backend", "pg_cancel_backend", "volt_", "pg_temp_",
+    ]
+    potential_problem_keywords = ["BIND"]
+    not_problem_keywords = ["BINDING"]
+    return any(word in text for word in problem_keywords) or (
+        any(word in text for word in potential_problem_keywords)
+        and not any(word in text for word in not_problem_keywords)
+    )
+
+
+keyword_pattern = re.compile("|".join(
+    re.escape(word) for word in sorted(extract.g_problem_keywords + ("BINDING", "BIND"), key=len, reverse=True)
+))
+
+
+def single_pass(text):
+    """ Find every keyword in one pass. No keyword ends with the start of another, so the
+        non-overlapping matches are enough """
+    found_bind = False
+    found_binding = False
+    for match in keyword_pattern.finditer(text):
+        if match.group() == "BINDING":
+            found_binding = True
+        elif match.group() == "BIND":
+            found_bind = True
+        else:
+            return True
+    return found_bind and not found_binding
+
+
+def short_queries():
+    return [
+        f"select c_custkey, c_name from customer where c_nationkey = {idx} and c_acctbal > 1000 limit 10;"
+        for idx in range(1000)
+    ]
+
+
+def reporting_queries():
+    query = """select n_name, sum(l_extendedprice * (1 - l_discount)) as revenue
+from customer, orders, lineitem, supplier, nation, region
+where c_custkey = o_custkey and l_orderkey = o_orderkey and l_suppkey = s_suppkey
+  and c_nationkey = s_nationkey and s_nationkey = n_nationkey and n_regionkey = r_regionkey
+  and r_name = 'ASIA' and o_orderdate >= date '1994-01-01' and o_orderdate < date '1995-01-01'
+group by n_name
+order by revenue desc;
+"""
+    return [f"/* report {idx} */\n{query * 4}" for idx in range(100)]
+
+
+def large_inserts(size_mb):
+    row_count = size_mb * 1024 * 1024 // 48
+    return ["insert into sales values " + ",".join(
+        f"({idx}, 'customer_{idx}', {idx * 3.14:.2f}, '2021-09-02')" for idx in range(row_count)
+    ) + ";"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--large-mb", type=int, default=4, help="size of the generated INSERT")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    checks = [("keyword scans", keyword_scans), ("single pass", single_pass),
+              ("has_problem_keyword", extract.has_problem_keyword)]
+    for name, texts in [("short", short_queries()), ("reporting", reporting_queries()),
+                        ("large insert", large_inserts(args.large_mb))]:
+        megabytes = sum(len(_) for _ in texts) / 1024 / 1024
+        print(f"{name} ({len(texts)} texts, {megabytes:.1f} MB)")
+        expected = [keyword_scans(_) for _ in texts]
+        for check_name, check in checks:
+            assert [check(_) for _ in texts] == expected
+            elapsed = min(timeit.repeat(lambda: [check(_) for _ in texts], number=1, repeat=args.repeat))
+            print(f"  {check_name:>20}: {elapsed / len(texts) * 1e6:9.2f} us per text, "
+                  f"{megabytes / elapsed:7.1f} MB/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Bytes per record kept by extract for the queries of the extraction window.
+
+Parses a synthetic useractivitylog with many short queries from a few users, databases and
+sessions, keeping every record, and reports the memory they hold as traced by tracemalloc.
+This is compared with the records extract kept before, an object with a __dict__ and its own
+copy of the username, database name and pid of every record:
+
+    python benchmarks/record_memory.py --records 200000
+"""
+import argparse
+import datetime
+import gzip
+import logging
+import os
+import sys
+import tempfile
+import tracemalloc
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import extract
+from tests.synthetic_logs import user_activity_log_record
+
+RECORD_TIME = datetime.datetime(2021, 9, 2, 20, 0, tzinfo=datetime.timezone.utc)
+
+
+class DictLog:
+    """ The Log extract used before __slots__ """
+
+    def __init__(self):
+        self.record_time = ""
+        self.start_time = ""
+        self.end_time = ""
+        self.username = ""
+        self.database_name = ""
+        self.pid = ""
+        self.xid = ""
+        self.text = ""
+        self.fingerprint = None
+
+
+def write_log(path, records):
+    with gzip.open(path, "wb", compresslevel=1) as fp:
+        for idx in range(records):
+            fp.write(user_activity_log_record(
+                RECORD_TIME + datetime.timedelta(seconds=idx // 100), f"db_{idx % 3}", f"user_{idx % 20}",
+                1000 + idx % 50, 5000 + idx // 4, f"select * from orders where id = {idx};",
+            ).encode("utf-8"))
+
+
+def retained_bytes(path):
+    """ Memory held by every record of the log, and how many there are """
+    tracemalloc.start()
+    with gzip.open(path, "r") as log_file:
+        records = list(extract.read_user_activity_log(log_file, "", ""))
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return retained, len(records)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=200000)
+    args = parser.parse_args()
+    extract.logger = logging.getLogger("SimpleReplayLogger")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = f"{tmp}/useractivitylog_2021-09-02T20:00.gz"
+        write_log(path, args.records)
+
+        with mock.patch.object(extract, "Log", DictLog), mock.patch.object(sys, "intern", lambda _: _):
+            before, records = retained_bytes(path)
+        after, _ = retained_bytes(path)
+
+    print(f"{records} records")
+    print(f"  __dict__, own strings: {before / records:6.0f} bytes per record")
+    print(f"  __slots__, interned:   {after / records:6.0f} bytes per record ({1 - after / before:.0%} less)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""
+Scheduling of the thread and asyncio replay engines, replaying a synthetic workload of many
+concurrent connections in one worker against a null driver, whose queries take --query-ms and
+return nothing. Reports for each engine the peak number of open connections and of threads,
+how late the queries start relative to their time in the workload (the scheduling lag), and the
+largest connection_diff_sec, followed by the lag histogram of the scheduler of the worker for each
+kind of event. Transactions are due at their time in the workload, so the lag of a query is how
+late the engine started it:
+
+    python benchmarks/replay_engines.py --connections 2000 --duration-seconds 20 --connection-seconds 10
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import replay
+
+START_TIME = datetime.datetime(2021, 9, 2, 20, 0, tzinfo=datetime.timezone.utc)
+
+
+class NullDriver:
+    """ Connections whose queries take query_sec, recording how late each query starts """
+
+    def __init__(self, query_sec, query_times, replay_start):
+        self.query_sec = query_sec
+        self.query_times = query_times
+        self.replay_start = replay_start
+        self.lock = threading.Lock()
+        self.open_connections = 0
+        self.peak_connections = 0
+        self.peak_threads = 0
+        self.lags = []
+
+    def connect(self, *args, **kwargs):
+        with self.lock:
+            self.open_connections += 1
+            self.peak_connections = max(self.peak_connections, self.open_connections)
+        return NullConnection(self)
+
+    def execute(self, sql_text):
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        xid = json.loads(sql_text[3:sql_text.index(" */")])["xid"]
+        expected = self.replay_start + (self.query_times[xid] - START_TIME)
+        with self.lock:
+            self.lags.append((now - expected).total_seconds())
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+        time.sleep(self.query_sec)
+
+
+class NullCursor:
+    def __init__(self, driver):
+        self.driver = driver
+
+    def execute(self, sql_text):
+        self.driver.execute(sql_text)
+
+    def close(self):
+        pass
+
+
+class NullConnection:
+    def __init__(self, driver):
+        self.driver = driver
+
+    def cursor(self):
+        return NullCursor(self.driver)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        if self.driver is not None:
+            with self.driver.lock:
+                self.driver.open_connections -= 1
+            self.driver = None
+
+
+def connection_logs(args):
+    """ Connections starting over duration_seconds, each running its transactions of one query
+        over connection_seconds """
+    rng = random.Random(args.seed)
+    logs = []
+    for idx in range(args.connections):
+        start = START_TIME + datetime.timedelta(seconds=rng.uniform(0, args.duration_seconds))
+        end = start + datetime.timedelta(seconds=args.connection_seconds)
+        pid = str(1000 + idx)
+        connection_log = replay.ConnectionLog(start, end, "psql", "dev", "bi_pool", pid, True, "all on",
+                                              replay.get_connection_key("dev", "bi_pool", pid))
+        for transaction_idx in range(args.transactions_per_connection):
+            query_time = start + (end - start) * (transaction_idx + 0.5) / args.transactions_per_connection
+            connection_log.transactions.append(replay.Transaction(
+                True, "dev", "bi_pool", pid, f"{idx}-{transaction_idx}",
+                [replay.Query(query_time, query_time, "select 1;")], connection_log.connection_key,
+            ))
+        logs.append(connection_log)
+    return sorted(logs, key=lambda connection_log: connection_log.session_initiation_time)
+
+
+def run_engine(worker, args, logging_dir):
+    logs = connection_logs(args)
+    query_times = {transaction.xid: transaction.start_time() for connection_log in logs
+                   for transaction in connection_log.transactions}
+    jobs = [{"job_id": idx, "connection": connection_log} for idx, connection_log in enumerate(logs)]
+
+    replay.g_config = {"execute_copy_statements": "false", "execute_unload_statements": "false",
+                       "replay_output": None, "split_multi": True, "logging_dir": logging_dir,
+                       "async_executor_threads": args.executor_threads}
+    replay.g_replay_timestamp = datetime.datetime.now(tz=datetime.timezone.utc)
+    credentials = {"host": "host", "port": 5439, "username": "bi_pool", "password": "", "database": "dev",
+                   "odbc_driver": None}
+    worker_stats = replay.init_stats({})
+    replay_start = datetime.datetime.now(tz=datetime.timezone.utc)
+    driver = NullDriver(args.query_ms / 1000.0, query_times, replay_start)
+
+    start = time.perf_counter()
+    with mock.patch.object(replay, "db_connect", driver.connect), \
+            mock.patch.object(replay, "get_connection_credentials", return_value=credentials), \
+            mock.patch.object(replay.random, "randrange", return_value=0):
+        worker(0, replay_start, START_TIME, jobs, worker_stats, "psql", None, None,
+               mock.Mock(value=0), mock.Mock(value=0))
+    elapsed = time.perf_counter() - start
+
+    lags = sorted(driver.lags)
+    return {
+        "seconds": elapsed,
+        "queries": len(lags),
+        "peak_connections": driver.peak_connections,
+        "peak_threads": driver.peak_threads,
+        "lag_p50_ms": statistics.median(lags) * 1000,
+        "lag_p99_ms": lags[int(len(lags) * 0.99)] * 1000,
+        "lag_max_ms": lags[-1] * 1000,
+        "connection_diff_sec": worker_stats["connection_diff_sec"],
+        "lag_histogram": worker_stats["lag_histogram"],
+    }
+
+
+def print_lag_histogram(engine, lag_histogram):
+    bounds = [f"<={bound}" for bound in replay.ReplayScheduler.lag_buckets_ms] + [">"]
+    print(f"{engine} scheduling lag, events per bucket of ms:")
+    print(f"{'kind':>12} " + " ".join(f"{bound:>7}" for bound in bounds))
+    for kind in replay.ReplayScheduler.kinds:
+        if kind in lag_histogram:
+            print(f"{kind:>12} " + " ".join(f"{count:7d}" for count in lag_histogram[kind]["counts"]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--connections", type=int, default=2000)
+    parser.add_argument("--duration-seconds", type=float, default=20, help="time over which the connections start")
+    parser.add_argument("--connection-seconds", type=float, default=10)
+    parser.add_argument("--transactions-per-connection", type=int, default=5)
+    parser.add_argument("--query-ms", type=float, default=20)
+    parser.add_argument("--executor-threads", type=int, default=100, help="async_executor_threads")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    replay.logger = logging.getLogger("SimpleReplayLogger")
+
+    print(f"{'engine':>8} {'seconds':>8} {'queries':>8} {'peak conns':>11} {'peak threads':>13} "
+          f"{'lag p50 ms':>11} {'lag p99 ms':>11} {'lag max ms':>11} {'conn diff s':>12}")
+    lag_histograms = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for engine, worker in (("threads", replay.replay_worker), ("asyncio", replay.async_replay_worker)):
+            stats = run_engine(worker, args, f"{tmp}/{engine}")
+            lag_histograms[engine] = stats["lag_histogram"]
+            print(f"{engine:>8} {stats['seconds']:8.1f} {stats['queries']:8d} {stats['peak_connections']:11d} "
+                  f"{stats['peak_threads']:13d} {stats['lag_p50_ms']:11.1f} {stats['lag_p99_ms']:11.1f} "
+                  f"{stats['lag_max_ms']:11.1f} {stats['connection_diff_sec']:12.3f}")
+
+    for engine, lag_histogram in lag_histograms.items():
+        print()
+        print_lag_histogram(engine, lag_histogram)
+
+
+if __name__ == "__main__":
+    main()
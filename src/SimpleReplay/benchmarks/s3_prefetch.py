@@ -0,0 +1,93 @@
+"""
+Benchmark of audit log download from s3 with and without prefetching, against a local
+s3 (moto) where every download is delayed to simulate network latency:
+
+    python benchmarks/s3_prefetch.py --files 40 --latency-ms 200 --concurrency 1 4 8
+"""
+import argparse
+import datetime
+import os
+import sys
+import tempfile
+import time
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import boto3
+
+try:
+    from moto import mock_aws
+except ImportError:  # moto < 5
+    from moto import mock_s3 as mock_aws
+
+import extract
+from tests.synthetic_logs import connection_log_line, user_activity_log_record, write_log_file
+
+BUCKET = "audit-logs"
+PREFIX = "AWSLogs/123456789012/redshift/us-east-1/2021/09/02/"
+START_TIME = datetime.datetime(2021, 9, 2, 0, 0, tzinfo=datetime.timezone.utc)
+
+
+def upload_logs(s3, directory, files, records_per_file):
+    path = write_log_file(directory, "connectionlog", START_TIME, [
+        connection_log_line("initiating session ", START_TIME, 1000 + idx, "dev", "user") for idx in range(20)
+    ])
+    s3.upload_file(path, BUCKET, PREFIX + os.path.basename(path))
+
+    for file_idx in range(files):
+        file_time = START_TIME + datetime.timedelta(minutes=file_idx)
+        lines = [
+            user_activity_log_record(file_time, "dev", "user", 1000 + idx % 20, file_idx * records_per_file + idx,
+                                     f"select {idx} from t where a = '{file_idx}';")
+            for idx in range(records_per_file)
+        ]
+        path = write_log_file(directory, "useractivitylog", file_time, lines)
+        s3.upload_file(path, BUCKET, PREFIX + os.path.basename(path))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=40)
+    parser.add_argument("--records-per-file", type=int, default=5000)
+    parser.add_argument("--latency-ms", type=float, default=200, help="Delay added to each download.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8])
+    args = parser.parse_args()
+
+    os.environ.update({"AWS_ACCESS_KEY_ID": "testing", "AWS_SECRET_ACCESS_KEY": "testing",
+                       "AWS_DEFAULT_REGION": "us-east-1"})
+    extract.logger = extract.init_logging()
+    extract.g_disable_progress_bar = True
+    extract.set_log_level("WARNING")
+
+    download_log_file = extract.download_log_file
+    open_log_file = extract.open_log_file
+
+    def slow_download_log_file(s3_client, location):
+        time.sleep(args.latency_ms / 1000.0)
+        return download_log_file(s3_client, location)
+
+    def slow_open_log_file(location, content=None):
+        # without prefetching, the object is requested when the parser opens it
+        if content is None:
+            time.sleep(args.latency_ms / 1000.0)
+        return open_log_file(location, content)
+
+    with mock_aws(), tempfile.TemporaryDirectory() as tmp, \
+            mock.patch.object(extract, "download_log_file", slow_download_log_file), \
+            mock.patch.object(extract, "open_log_file", slow_open_log_file):
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket=BUCKET)
+        upload_logs(s3, tmp, args.files, args.records_per_file)
+
+        for concurrency in args.concurrency:
+            extract.g_config = {"log_download_concurrency": concurrency, "log_download_max_mb": 512}
+            start = time.perf_counter()
+            extract.get_s3_logs(BUCKET, PREFIX, "", "")
+            elapsed = time.perf_counter() - start
+            print(f"concurrency {concurrency:>2}: {elapsed:6.2f} sec for {args.files} files "
+                  f"({args.latency_ms:.0f} ms latency per file)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Benchmark of the comment removal and duplicate check done for every extracted query, against
+the implementations they replace, on generated SQL with one line comment per line, which made
+the previous comment removal quadratic:
+
+    python benchmarks/sql_lexer.py --comment-lines 2000 8000 32000 --records 2000
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import extract
+from tests.test_extract import is_duplicate_reference, remove_line_comments_reference
+
+
+def commented_query(comment_lines):
+    columns = "\n".join(f"    column_{idx}, -- column {idx} of the generated report" for idx in range(comment_lines))
+    return f"select\n{columns}\n    'it''s -- not a comment' as note\nfrom report;"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--comment-lines", type=int, nargs="+", default=[2000, 8000, 32000])
+    parser.add_argument("--records", type=int, default=2000,
+                        help="consecutive records checked for duplicates, each a 2000 line query")
+    args = parser.parse_args()
+
+    print("remove_line_comments")
+    for comment_lines in args.comment_lines:
+        query = commented_query(comment_lines)
+        baseline = timeit.timeit(lambda: remove_line_comments_reference(query), number=1)
+        lexer = min(timeit.repeat(lambda: extract.remove_line_comments(query), number=1, repeat=3))
+        print(f"  {comment_lines:>7} comment lines ({len(query) / 1024 / 1024:5.1f} MB): "
+              f"{baseline * 1e3:9.1f} ms -> {lexer * 1e3:7.1f} ms ({baseline / lexer:.0f}x)")
+
+    # consecutive records of the same transaction, every other one a JDBC duplicate
+    texts = [commented_query(2000).replace("report", f"report_{idx // 2}") for idx in range(args.records)]
+
+    def pairwise():
+        # as add_user_activity_log did, checking both texts for FETCH unless it's a duplicate
+        return [
+            is_duplicate_reference(first, second) or (
+                extract.g_fetch_pattern.search(first) is not None and extract.g_fetch_pattern.search(second) is not None
+            )
+            for first, second in zip(texts, texts[1:])
+        ]
+
+    def fingerprints():
+        records = []
+        for text in texts:
+            log = extract.Log()
+            log.text = text
+            records.append(log)
+        return [
+            extract.is_duplicate_fingerprint(extract.get_fingerprint(first), extract.get_fingerprint(second),
+                                             first.text, second.text) or (
+                first.fingerprint.fetch and second.fingerprint.fetch
+            )
+            for first, second in zip(records, records[1:])
+        ]
+
+    assert pairwise() == fingerprints()
+    megabytes = sum(len(_) for _ in texts) / 1024 / 1024
+    baseline = timeit.timeit(pairwise, number=1)
+    fingerprint = timeit.timeit(fingerprints, number=1)
+    print(f"duplicate and FETCH checks, {args.records} records ({megabytes:.0f} MB): "
+          f"{baseline * 1e3:.0f} ms -> {fingerprint * 1e3:.0f} ms ({baseline / fingerprint:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
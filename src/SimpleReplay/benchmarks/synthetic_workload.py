@@ -0,0 +1,264 @@
+"""
+Writes a synthetic set of gzipped Redshift audit logs (connectionlog, useractivitylog and
+start_node files, rotated every few minutes like the ones Redshift writes to S3) to measure
+extract and replay without a cluster.
+
+Sessions of a few users, databases and applications run transactions drawn from a query mix
+of short selects, multi-line reports with comments, inserts, updates, COPYs and cursors with
+consecutive FETCHes. Some sessions reuse the pid of an earlier session of the same user, and
+some queries are logged twice in a row like the JDBC driver does:
+
+    python benchmarks/synthetic_workload.py /tmp/audit_logs --connections 2000 --transactions-per-connection 20
+"""
+import argparse
+import collections
+import datetime
+import gzip
+import heapq
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from tests.synthetic_logs import connection_log_line, log_filename, start_node_log_record, \
+    user_activity_log_record
+
+START_TIME = datetime.datetime(2021, 9, 2, 20, 0, tzinfo=datetime.timezone.utc)
+
+USERS = ["etl", "dashboard", "analyst_1", "analyst_2", "analyst_3", "admin"]
+DATABASES = ["dev", "prod", "reporting"]
+APPLICATIONS = ["psql", "Redshift JDBC Driver", "Tableau", "dbt", ""]
+
+# relative frequency of each kind of transaction
+DEFAULT_QUERY_MIX = {"select": 50, "report": 20, "insert": 10, "update": 8, "copy": 4, "cursor": 8}
+
+
+def select_query(rng):
+    return f"select c_custkey, c_name, c_acctbal from customer where c_custkey = {rng.randrange(150000)};"
+
+
+def report_query(rng, multiline):
+    region = rng.choice(["ASIA", "EUROPE", "AMERICA", "AFRICA", "MIDDLE EAST"])
+    year = rng.randrange(1992, 1999)
+    query = (
+        "/* revenue report */\n"
+        "select n_name, -- nation\n"
+        "       sum(l_extendedprice * (1 - l_discount)) as revenue -- net revenue\n"
+        "  from customer, orders, lineitem, supplier, nation, region\n"
+        " where c_custkey = o_custkey and l_orderkey = o_orderkey and l_suppkey = s_suppkey\n"
+        "   and c_nationkey = s_nationkey and s_nationkey = n_nationkey and n_regionkey = r_regionkey\n"
+        f"   and r_name = '{region}' and o_orderdate >= date '{year}-01-01' -- one year\n"
+        " group by n_name\n"
+        " order by revenue desc;"
+    )
+    if multiline:
+        return query
+    # as logged when the client sends it on one line
+    return " ".join(line.split("--")[0].strip() for line in query.splitlines()[1:])
+
+
+def transaction_queries(kind, rng, multiline):
+    if kind == "select":
+        return [select_query(rng)]
+    if kind == "report":
+        return [report_query(rng, multiline)]
+    if kind == "insert":
+        return ["begin;", f"insert into orders_staging values ({rng.randrange(10 ** 6)}, 'O', 173665.47, '1996-01-02');",
+                "commit;"]
+    if kind == "update":
+        return ["begin;", f"update customer set c_acctbal = c_acctbal + 1 where c_custkey = {rng.randrange(150000)};",
+                "end;"]
+    if kind == "copy":
+        return [f"copy lineitem_staging from 's3://example-bucket/lineitem/part-{rng.randrange(1000):04d}' "
+                "iam_role 'arn:aws:iam::123456789012:role/RedshiftCopy' gzip delimiter '|';"]
+    # a cursor read in chunks, where every FETCH after the first is commented out by extract
+    return ["begin;", f"declare c1 cursor for {select_query(rng)}"] + \
+           ["fetch forward 1000 from c1;"] * rng.randrange(2, 6) + ["close c1;", "commit;"]
+
+
+class Session:
+    def __init__(self, start, end, database_name, username, application_name, pid):
+        self.start = start
+        self.end = end
+        self.database_name = database_name
+        self.username = username
+        self.application_name = application_name
+        self.pid = pid
+
+
+def generate_sessions(rng, connections, duration, pid_reuse):
+    """ Sessions in order of their start. A session reuses, with probability pid_reuse, the pid of
+        an earlier session of the same user and database that has ended """
+    starts = sorted(rng.uniform(0, duration * 0.9) for _ in range(connections))
+    ended = collections.defaultdict(list)
+    running = []
+    next_pid = 1000
+    sessions = []
+    for start in starts:
+        while running and running[0][0] <= start:
+            end, _, session = heapq.heappop(running)
+            ended[(session.database_name, session.username)].append(session.pid)
+        database_name = rng.choice(DATABASES)
+        username = rng.choice(USERS)
+        pids = ended[(database_name, username)]
+        if pids and rng.random() < pid_reuse:
+            pid = pids.pop(rng.randrange(len(pids)))
+        else:
+            pid = next_pid
+            next_pid += 1
+        end = rng.uniform(start + 10, duration)
+        session = Session(
+            START_TIME + datetime.timedelta(seconds=start), START_TIME + datetime.timedelta(seconds=end),
+            database_name, username, rng.choice(APPLICATIONS), pid,
+        )
+        heapq.heappush(running, (end, len(sessions), session))
+        sessions.append(session)
+    return sessions
+
+
+def session_transactions(session, session_idx, transactions_per_connection):
+    """ Yield (time, session_idx, transaction_idx) for the transactions of a session, spread over
+        its lifetime """
+    interval = (session.end - session.start) / (transactions_per_connection + 1)
+    for idx in range(transactions_per_connection):
+        yield session.start + interval * (idx + 1), session_idx, idx
+
+
+class RotatingLogWriter:
+    """ Writes the lines of one type of log to a new gzipped file every file_minutes. Redshift
+        writes a user activity record once the next one starts, so the last record of a file is
+        never extracted: with format_record, each file ends with one that isn't part of the
+        workload """
+
+    def __init__(self, directory, log_type, file_minutes, format_record=None):
+        self.directory = directory
+        self.log_type = log_type
+        self.file_interval = datetime.timedelta(minutes=file_minutes)
+        self.format_record = format_record
+        self.file = None
+        self.file_end = None
+        self.files = 0
+        self.records = 0
+        self.bytes = 0
+
+    def write(self, record_time, line):
+        if self.file is None or record_time >= self.file_end:
+            self.close()
+            file_start = START_TIME + (record_time - START_TIME) // self.file_interval * self.file_interval
+            self.file_end = file_start + self.file_interval
+            path = f"{self.directory}/{log_filename(self.log_type, file_start)}"
+            self.file = gzip.open(path, "wb", compresslevel=1)
+            self.files += 1
+        data = line.encode("utf-8")
+        self.file.write(data)
+        self.bytes += len(data)
+        self.records += 1
+
+    def close(self):
+        if self.file is not None:
+            if self.format_record is not None:
+                padding_time = self.file_end - datetime.timedelta(seconds=1)
+                self.file.write(self.format_record(
+                    padding_time, "dev", "padding", 999, 999, "select 'padding';"
+                ).encode("utf-8"))
+            self.file.close()
+            self.file = None
+
+
+def write_synthetic_logs(directory, connections=1000, transactions_per_connection=10, duration_minutes=60,
+                         file_minutes=15, pid_reuse=0.2, jdbc_duplicates=0.1, multiline=0.5,
+                         start_node_fraction=0.01, query_mix=None, seed=0):
+    """ Write the audit logs of a synthetic workload to directory. Returns, by log type, the
+        number of files, records and decompressed bytes written """
+    rng = random.Random(seed)
+    query_mix = query_mix or DEFAULT_QUERY_MIX
+    kinds = list(query_mix)
+    weights = [query_mix[kind] for kind in kinds]
+    os.makedirs(directory, exist_ok=True)
+
+    sessions = generate_sessions(rng, connections, duration_minutes * 60, pid_reuse)
+
+    connection_log = RotatingLogWriter(directory, "connectionlog", file_minutes)
+    events = []
+    for session in sessions:
+        events.append((session.start, 0, connection_log_line(
+            "initiating session ", session.start, session.pid, session.database_name, session.username)))
+        events.append((session.start, 1, connection_log_line(
+            "set application_name ", session.start, session.pid, session.database_name, session.username,
+            session.application_name)))
+        events.append((session.end, 2, connection_log_line(
+            "disconnecting session ", session.end, session.pid, session.database_name, session.username)))
+    for event_time, _, line in sorted(events, key=lambda event: event[:2]):
+        connection_log.write(event_time, line)
+    connection_log.close()
+
+    user_activity_log = RotatingLogWriter(directory, "useractivitylog", file_minutes, user_activity_log_record)
+    start_node_log = RotatingLogWriter(directory, "start_node", file_minutes, start_node_log_record)
+    xid = 100000
+    transactions = heapq.merge(*(
+        session_transactions(session, idx, transactions_per_connection) for idx, session in enumerate(sessions)
+    ))
+    for transaction_time, session_idx, _ in transactions:
+        session = sessions[session_idx]
+        xid += 1
+        kind = rng.choices(kinds, weights)[0]
+        log = start_node_log if rng.random() < start_node_fraction else user_activity_log
+        for text in transaction_queries(kind, rng, rng.random() < multiline):
+            record = log.format_record(
+                transaction_time, session.database_name, session.username, session.pid, xid, text
+            )
+            log.write(transaction_time, record)
+            if log is user_activity_log and rng.random() < jdbc_duplicates:
+                log.write(transaction_time, record)
+    user_activity_log.close()
+    start_node_log.close()
+
+    return {log.log_type: {"files": log.files, "records": log.records, "bytes": log.bytes}
+            for log in (connection_log, user_activity_log, start_node_log)}
+
+
+def add_arguments(parser):
+    parser.add_argument("--connections", type=int, default=1000)
+    parser.add_argument("--transactions-per-connection", type=int, default=10)
+    parser.add_argument("--duration-minutes", type=int, default=60)
+    parser.add_argument("--file-minutes", type=int, default=15, help="minutes of logs in each file")
+    parser.add_argument("--pid-reuse", type=float, default=0.2,
+                        help="probability that a session reuses the pid of an earlier one")
+    parser.add_argument("--jdbc-duplicates", type=float, default=0.1,
+                        help="probability that a query is logged twice in a row")
+    parser.add_argument("--multiline", type=float, default=0.5,
+                        help="probability that a report is logged on several lines, with comments")
+    parser.add_argument("--start-node-fraction", type=float, default=0.01,
+                        help="fraction of the transactions logged in the start_node log")
+    parser.add_argument("--query-mix", default=None,
+                        help="weights of the kinds of transaction, e.g. select=50,report=20,cursor=5")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def synthetic_logs_kwargs(args):
+    query_mix = None
+    if args.query_mix:
+        query_mix = {kind: float(weight) for kind, weight in (_.split("=") for _ in args.query_mix.split(","))}
+    return dict(
+        connections=args.connections, transactions_per_connection=args.transactions_per_connection,
+        duration_minutes=args.duration_minutes, file_minutes=args.file_minutes, pid_reuse=args.pid_reuse,
+        jdbc_duplicates=args.jdbc_duplicates, multiline=args.multiline, start_node_fraction=args.start_node_fraction,
+        query_mix=query_mix, seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    written = write_synthetic_logs(args.directory, **synthetic_logs_kwargs(args))
+    for log_type, counts in written.items():
+        print(f"{log_type:>16}: {counts['files']} files, {counts['records']} records, "
+              f"{counts['bytes'] / 1024 / 1024:.1f} MB decompressed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Micro-benchmark of the audit log timestamp parsers used by extract, against the generic
+parsers they replace. Records are generated in bursts that share the same second, as they
+are in real audit logs:
+
+    python benchmarks/timestamp_parsing.py --records 100000 --records-per-second 200
+"""
+import argparse
+import datetime
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import dateutil.parser
+
+import extract
+
+
+def timestamps(records, records_per_second):
+    start = datetime.datetime(2021, 9, 2, 20, 0)
+    for idx in range(records):
+        yield start + datetime.timedelta(seconds=idx // records_per_second, microseconds=idx * 997 % 1000000)
+
+
+def report(name, baseline, fast, records):
+    print(f"{name:>18}: {baseline / records * 1e6:7.2f} us -> {fast / records * 1e6:7.2f} us per record "
+          f"({baseline / fast:.1f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=100000)
+    parser.add_argument("--records-per-second", type=int, default=200)
+    args = parser.parse_args()
+
+    times = list(timestamps(args.records, args.records_per_second))
+
+    user_activity = [t.strftime("%Y-%m-%dT%H:%M:%SZ") for t in times]
+    report("user activity log",
+           timeit.timeit(lambda: [dateutil.parser.parse(_) for _ in user_activity], number=1),
+           timeit.timeit(lambda: [extract.parse_audit_log_time(_) for _ in user_activity], number=1),
+           args.records)
+
+    start_node = [t.strftime("%Y-%m-%d %H:%M:%S UTC") for t in times]
+    report("start node log",
+           timeit.timeit(lambda: [dateutil.parser.parse(_) for _ in start_node], number=1),
+           timeit.timeit(lambda: [extract.parse_audit_log_time(_) for _ in start_node], number=1),
+           args.records)
+
+    connection = [t.strftime("%a, %d %b %Y %H:%M:%S:") + f"{t.microsecond // 1000:03d}" for t in times]
+    report("connection log",
+           timeit.timeit(lambda: [datetime.datetime.strptime(_, "%a, %d %b %Y %H:%M:%S:%f").replace(
+               tzinfo=datetime.timezone.utc) for _ in connection], number=1),
+           timeit.timeit(lambda: [extract.parse_connection_log_time(_) for _ in connection], number=1),
+           args.records)
+
+    filenames = [f"123456789012_redshift_us-east-1_cluster_useractivitylog_{t.strftime('%Y-%m-%dT%H:%M')}.gz"
+                 for t in times[::args.records_per_second]]
+    report("log filename",
+           timeit.timeit(lambda: [dateutil.parser.parse(_.split("_")[-1][:-3]).replace(
+               tzinfo=datetime.timezone.utc) for _ in filenames], number=1),
+           timeit.timeit(lambda: [extract.parse_log_filename_time(_) for _ in filenames], number=1),
+           len(filenames))
+
+
+if __name__ == "__main__":
+    main()
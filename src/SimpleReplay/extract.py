@@ -1,12 +1,23 @@
 import argparse
+import bisect
+import collections
+import concurrent.futures
+import copy
 import datetime
+import functools
 import gzip
+import hashlib
+import io
 import json
 import logging
+import math
+import multiprocessing
 import os
 import pathlib
+import random
 import re
 import redshift_connector
+import sys
 import threading
 import time
 import yaml
@@ -18,14 +29,34 @@ import boto3
 from boto3 import client
 import dateutil.parser
 
-from util import init_logging, set_log_level, prepend_ids_to_logs, add_logfile, log_version
+from util import init_logging, set_log_level, prepend_ids_to_logs, add_logfile, log_version, load_file, \
+    retrieve_compressed_json, retrieve_compressed_ndjson, file_exists
 
 logger = None
 g_disable_progress_bar = None
+g_config = {}
+
+# bytes of decompressed log read at a time when parsing audit logs
+g_read_buffer_size = 1024 * 1024
+
+# bytes per part when uploading the workload to s3. Parts other than the last must be at least 5MB
+g_upload_part_size = 8 * 1024 * 1024
+
+# bytes of workload compressed at a time by each thread, with workload_compression_threads
+g_compress_block_size = 1024 * 1024
+
+# SVL_STATEMENTTEXT rows fetched at a time, and databases queried at the same time
+g_statement_text_fetch_size = 10000
+g_statement_text_max_connections = 8
 
 g_bar_format = '{desc}: {percentage:3.0f}%|{bar}| {n_fmt}/{total_fmt} [{elapsed}{postfix}]'
 
 class Log:
+    # there are as many of these as queries in the extraction window, so no per-instance __dict__
+    __slots__ = (
+        "record_time", "start_time", "end_time", "username", "database_name", "pid", "xid", "text", "fingerprint",
+    )
+
     def __init__(self):
         self.record_time = ""
         self.start_time = ""
@@ -35,6 +66,8 @@ class Log:
         self.pid = ""
         self.xid = ""
         self.text = ""
+        # query_fingerprint of the text, kept while this is the last query of its transaction
+        self.fingerprint = None
 
     def get_filename(self):
         base_name = (
@@ -73,7 +106,16 @@ class Log:
     def __hash__(self):
         return hash((str(self.pid), str(self.xid), self.text.strip("\n")))
 
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__ if key != "fingerprint"}
+
 class ConnectionLog:
+    # in the order of the fields of connections.json
+    __slots__ = (
+        "session_initiation_time", "disconnection_time", "application_name", "database_name", "username", "pid",
+        "time_interval_between_transactions", "time_interval_between_queries",
+    )
+
     def __init__(self, session_initiation_time, end_time, database_name, username, pid):
         self.session_initiation_time = session_initiation_time
         self.disconnection_time = end_time
@@ -105,8 +147,13 @@ class ConnectionLog:
     def get_pk(self):
         return hash((self.session_initiation_time, self.database_name, self.username, self.pid))
 
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
 
 class SystemLog:
+    __slots__ = ("start_time", "end_time", "database_name", "user_id", "pid", "xid", "text")
+
     def __init__(self, start_time, end_time, database_name, user_id, pid, xid, text):
         self.start_time = start_time
         self.end_time = end_time
@@ -147,77 +194,126 @@ class SystemLog:
 def retrieve_source_cluster_statement_text(
     source_cluster_urls, databases, start_time, end_time, interface
 ):
-    statement_text_logs = {}
-
-    for database_name in databases:
-        with initiate_connection(
-            source_cluster_urls, interface, database_name
-        ) as connection:
-            cursor = connection.cursor()
-
-            start_time_where = ""
-            end_time_where = ""
-            if start_time:
-                start_time_where = (
-                    f"AND starttime > '{start_time.strftime('%Y-%m-%d %H:%M:%S')}' "
-                )
-            if end_time:
-                end_time_where = (
-                    f"AND endtime < '{end_time.strftime('%Y-%m-%d %H:%M:%S')}' "
-                )
+    """ Fetch SVL_STATEMENTTEXT from every database, at most g_statement_text_max_connections at a
+        time, indexed by (xid, pid) and then by the second each statement started in """
+    statement_text_logs = collections.defaultdict(lambda: collections.defaultdict(list))
+    if not databases:
+        return statement_text_logs
+
+    max_workers = min(len(databases), g_statement_text_max_connections)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                retrieve_database_statement_text, source_cluster_urls, database_name, start_time, end_time, interface
+            )
+            for database_name in databases
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            for system_log in future.result():
+                statement_text_logs[(str(system_log.xid), str(system_log.pid))][
+                    system_log.start_time.replace(microsecond=0)
+                ].append(system_log)
+
+    return statement_text_logs
+
 
-            cursor.execute(
-                "SELECT starttime, endtime, userid, pid, xid, text, sequence "
-                "FROM SVL_STATEMENTTEXT "
-                f"WHERE userid>1 {start_time_where} {end_time_where}"
-                "ORDER BY xid, starttime, sequence;"
+def retrieve_database_statement_text(source_cluster_urls, database_name, start_time, end_time, interface):
+    with initiate_connection(
+        source_cluster_urls, interface, database_name
+    ) as connection:
+        cursor = connection.cursor()
+
+        start_time_where = ""
+        end_time_where = ""
+        if start_time:
+            start_time_where = (
+                f"AND starttime > '{start_time.strftime('%Y-%m-%d %H:%M:%S')}' "
+            )
+        if end_time:
+            end_time_where = (
+                f"AND endtime < '{end_time.strftime('%Y-%m-%d %H:%M:%S')}' "
             )
 
-            fetch_size = 10000
+        cursor.execute(
+            "SELECT starttime, endtime, userid, pid, xid, text, sequence "
+            "FROM SVL_STATEMENTTEXT "
+            f"WHERE userid>1 {start_time_where} {end_time_where}"
+            "ORDER BY xid, starttime, sequence;"
+        )
 
-            rows = cursor.fetchmany(fetch_size)
-            complete_log = None
-            for row in rows:
-                start_time = row[0].replace(tzinfo=datetime.timezone.utc)
-                end_time = row[1].replace(tzinfo=datetime.timezone.utc)
-                system_log = SystemLog(
-                    start_time, end_time, database_name, row[2], row[3], row[4], row[5],
-                )
+        return list(stitch_statement_text(fetch_rows(cursor, g_statement_text_fetch_size), database_name))
 
-                if row[6] == 0:
-                    if complete_log is None:
-                        complete_log = system_log
-                    else:
-                        if hash(complete_log) in statement_text_logs:
-                            statement_text_logs[hash(complete_log)].append(complete_log)
-                        else:
-                            statement_text_logs[hash(complete_log)] = [complete_log]
-                        complete_log = system_log
-                else:
-                    if not complete_log is None:
-                        complete_log.text = complete_log.text + system_log.text
 
-                rows = cursor.fetchmany(fetch_size)
+def fetch_rows(cursor, fetch_size):
+    while True:
+        rows = cursor.fetchmany(fetch_size)
+        if not rows:
+            return
+        yield from rows
+
+
+def stitch_statement_text(rows, database_name):
+    """ Join the text fragments of each statement, which start again at sequence 0. Fragments
+        before the first sequence 0 belong to a statement outside the window and are dropped """
+    system_log = None
+    fragments = []
+    for row in rows:
+        if row[6] == 0:
+            if system_log is not None:
+                system_log.text = "".join(fragments)
+                yield system_log
+            system_log = SystemLog(
+                row[0].replace(tzinfo=datetime.timezone.utc),
+                row[1].replace(tzinfo=datetime.timezone.utc),
+                database_name, row[2], row[3], row[4], row[5],
+            )
+            fragments = [row[5]]
+        elif system_log is not None:
+            fragments.append(row[5])
+
+    if system_log is not None:
+        system_log.text = "".join(fragments)
+        yield system_log
+
+
+def pop_statement_text_log(statement_text_logs, audit_query):
+    """ Take the statement of the audit query's xid and pid with the same text, starting in the
+        second the query was logged or else as close to it as possible """
+    by_start_second = statement_text_logs.get((str(audit_query.xid), str(audit_query.pid)))
+    if not by_start_second:
+        return None
+
+    text = audit_query.text.strip("\n")
+    record_second = audit_query.record_time.replace(microsecond=0)
+    statement_text_log = pop_matching_text(by_start_second, record_second, text)
+    if statement_text_log is None:
+        for second in sorted(by_start_second, key=lambda _: abs(_ - record_second)):
+            statement_text_log = pop_matching_text(by_start_second, second, text)
+            if statement_text_log is not None:
+                break
+    return statement_text_log
 
-            if hash(complete_log) in statement_text_logs:
-                statement_text_logs[hash(complete_log)].append(complete_log)
-            else:
-                statement_text_logs[hash(complete_log)] = [complete_log]
 
-    return statement_text_logs
+def pop_matching_text(by_start_second, second, text):
+    candidates = by_start_second.get(second, [])
+    for idx, candidate in enumerate(candidates):
+        if candidate.text.strip("\n") == text:
+            del candidates[idx]
+            if not candidates:
+                del by_start_second[second]
+            return candidate
+    return None
 
 
 def combine_logs(audit_logs, statement_text_logs):
     for audit_transaction in audit_logs:
         for audit_query in audit_logs[audit_transaction]:
-            matching_statement_text_logs = statement_text_logs.get(hash(audit_query))
-            if matching_statement_text_logs:
-                statement_text_log = matching_statement_text_logs.pop()
-                if statement_text_log:
-                    if statement_text_log.start_time:
-                        audit_query.start_time = statement_text_log.start_time
-                    if statement_text_log.end_time:
-                        audit_query.end_time = statement_text_log.end_time
+            statement_text_log = pop_statement_text_log(statement_text_logs, audit_query)
+            if statement_text_log:
+                if statement_text_log.start_time:
+                    audit_query.start_time = statement_text_log.start_time
+                if statement_text_log.end_time:
+                    audit_query.end_time = statement_text_log.end_time
 
 
 @contextmanager
@@ -250,138 +346,571 @@ def initiate_connection(cluster_urls, interface, database_name):
                 conn.close()
 
 
+class ExtractionStages:
+    """ Wall time, cpu time, bytes and records of each stage of an extraction, to tell whether it
+        is bound by the network, gzip or the parser. The cpu time is that of the thread running
+        the stage. Downloads and uploads run in threads alongside the other stages, so the wall
+        times overlap rather than add up.
+
+        decompress is the time spent reading decompressed audit logs, which includes the download
+        of s3 files that are not prefetched, and parse the time spent on what was read. """
+
+    filename = "extract_stats.json"
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, name, wall_time=0.0, cpu_time=0.0, bytes=0, records=0):
+        with self.lock:
+            stage = self.stages.setdefault(name, {"wall_time": 0.0, "cpu_time": 0.0, "bytes": 0, "records": 0})
+            stage["wall_time"] += wall_time
+            stage["cpu_time"] += cpu_time
+            stage["bytes"] += bytes
+            stage["records"] += records
+
+    def add_stages(self, stages):
+        for name, stage in stages.items():
+            self.add(name, **stage)
+
+    @contextmanager
+    def measure(self, name, bytes=0, records=0):
+        """ Add the time spent in the block to the stage. The block can set the bytes and records
+            of the dict it is given """
+        counts = {"bytes": bytes, "records": records}
+        start_wall_time = time.perf_counter()
+        start_cpu_time = time.thread_time()
+        try:
+            yield counts
+        finally:
+            self.add(name, time.perf_counter() - start_wall_time, time.thread_time() - start_cpu_time,
+                     counts["bytes"], counts["records"])
+
+    def summary(self):
+        summary = OrderedDict()
+        for name, stage in self.stages.items():
+            wall_time = stage["wall_time"]
+            summary[name] = dict(
+                stage,
+                mb_per_second=stage["bytes"] / 1024 / 1024 / wall_time if wall_time else None,
+                records_per_second=stage["records"] / wall_time if wall_time else None,
+            )
+        return summary
+
+    def log(self):
+        for name, stage in self.summary().items():
+            throughput = []
+            if stage["bytes"]:
+                throughput.append(f"{stage['bytes'] / 1024 / 1024:.1f} MB ({stage['mb_per_second'] or 0:.1f} MB/s)")
+            if stage["records"]:
+                throughput.append(f"{stage['records']} records ({stage['records_per_second'] or 0:.0f}/s)")
+            logger.info(f"{name}: {stage['wall_time']:.2f}s wall, {stage['cpu_time']:.2f}s cpu"
+                        + (", " + ", ".join(throughput) if throughput else ""))
+
+    def save(self, workload_location):
+        location = workload_location + "/" + self.filename
+        logger.info(f"Saving extraction stage timings to {location}")
+        stats_json = json.dumps({"stages": self.summary()}, indent=2)
+        if location.startswith("s3://"):
+            bucket_name, _, key = location[5:].partition("/")
+            client("s3").put_object(Body=stats_json, Bucket=bucket_name, Key=key)
+        else:
+            with open(location, "w") as stats_file:
+                stats_file.write(stats_json)
+
+
+g_stages = ExtractionStages()
+
+
+class TimedReader(io.RawIOBase):
+    """ A log file whose reads are added to the decompress stage, and the time between reads,
+        spent by the reader on what was read, to the parse stage """
+
+    def __init__(self, file):
+        super().__init__()
+        self.file = file
+        self.last_read = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        wall_time = time.perf_counter()
+        cpu_time = time.thread_time()
+        if self.last_read is not None:
+            g_stages.add("parse", wall_time - self.last_read[0], cpu_time - self.last_read[1])
+        size = self.file.readinto(b)
+        self.last_read = (time.perf_counter(), time.thread_time())
+        g_stages.add("decompress", self.last_read[0] - wall_time, self.last_read[1] - cpu_time, size or 0)
+        return size
+
+
+def count_records(records):
+    """ Add the records read from a log file to the parse stage """
+    num_records = 0
+    for record in records:
+        num_records += 1
+        yield record
+    g_stages.add("parse", records=num_records)
+
+
 def parse_log(
-    log_file, filename, connections, last_connections, logs, databases, start_time, end_time,
+    log_file, filename, connections, last_connections, logs, databases, start_time, end_time, sampler=None,
 ):
+    merge_log(
+        count_records(read_log(log_file, filename, start_time, end_time)),
+        filename, connections, last_connections, logs, databases, start_time, end_time, sampler,
+    )
+
+
+def read_log(log_file, filename, start_time, end_time):
+    """ Read the records of a single audit log file. This has no dependency on any other file, so
+        it can run in a separate process """
     if "useractivitylog" in filename:
         logger.debug(f"Parsing user activity log: {filename}")
-        parse_user_activity_log(log_file, logs, databases, start_time, end_time)
+        return read_user_activity_log(log_file, start_time, end_time)
     elif "connectionlog" in filename:
         logger.debug(f"Parsing connection log: {filename}")
-        parse_connection_log(log_file, connections, last_connections, start_time, end_time)
+        return read_connection_log(log_file, start_time, end_time)
     elif "start_node" in filename:
         logger.debug(f"Parsing start node log: {filename}")
-        parse_start_node_log(log_file, logs, databases, start_time, end_time)
+        return read_start_node_log(log_file, start_time, end_time)
+    return []
+
+
+def merge_log(records, filename, connections, last_connections, logs, databases, start_time, end_time,
+              sampler=None):
+    """ Add the records read from a single audit log file to the state built from the previous
+        files. Files must be merged in order since sessions, duplicates and FETCHes span files.
+        With a sampler, the queries of the sessions and transactions it leaves out are dropped """
+    if "useractivitylog" in filename:
+        for record in records:
+            if sampler is None or sampler.keep_query(record):
+                add_user_activity_log(record, logs, databases)
+    elif "connectionlog" in filename:
+        for record in records:
+            add_connection_event(record, connections, last_connections, start_time, end_time)
+            if sampler is not None:
+                sampler.add_connection_event(record)
+    elif "start_node" in filename:
+        for record in records:
+            if sampler is None or sampler.keep_query(record):
+                add_start_node_log(record, logs, databases)
+
+
+def open_log_file(location, content=None):
+    """ Open a gzipped audit log file, either local or s3. If the compressed content has already
+        been downloaded, it is read from memory instead """
+    filename = location.split("/")[-1]
+    if content is not None:
+        return gzip.GzipFile(fileobj=io.BytesIO(content))
+    if location.startswith("s3://"):
+        bucket_name, _, key = location[5:].partition("/")
+        log_object = boto3.resource("s3").Object(bucket_name, key)
+        return gzip.GzipFile(fileobj=log_object.get()["Body"])
+    if "start_node" in filename:
+        return gzip.open(location, "rt", encoding="ISO-8859-1")
+    return gzip.open(location, "r")
+
+
+def download_log_file(s3_client, location):
+    """ Download the compressed content of an s3 audit log file """
+    bucket_name, _, key = location[5:].partition("/")
+    with g_stages.measure("download") as stage:
+        content = s3_client.get_object(Bucket=bucket_name, Key=key)["Body"].read()
+        stage["bytes"] = len(content)
+    return content
+
+
+def prefetch_log_files(s3_client, log_locations, log_sizes, concurrency, max_prefetch_bytes):
+    """ Download s3 audit log files ahead of the parser with a pool of threads, so the network
+        and the parser are busy at the same time. Yields (location, content) in the order of
+        log_locations. At most `concurrency` files are downloaded ahead, and no new download
+        starts if the files not yet parsed would exceed max_prefetch_bytes. """
+    pending = collections.deque()
+    pending_bytes = 0
+    next_idx = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        try:
+            while pending or next_idx < len(log_locations):
+                while next_idx < len(log_locations) and len(pending) < concurrency:
+                    location = log_locations[next_idx]
+                    size = log_sizes.get(location, 0)
+                    # always allow one download, even if the file is larger than the cap
+                    if pending and pending_bytes + size > max_prefetch_bytes:
+                        break
+                    pending.append((location, size, executor.submit(download_log_file, s3_client, location)))
+                    pending_bytes += size
+                    next_idx += 1
+
+                location, size, future = pending.popleft()
+                content = future.result()
+                pending_bytes -= size
+                yield location, content
+        finally:
+            for _, _, future in pending:
+                future.cancel()
+
+
+def init_log_worker():
+    global logger
+    logger = logging.getLogger("SimpleReplayLogger")
+
+
+def intern_record_strings(records):
+    """ Share the repeated strings of records unpickled from a worker process again, as the
+        parser does """
+    for record in records:
+        if isinstance(record, Log):
+            record.username = sys.intern(record.username)
+            record.database_name = sys.intern(record.database_name)
+            record.pid = sys.intern(record.pid)
+            yield record
+        else:
+            (event, event_time, database_name, username, pid, application_name) = record
+            yield (event, event_time, sys.intern(database_name), sys.intern(username), sys.intern(pid),
+                   application_name)
+
+
+def read_log_file(job):
+    """ Worker entry point to read a single audit log file into a list of records. Returns the
+        timings of the file too, since the stages of the worker process are not the extraction's """
+    global g_stages
+    g_stages = ExtractionStages()
+    (location, start_time, end_time) = job
+    filename = location.split("/")[-1]
+    log_file = open_log_file(location)
+    try:
+        records = list(read_log(log_file, filename, start_time, end_time))
+        g_stages.add("parse", records=len(records))
+        return filename, records, g_stages.stages
+    finally:
+        log_file.close()
+
+
+def parse_log_files(log_locations, connections, last_connections, logs, databases, start_time, end_time,
+                    num_workers=None, log_sizes=None, manifest=None, sampler=None):
+    """ Parse the audit log files in order. With more than one worker, the files are read in
+        parallel by a process pool and merged back in the original order, so the result is the
+        same as parsing them one at a time. Otherwise s3 files are downloaded ahead of the parser
+        by prefetch_log_files, using log_sizes (compressed bytes by location) to cap memory.
+        With a manifest, files fully parsed by a previous extraction are skipped. With a sampler,
+        only the sampled queries are kept. """
+    if manifest:
+        num_files = len(log_locations)
+        log_locations = manifest.unprocessed(log_locations)
+        logger.info(f"Skipping {num_files - len(log_locations)} files already extracted")
+
+    if num_workers and num_workers > 1 and len(log_locations) > 1:
+        logger.info(f"Parsing {len(log_locations)} files with {num_workers} processes")
+        jobs = [(location, start_time, end_time) for location in log_locations]
+        with multiprocessing.Pool(num_workers, initializer=init_log_worker) as pool:
+            for filename, records, stages in tqdm(pool.imap(read_log_file, jobs), total=len(jobs), disable=g_disable_progress_bar, unit='files', desc='Files processed', bar_format=g_bar_format):
+                if g_disable_progress_bar:
+                    logger.info(f"Processed {filename}")
+                g_stages.add_stages(stages)
+                with g_stages.measure("merge", records=len(records)):
+                    merge_log(intern_record_strings(records), filename, connections, last_connections, logs,
+                              databases, start_time, end_time, sampler)
+        last_connections.resolve(connections, end_time)
+        if manifest:
+            manifest.add_processed(log_locations, end_time)
+        return
+
+    download_concurrency = g_config.get("log_download_concurrency", 4) or 1
+    if download_concurrency > 1 and log_locations and log_locations[0].startswith("s3://"):
+        max_prefetch_bytes = (g_config.get("log_download_max_mb") or 512) * 1024 * 1024
+        log_files = prefetch_log_files(
+            client("s3"), log_locations, log_sizes or {}, download_concurrency, max_prefetch_bytes
+        )
+    else:
+        log_files = ((location, None) for location in log_locations)
+
+    for location, content in tqdm(log_files, total=len(log_locations), disable=g_disable_progress_bar, unit='files', desc='Files processed', bar_format=g_bar_format):
+        filename = location.split("/")[-1]
+        if g_disable_progress_bar:
+            logger.info(f"Processing {filename}")
+        log_file = open_log_file(location, content)
+        parse_log(
+            log_file, filename, connections, last_connections, logs, databases, start_time, end_time, sampler,
+        )
+        log_file.close()
+
+    last_connections.resolve(connections, end_time)
+    if manifest:
+        manifest.add_processed(log_locations, end_time)
+
+
+g_audit_time_pattern = re.compile(r"(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})(?:Z| UTC)")
+g_connection_log_time_pattern = re.compile(r"\w{3}, (\d{1,2}) (\w{3}) (\d{4}) (\d{2}):(\d{2}):(\d{2})")
+g_log_filename_time_pattern = re.compile(r"(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2})(?::(\d{2}))?")
+g_month_numbers = {month: idx + 1 for idx, month in enumerate(
+    ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"])}
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_audit_log_time(timestamp):
+    """ Parse a record time from a user activity log (2021-09-02T20:00:05Z) or start node log
+        (2021-09-02 20:00:05 UTC). Records come in bursts sharing the same second, so results
+        are cached. Anything else falls back to dateutil. """
+    match = g_audit_time_pattern.fullmatch(timestamp)
+    if not match:
+        return dateutil.parser.parse(timestamp)
+    return datetime.datetime(*map(int, match.groups()), tzinfo=datetime.timezone.utc)
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_connection_log_second(timestamp):
+    match = g_connection_log_time_pattern.fullmatch(timestamp)
+    if not match or match.group(2) not in g_month_numbers:
+        return None
+    day, month, year, hour, minute, second = match.groups()
+    return datetime.datetime(int(year), g_month_numbers[month], int(day), int(hour), int(minute), int(second),
+                             tzinfo=datetime.timezone.utc)
+
+
+def parse_connection_log_time(timestamp):
+    """ Parse an event time from a connection log, e.g. Thu, 02 Sep 2021 20:16:34:123. The
+        result for the whole second is cached and the fraction added to it. Anything else
+        falls back to strptime. """
+    seconds, _, fraction = timestamp.rpartition(":")
+    event_second = parse_connection_log_second(seconds)
+    if event_second is None or not (0 < len(fraction) <= 6 and fraction.isdigit()):
+        return datetime.datetime.strptime(timestamp, "%a, %d %b %Y %H:%M:%S:%f").replace(
+            tzinfo=datetime.timezone.utc
+        )
+    return event_second.replace(microsecond=int(fraction.ljust(6, "0")))
+
+
+def parse_log_filename_time(filename):
+    """ Parse the time at the end of an audit log filename, e.g. ..._useractivitylog_2021-09-02T20:16.gz """
+    timestamp = filename.split("_")[-1][:-3]
+    match = g_log_filename_time_pattern.fullmatch(timestamp)
+    if not match:
+        return dateutil.parser.parse(timestamp).replace(tzinfo=datetime.timezone.utc)
+    return datetime.datetime(*(int(_) for _ in match.groups() if _ is not None), tzinfo=datetime.timezone.utc)
+
+
+def read_lines(file):
+    """ Iterate over the decoded lines of a log file through a fixed size buffer, so memory use
+        doesn't depend on the size of the file. Lines end only at a newline, as with readlines() """
+    if isinstance(file, io.TextIOBase):
+        return file
+    return io.TextIOWrapper(
+        io.BufferedReader(TimedReader(file), buffer_size=g_read_buffer_size), encoding="utf-8", newline="\n"
+    )
 
 
 def parse_connection_log(file, connections, last_connections, start_time, end_time):
-    for line in file.readlines():
-        line = line.decode("utf-8")
+    for connection_event in read_connection_log(file, start_time, end_time):
+        add_connection_event(connection_event, connections, last_connections, start_time, end_time)
+
+
+def read_connection_log(file, start_time, end_time):
+    """ Yield (event, event_time, database_name, username, pid, application_name) for each
+        connection log line inside the extraction window """
+    for line in read_lines(file):
         connection_information = line.split("|")
         connection_event = connection_information[0]
-        event_time = datetime.datetime.strptime(
-            connection_information[1], "%a, %d %b %Y %H:%M:%S:%f"
-        ).replace(tzinfo=datetime.timezone.utc)
-        pid = connection_information[4]
-        database_name = connection_information[5].strip()
+        event_time = parse_connection_log_time(connection_information[1])
+        pid = sys.intern(connection_information[4])
+        database_name = sys.intern(connection_information[5].strip())
         if connection_information[7].strip() == 'IAM AssumeUser':
-            username = connection_information[6].strip()[4:]
+            username = sys.intern(connection_information[6].strip()[4:])
         else:
-            username = connection_information[6].strip()
+            username = sys.intern(connection_information[6].strip())
         application_name = connection_information[15]
 
         if username != "rdsdb" and (not start_time or event_time >= start_time) and (not end_time or event_time <= end_time):
+            yield (connection_event, event_time, database_name, username, pid, application_name)
 
-            connection_log = ConnectionLog(event_time, end_time, database_name, username, pid)
-            if connection_event == "initiating session ":
-                connection_key = connection_log.get_pk()
-                # create a new connection
-                connections[connection_key] = connection_log
-                last_connections[hash(connection_log)]=connection_key
-            elif connection_event == "set application_name ":
-                if hash(connection_log) in last_connections:
-                    connection_key = last_connections[hash(connection_log)]
-                    if connection_key in connections:
-                        # set the latest connection with application name
-                        connections[connection_key].application_name = " ".join(application_name.split())
-                    else:
-                        # create new connection if there's no one yet with start
-                        # time equals to start of extraction
-                        connection_log.session_initiation_time = start_time
-                        connection_key = connection_log.get_pk()
-                        connections[connection_key] = connection_log
-                        last_connections[hash(connection_log)] = connection_key
-            elif connection_event == "disconnecting session ":
-                if hash(connection_log) in last_connections:
-                    connection_key = last_connections[hash(connection_log)]
-                    if connection_key in connections:
-                        # set the latest connection with disconnection time
-                        connections[connection_key].disconnection_time = event_time
-                else:
-                    # create new connection if there's no one yet with start
-                    # time equals to start of extraction
-                    connection_log.session_initiation_time = start_time
-                    connection_log.disconnection_time = event_time
-                    connection_key = connection_log.get_pk()
-                    connections[connection_key] = connection_log
-                    last_connections[hash(connection_log)] = connection_key
+
+g_min_time = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+
+
+class SessionIndex:
+    """ The sessions of each (database, user, pid) in time order. Redshift reuses pids, so an event
+        belongs to the session of its pid running at the time of the event, which is found by
+        bisecting its sessions, whatever order the log files are read in.
+
+        A disconnection before any session of its pid starts, because the session started before
+        the extraction or in a file not read yet, starts a session at the start of the extraction.
+        Its start isn't known, so it is ordered by its disconnection: sessions of a pid don't
+        overlap. Once every file is read, resolve() joins each session still running to such a
+        disconnection after it. """
+
+    def __init__(self, connections=()):
+        # by session, the time each session is ordered by and the sessions in the same order
+        self.times = collections.defaultdict(list)
+        self.sessions = collections.defaultdict(list)
+        self.unknown_starts = set()
+        for connection in connections:
+            self.add(connection)
+
+    def __contains__(self, session):
+        return session in self.sessions
+
+    def add(self, connection, start_known=True):
+        session = (connection.database_name, connection.username, connection.pid)
+        if start_known:
+            order_time = connection.session_initiation_time or g_min_time
+        else:
+            order_time = connection.disconnection_time
+            self.unknown_starts.add(id(connection))
+        idx = bisect.bisect_right(self.times[session], order_time)
+        self.times[session].insert(idx, order_time)
+        self.sessions[session].insert(idx, connection)
+
+    def find(self, session, event_time):
+        """ The session of a (database, user, pid) that started last at or before event_time, or
+            None if its start isn't known """
+        if session not in self.sessions:
+            return None
+        idx = bisect.bisect_right(self.times[session], event_time)
+        if idx == 0 or not self.start_known(self.sessions[session][idx - 1]):
+            return None
+        return self.sessions[session][idx - 1]
+
+    def start_known(self, connection):
+        return id(connection) not in self.unknown_starts
+
+    def resolve(self, connections, end_time):
+        """ Join each session without a disconnection to the disconnection after it whose session
+            start wasn't found, which were logged in files read out of order """
+        for session, sessions in self.sessions.items():
+            for idx in range(len(sessions) - 1, 0, -1):
+                running, disconnected = sessions[idx - 1], sessions[idx]
+                if self.start_known(running) and running.disconnection_time == end_time \
+                        and not self.start_known(disconnected):
+                    running.disconnection_time = disconnected.disconnection_time
+                    del self.times[session][idx]
+                    del sessions[idx]
+                    self.unknown_starts.discard(id(disconnected))
+                    if connections.get(disconnected.get_pk()) is disconnected:
+                        del connections[disconnected.get_pk()]
+            # sessions starting at the start of the extraction have the same key, and one may
+            # have replaced another that is still a session
+            for connection in sessions:
+                connections.setdefault(connection.get_pk(), connection)
+
+
+def add_connection_event(connection_event, connections, last_connections, start_time, end_time):
+    """ Apply a single connection log event to the connections seen so far. last_connections is
+        the SessionIndex of the connections """
+    (event, event_time, database_name, username, pid, application_name) = connection_event
+
+    session = (database_name, username, pid)
+    connection_log = last_connections.find(session, event_time)
+    if event == "initiating session ":
+        # create a new connection
+        connection_log = ConnectionLog(event_time, end_time, database_name, username, pid)
+        connections[connection_log.get_pk()] = connection_log
+        last_connections.add(connection_log)
+    elif event == "set application_name ":
+        if connection_log is not None:
+            connection_log.application_name = " ".join(application_name.split())
+    elif event == "disconnecting session ":
+        disconnection_time = event_time
+        while connection_log is not None and connection_log.disconnection_time != end_time \
+                and connection_log.disconnection_time > disconnection_time:
+            # the session found disconnects at this time, so the later disconnection it had
+            # belongs to a later session of its pid, read from a file before this one
+            connection_log.disconnection_time, disconnection_time = \
+                disconnection_time, connection_log.disconnection_time
+            connection_log = last_connections.find(session, disconnection_time)
+        if connection_log is not None and connection_log.disconnection_time in (end_time, disconnection_time):
+            # the session running at the time of the event
+            connection_log.disconnection_time = disconnection_time
+        else:
+            # create new connection if there's no one yet with start
+            # time equals to start of extraction
+            connection_log = ConnectionLog(start_time, disconnection_time, database_name, username, pid)
+            connections[connection_log.get_pk()] = connection_log
+            last_connections.add(connection_log, start_known=False)
 
 
 def parse_user_activity_log(file, logs, databases, start_time, end_time):
+    for user_activity_log in read_user_activity_log(file, start_time, end_time):
+        add_user_activity_log(user_activity_log, logs, databases)
+
+
+def read_user_activity_log(file, start_time, end_time):
+    """ Yield each valid record of a user activity log, in file order """
     user_activity_log = Log()
 
     datetime_pattern = re.compile(r"'\d+-\d+-\d+T\d+:\d+:\d+Z UTC")
-    fetch_pattern = re.compile(r"fetch\s+(next|all|forward all|\d+|forward\s+\d+)\s+(from|in)\s+\S+", flags=re.IGNORECASE)
-    for line in file.readlines():
-        line = line.decode("utf-8")
+    for line in read_lines(file):
         if datetime_pattern.match(line):
             if user_activity_log.xid and is_valid_log(
                 user_activity_log, start_time, end_time
             ):
-                filename = user_activity_log.get_filename()
-                if filename in logs:
-                    # Check if duplicate. This happens with JDBC connections.
-                    prev_query = logs[filename][-1]
-                    if not is_duplicate(prev_query.text, user_activity_log.text):
-                        if fetch_pattern.search(prev_query.text) and fetch_pattern.search(user_activity_log.text):
-                            user_activity_log.text = f"--{user_activity_log.text}"
-                            logs[filename].append(user_activity_log)
-                        else:
-                            logs[filename].append(user_activity_log)
-                else:
-                    logs[filename] = [user_activity_log]
-
-                databases.add(user_activity_log.database_name)
+                yield user_activity_log
                 user_activity_log = Log()
             line_split = line.split(" LOG: ")
             query_information = line_split[0].split(" ")
 
-            user_activity_log.record_time = dateutil.parser.parse(
-                query_information[0][1:]
-            )
-            user_activity_log.username = query_information[4][5:]
-            user_activity_log.database_name = query_information[3][3:]
-            user_activity_log.pid = query_information[5][4:]
+            user_activity_log.record_time = parse_audit_log_time(query_information[0][1:])
+            # a few users, databases and sessions make up most records, so share their strings
+            user_activity_log.username = sys.intern(query_information[4][5:])
+            user_activity_log.database_name = sys.intern(query_information[3][3:])
+            user_activity_log.pid = sys.intern(query_information[5][4:])
             user_activity_log.xid = query_information[7][4:]
             user_activity_log.text = line_split[1]
         else:
             user_activity_log.text += line
 
 
+g_fetch_pattern = re.compile(r"fetch\s+(next|all|forward all|\d+|forward\s+\d+)\s+(from|in)\s+\S+", flags=re.IGNORECASE)
+
+
+def add_user_activity_log(user_activity_log, logs, databases):
+    """ Add a user activity record to its transaction, dropping JDBC duplicates of the previous
+        query and commenting out consecutive FETCHes """
+    filename = user_activity_log.get_filename()
+    if filename in logs:
+        # Check if duplicate. This happens with JDBC connections.
+        prev_query = logs[filename][-1]
+        prev_fingerprint = get_fingerprint(prev_query)
+        fingerprint = get_fingerprint(user_activity_log)
+        if not is_duplicate_fingerprint(prev_fingerprint, fingerprint, prev_query.text, user_activity_log.text):
+            if prev_fingerprint.fetch and fingerprint.fetch:
+                user_activity_log.text = f"--{user_activity_log.text}"
+                user_activity_log.fingerprint = None
+            prev_query.fingerprint = None
+            logs[filename].append(user_activity_log)
+    else:
+        logs[filename] = [user_activity_log]
+
+    databases.add(user_activity_log.database_name)
+
+
+# records containing any of these are not extracted
+g_problem_keywords = (
+    "SPECTRUM INTERNAL QUERY",
+    "context: SQL",
+    "ERROR:",
+    "CONTEXT:  SQL",
+    "show ",
+    "Undoing transaction",
+    "Undo on",
+    "pg_terminate_backend",
+    "pg_cancel_backend",
+    "volt_",
+    "pg_temp_",
+)
+
+
+def has_problem_keyword(text):
+    """ Check the text for problem keywords, stopping at the first one found. BIND is only a
+        problem if BINDING isn't in the text """
+    for word in g_problem_keywords:
+        if word in text:
+            return True
+    return "BIND" in text and "BINDING" not in text
+
+
 def is_valid_log(log, start_time, end_time):
     """If query doesn't contain problem statements, saves it."""
-    problem_keywords = [
-        "SPECTRUM INTERNAL QUERY",
-        "context: SQL",
-        "ERROR:",
-        "CONTEXT:  SQL",
-        "show ",
-        "Undoing transaction",
-        "Undo on",
-        "pg_terminate_backend",
-        "pg_cancel_backend",
-        "volt_",
-        "pg_temp_",
-    ]
-
-    potential_problem_keywords = [
-        "BIND"
-    ]
-
-    not_problem_keywords = [
-        "BINDING"
-    ]
-
     if log.username == "rdsdb":
         return False
 
@@ -391,69 +920,102 @@ def is_valid_log(log, start_time, end_time):
     if end_time and log.record_time > end_time:
         return False
 
-    if any(word in log.text for word in problem_keywords):
-        return False
-
-    if any(word in log.text for word in potential_problem_keywords) and not any(word in log.text for word in not_problem_keywords):
+    if has_problem_keyword(log.text):
         return False
 
     return True
 
 
-def is_duplicate(first_query_text, second_query_text):
-    dedupe_these = [
-        "set",
-        "select",
-        "create",
-        "delete",
-        "update",
-        "insert",
-        "copy",
-        "unload",
-        "with"
-    ]
-
-    first_query_text = first_query_text.strip()
-    second_query_text = second_query_text.strip()
-    first_query_text_no_semi = first_query_text.replace(";", "")
-    second_query_tex_no_semi = second_query_text.replace(";", "")
-    second_query_comment_removed = second_query_text
-    first_query_comment_removed = first_query_text
-    if second_query_text.startswith("/*"):
-        second_query_comment_removed = second_query_text[second_query_text.find('*/')+2:len(second_query_text)].strip()
-    if first_query_text.startswith("/*"):
-        first_query_comment_removed = first_query_text[second_query_text.find('*/')+2:len(first_query_text)].strip()
-    return (
-        (
-                first_query_text_no_semi == second_query_tex_no_semi
-                and any(second_query_comment_removed.startswith(word) for word in dedupe_these)
-        ) or ((second_query_comment_removed.lower().startswith('create')) and (first_query_comment_removed.lower().startswith('create')) and second_query_comment_removed.endswith(';'))
-        or ((second_query_comment_removed.lower().startswith('drop')) and (first_query_comment_removed.lower().startswith('drop')) and second_query_comment_removed.endswith(';'))
-        or ((second_query_comment_removed.lower().startswith('alter')) and (first_query_comment_removed.lower().startswith('alter')) and second_query_comment_removed.endswith(';'))
+# queries starting with these are duplicates of an identical previous query
+g_dedupe_keywords = (
+    "set",
+    "select",
+    "create",
+    "delete",
+    "update",
+    "insert",
+    "copy",
+    "unload",
+    "with"
+)
+
+# queries starting with these are duplicates of a previous query starting with the same keyword
+g_dedupe_ddl_keywords = ("create", "drop", "alter")
+
+# enough of the start of a query to check for any of the keywords above
+g_fingerprint_head_length = max(len(word) for word in g_dedupe_keywords + g_dedupe_ddl_keywords)
+
+g_leading_whitespace_pattern = re.compile(r"\s*")
+
+QueryFingerprint = collections.namedtuple("QueryFingerprint", ["digest", "head", "ends_with_semicolon", "fetch"])
+
+
+def is_fetch(text):
+    # the case insensitive pattern is slow on long texts, which rarely have a FETCH
+    return "fetch" in text.lower() and g_fetch_pattern.search(text) is not None
+
+
+def query_fingerprint(text):
+    """ Everything is_duplicate needs to know about a query: the length and hash of the text
+        without semicolons, the start of the text after a leading block comment, whether that
+        ends with a semicolon, and whether the query is a FETCH """
+    text = text.strip()
+    text_no_semi = text.replace(";", "")
+    digest = (len(text_no_semi), hash(text_no_semi))
+    head_start = 0
+    if text.startswith("/*"):
+        head_start = g_leading_whitespace_pattern.match(text, text.find("*/") + 2).end()
+    return QueryFingerprint(
+        digest,
+        text[head_start:head_start + g_fingerprint_head_length],
+        head_start < len(text) and text.endswith(";"),
+        is_fetch(text),
+    )
+
+
+def get_fingerprint(log):
+    if log.fingerprint is None:
+        log.fingerprint = query_fingerprint(log.text)
+    return log.fingerprint
+
+
+def is_duplicate_fingerprint(first, second, first_text, second_text):
+    """ Check if the second query is a duplicate of the first, from their query_fingerprint. The
+        texts are only compared when the digests match, so a hash collision isn't a duplicate """
+    if first.digest == second.digest and second.head.startswith(g_dedupe_keywords) and (
+        first_text.strip().replace(";", "") == second_text.strip().replace(";", "")
+    ):
+        return True
+    first_head = first.head.lower()
+    second_head = second.head.lower()
+    return second.ends_with_semicolon and any(
+        second_head.startswith(word) and first_head.startswith(word) for word in g_dedupe_ddl_keywords
     )
 
 
+def is_duplicate(first_query_text, second_query_text):
+    return is_duplicate_fingerprint(query_fingerprint(first_query_text), query_fingerprint(second_query_text),
+                                    first_query_text, second_query_text)
+
+
 def parse_start_node_log(file, logs, databases, start_time, end_time):
+    for start_node_log in read_start_node_log(file, start_time, end_time):
+        add_start_node_log(start_node_log, logs, databases)
+
+
+def read_start_node_log(file, start_time, end_time):
+    """ Yield each valid statement of a start node log, in file order """
     start_node_log = Log()
 
     datetime_pattern = re.compile(r"'\d+-\d+-\d+ \d+:\d+:\d+ UTC")
 
-    for line in file.readlines():
+    for line in read_lines(file):
 
         if datetime_pattern.match(line):
             if start_node_log.xid and is_valid_log(
                 start_node_log, start_time, end_time
             ):
-                filename = start_node_log.get_filename()
-                if filename in logs:
-                    # Check if duplicate. This happens with JDBC connections.
-                    prev_query = logs[filename][-1]
-                    if not is_duplicate(prev_query.text, start_node_log.text):
-                        logs[filename].append(start_node_log)
-                else:
-                    logs[filename] = [start_node_log]
-
-                databases.add(start_node_log.database_name)
+                yield start_node_log
                 start_node_log = Log()
 
             line_split = line.split("LOG:  statement: ")
@@ -462,21 +1024,36 @@ def parse_start_node_log(file, logs, databases, start_time, end_time):
             if len(line_split) == 2:
                 query_information = line_split[0].split(" ")
 
-                start_node_log.record_time = dateutil.parser.parse(
+                start_node_log.record_time = parse_audit_log_time(
                     query_information[0][1:]
                     + " "
                     + query_information[1]
                     + " "
                     + query_information[2]
                 )
-                start_node_log.database_name = query_information[4].split("@")[1]
-                start_node_log.username = query_information[4][3:].split(":")[0]
-                start_node_log.pid = query_information[5][4:]
+                start_node_log.database_name = sys.intern(query_information[4].split("@")[1])
+                start_node_log.username = sys.intern(query_information[4][3:].split(":")[0])
+                start_node_log.pid = sys.intern(query_information[5][4:])
                 start_node_log.xid = query_information[7][4:]
                 start_node_log.text = line_split[1].strip()
         else:
             start_node_log.text += line
 
+
+def add_start_node_log(start_node_log, logs, databases):
+    filename = start_node_log.get_filename()
+    if filename in logs:
+        # Check if duplicate. This happens with JDBC connections.
+        prev_query = logs[filename][-1]
+        if not is_duplicate_fingerprint(get_fingerprint(prev_query), get_fingerprint(start_node_log), prev_query.text,
+                                        start_node_log.text):
+            prev_query.fingerprint = None
+            logs[filename].append(start_node_log)
+    else:
+        logs[filename] = [start_node_log]
+
+    databases.add(start_node_log.database_name)
+
 def connection_time_replacement(sorted_connections):
     i = 0
     min_init_time = sorted_connections[0]['session_initiation_time']
@@ -505,53 +1082,485 @@ def connection_time_replacement(sorted_connections):
     return sorted_connections
 
 
+g_sql_token_pattern = re.compile(r"--|/\*|\*/|'|\"")
+g_sql_quoted_end_patterns = {
+    # the rest of a string literal, which may escape quotes with '' or a backslash
+    "'": re.compile(r"[^'\\]*(?:(?:\\.|'')[^'\\]*)*'", flags=re.DOTALL),
+    # the rest of a quoted identifier
+    '"': re.compile(r'[^"]*(?:""[^"]*)*"'),
+}
+
+
 """
 Remove single line comments
 If a line comment is inside a block comment, then the line comment ends at the end of the comment
 
+This is a single pass over the query, jumping from one token to the next. String literals and
+quoted identifiers are copied as they are, so a -- inside them isn't taken for a comment
+
 param query: the multiline query to remove single line comments from
 return: a string of the update query lines
 """
 
 
 def remove_line_comments(query):
-    removed_string = query
-    prev_location = 0
+    pieces = []
+    # everything before copied_to is either in pieces or removed
+    copied_to = 0
+    position = 0
+    in_block_comment = False
+    query_length = len(query)
 
     while True:
-        line_comment_begin = removed_string.find('--', prev_location)
-        prev_location = line_comment_begin
-
-        # no more comments to find
-        if line_comment_begin == -1:
+        token = g_sql_token_pattern.search(query, position)
+        if not token:
             break
 
-        #found_comment = True
-        linebreak = removed_string.find('\n', line_comment_begin)
-        start_comment = removed_string.find('/*', line_comment_begin, linebreak if linebreak != -1 else len(removed_string))
-        end_comment = removed_string.find('*/', line_comment_begin, linebreak if linebreak != -1 else len(removed_string))
+        if token.group() == "--":
+            line_comment_begin = token.start()
+            linebreak = query.find('\n', line_comment_begin)
+            line_end = linebreak if linebreak != -1 else query_length
+            start_comment = query.find('/*', line_comment_begin, line_end)
+            end_comment = query.find('*/', line_comment_begin, line_end)
 
-        if linebreak != -1:
+            pieces.append(query[copied_to:line_comment_begin])
             if start_comment == -1 and end_comment != -1:
                 # if line comment is between start and end, then remove until end of comment
-                removed_string = removed_string[:line_comment_begin] + removed_string[end_comment:]
+                copied_to = end_comment
             else:
                 # else remove up the end of line
-                removed_string = removed_string[:line_comment_begin] + removed_string[linebreak:]
+                copied_to = line_end
+            position = copied_to
+        elif token.group() == "/*":
+            in_block_comment = True
+            position = token.end()
+        elif token.group() == "*/":
+            in_block_comment = False
+            position = token.end()
+        elif in_block_comment:
+            # quotes in comments don't start anything
+            position = token.end()
         else:
-            # reached end of query
-            if start_comment == -1 and end_comment != -1:
-                # if line comment is between start and end, then remove until end of comment
+            quoted_end = g_sql_quoted_end_patterns[token.group()].match(query, token.end())
+            # an unterminated literal runs to the end of the query
+            position = quoted_end.end() if quoted_end else query_length
+
+    pieces.append(query[copied_to:])
+    return "".join(pieces)
+
+
+class BlockGzipFile(io.RawIOBase):
+    """ A gzip file written to fileobj in blocks compressed by a pool of threads, like pigz. Each
+        block is a gzip member of its own, which gzip readers decode as a single stream. zlib
+        releases the GIL, so the blocks are compressed in parallel while the writer carries on.
+        Blocks are written in order, with at most twice as many as threads held in memory. Like
+        GzipFile, closing it doesn't close fileobj. """
+
+    def __init__(self, fileobj, compresslevel=9, threads=4, block_size=None):
+        super().__init__()
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.block_size = block_size or g_compress_block_size
+        self.max_pending_blocks = threads * 2
+        self.buffer = bytearray()
+        self.pending = collections.deque()
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.buffer.extend(b)
+        while len(self.buffer) >= self.block_size:
+            self.compress_block(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(b)
+
+    def compress_block(self, block):
+        # no timestamp, so the output only depends on the data
+        self.pending.append(self.executor.submit(gzip.compress, block, self.compresslevel, mtime=0))
+        while self.pending and (len(self.pending) > self.max_pending_blocks or self.pending[0].done()):
+            self.fileobj.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.buffer:
+                self.compress_block(bytes(self.buffer))
+                self.buffer = bytearray()
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().result())
+        finally:
+            self.executor.shutdown()
+            super().close()
+
+
+def open_workload_gzip(fileobj):
+    """ A gzip file to write a workload file to fileobj, compressed at workload_compression_level
+        and in blocks by workload_compression_threads threads if there are more than one """
+    compresslevel = g_config.get("workload_compression_level") or 9
+    threads = g_config.get("workload_compression_threads") or 1
+    if threads > 1:
+        return BlockGzipFile(fileobj, compresslevel, threads)
+    return gzip.GzipFile(fileobj=fileobj, mode="wb", compresslevel=compresslevel)
+
+
+class S3MultipartUpload(io.RawIOBase):
+    """ A file that is uploaded to s3 as it is written, without a local copy. Each part is
+        uploaded by a pool of threads as soon as it fills, so the writer and the upload run at the
+        same time. At most max_pending_parts parts are held in memory, the writer waits for the
+        oldest upload beyond that. The upload completes on close, or is aborted if the file is
+        used as a context manager and an exception is raised. """
+
+    max_copy_part_size = 5 * 1024 * 1024 * 1024
+
+    def __init__(self, s3_client, bucket_name, key, part_size=None, max_pending_parts=4):
+        super().__init__()
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.part_size = part_size or g_upload_part_size
+        self.max_pending_parts = max_pending_parts
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.pending = collections.deque()
+        self.executor = None
+        self.aborted = False
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.buffer.extend(b)
+        while len(self.buffer) >= self.part_size:
+            self.upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(b)
+
+    def start_upload(self):
+        if self.upload_id is None:
+            self.upload_id = self.s3_client.create_multipart_upload(Bucket=self.bucket_name, Key=self.key)["UploadId"]
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_pending_parts)
+
+    def copy_object(self, key):
+        """ Start the file with the content of the object at key, in the same bucket, before anything
+            is written. s3 copies an object of at least a part into parts of the upload, without it
+            being downloaded. A smaller one is read into the buffer, as parts other than the last
+            must be at least 5 MB """
+        size = self.s3_client.head_object(Bucket=self.bucket_name, Key=key)["ContentLength"]
+        if size < self.part_size:
+            self.write(self.s3_client.get_object(Bucket=self.bucket_name, Key=key)["Body"].read())
+            return
+        self.start_upload()
+        # a copied part is at most 5 GB
+        num_parts = -(-size // self.max_copy_part_size)
+        copy_part_size = -(-size // num_parts)
+        for first in range(0, size, copy_part_size):
+            last = min(first + copy_part_size, size) - 1
+            part_number = len(self.parts) + 1
+            response = self.s3_client.upload_part_copy(
+                Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id, PartNumber=part_number,
+                CopySource={"Bucket": self.bucket_name, "Key": key}, CopySourceRange=f"bytes={first}-{last}",
+            )
+            self.parts.append({"PartNumber": part_number, "ETag": response["CopyPartResult"]["ETag"]})
+
+    def upload_part(self, body):
+        self.start_upload()
+        while len(self.pending) >= self.max_pending_parts:
+            self.wait_for_part()
+        part_number = len(self.parts) + len(self.pending) + 1
+        future = self.executor.submit(self.upload_part_body, part_number, body)
+        self.pending.append((part_number, future))
+
+    def upload_part_body(self, part_number, body):
+        with g_stages.measure("upload", bytes=len(body)):
+            return self.s3_client.upload_part(
+                Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id, PartNumber=part_number, Body=body,
+            )
 
-                removed_string = removed_string[:line_comment_begin] + removed_string[end_comment:]
-            else:
-                # else remove up the end of line
-                removed_string = removed_string[:line_comment_begin]
+    def wait_for_part(self):
+        part_number, future = self.pending.popleft()
+        self.parts.append({"PartNumber": part_number, "ETag": future.result()["ETag"]})
 
-    return removed_string
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.aborted:
+                return
+            if self.upload_id is None:
+                # smaller than a part
+                with g_stages.measure("upload", bytes=len(self.buffer)):
+                    self.s3_client.put_object(Bucket=self.bucket_name, Key=self.key, Body=bytes(self.buffer))
+                return
+            if self.buffer:
+                # the last part may be smaller than part_size
+                self.upload_part(bytes(self.buffer))
+                self.buffer = bytearray()
+            while self.pending:
+                self.wait_for_part()
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id,
+                MultipartUpload={"Parts": self.parts},
+            )
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            if self.executor:
+                self.executor.shutdown()
+            super().close()
+
+    def abort(self):
+        if self.aborted:
+            return
+        self.aborted = True
+        for _, future in self.pending:
+            future.cancel()
+        if self.upload_id is not None:
+            logger.warning(f"Aborting upload to s3://{self.bucket_name}/{self.key}")
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        self.close()
+
+
+def get_transactions(logs, last_connections, missing_audit_log_connections, replacements):
+    """ Yield each transaction of the workload once all of its queries are cleaned up, in the
+        order the transactions were first logged, unless none of its queries could be. COPY
+        locations are added to replacements, and queries without a session to
+        missing_audit_log_connections """
+    filenames_by_xid = OrderedDict()
+    for filename, queries in logs.items():
+        if queries:
+            filenames_by_xid.setdefault(queries[0].xid, []).append(filename)
+
+    for xid, filenames in tqdm(filenames_by_xid.items(), disable=g_disable_progress_bar, unit='transactions', desc='Transactions processed', bar_format=g_bar_format):
+        # transaction has form { "xid": xxx, "pid": xxx, etc..., queries: [] }
+        transaction = None
+        for filename in filenames:
+            for query in logs[filename]:
+                try:
+                    if transaction is None:
+                        transaction = {"xid": query.xid,
+                                       "pid": query.pid,
+                                       "db": query.database_name,
+                                       "user": query.username,
+                                       "time_interval": True,
+                                       "queries": []}
+                    query_info = {
+                      "record_time": query.record_time.isoformat(),
+                      "start_time": query.start_time.isoformat() if query.start_time else None,
+                      "end_time": query.end_time.isoformat() if query.end_time else None
+                    }
+                except AttributeError:
+                    logger.error(f'Query is missing header info, skipping {filename}: {query}')
+                    continue
+
+                query.text = remove_line_comments(query.text).strip()
+
+                if "copy " in query.text.lower() and "from 's3:" in query.text.lower(): #Raj
+                    bucket = re.search(r"from 's3:\/\/[^']*", query.text, re.IGNORECASE).group()[6:]
+                    replacements.add(bucket)
+                    query.text = re.sub(
+                        r"IAM_ROLE 'arn:aws:iam::\d+:role/\S+'",
+                        f" IAM_ROLE ''",
+                        query.text,
+                        flags=re.IGNORECASE,
+                    )
+                if "unload" in query.text.lower() and "to 's3:" in query.text.lower():
+                    query.text = re.sub(
+                        r"IAM_ROLE 'arn:aws:iam::\d+:role/\S+'",
+                        f" IAM_ROLE ''",
+                        query.text,
+                        flags=re.IGNORECASE,
+                    )
+
+                query.text = f"{query.text.strip()}"
+                if not len(query.text) == 0:
+                    if not query.text.endswith(";"):
+                        query.text += ";"
+
+                if "%" in query.text:
+                    # Escape modulo operator in extract for replay - RR-411
+                    query_info['text'] = query.text.replace("%", "%%")
+                else:
+                    query_info['text'] = query.text
+
+                transaction['queries'].append(query_info)
+                if not (query.database_name, query.username, query.pid) in last_connections:
+                    missing_audit_log_connections.add((query.database_name, query.username, query.pid))
+        # every query of the transaction may have been skipped
+        if transaction is not None and transaction['queries']:
+            yield transaction
+
+
+def query_text_id(text):
+    """ Id of a query text in SQL_texts.ndjson.gz, the same for the same text in every extraction """
+    return hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=12).hexdigest()
 
 
-def save_logs(logs, last_connections, output_directory, connections, start_time, end_time):
+def write_text_table_transactions(write_transaction, transactions, output_directory, append):
+    """ Write the transactions with write_transaction, with the text of each query replaced by
+        its text_id. Each distinct text is written once to SQL_texts.ndjson.gz, as {"id", "text"}
+        lines. With append, texts already in the workload are not written again """
+    texts_filename = "SQL_texts.ndjson.gz"
+    append = append and file_exists(output_directory + "/" + texts_filename)
+    text_ids = set()
+    if append:
+        text_ids = {text["id"] for text in retrieve_compressed_ndjson(output_directory + "/" + texts_filename)}
+
+    if output_directory.startswith("s3://"):
+        bucket_name, _, output_prefix = output_directory[5:].partition("/")
+        texts_archive = S3MultipartUpload(boto3.client("s3"), bucket_name, output_prefix + "/" + texts_filename)
+    else:
+        texts_archive = open(output_directory + "/" + texts_filename, "ab" if append else "wb")
+
+    with texts_archive:
+        if append and isinstance(texts_archive, S3MultipartUpload):
+            texts_archive.copy_object(output_prefix + "/" + texts_filename)
+        with open_workload_gzip(texts_archive) as texts_file:
+            for transaction in transactions:
+                for query in transaction["queries"]:
+                    text = query.pop("text")
+                    query["text_id"] = query_text_id(text)
+                    if query["text_id"] not in text_ids:
+                        text_ids.add(query["text_id"])
+                        texts_file.write(json.dumps({"id": query["text_id"], "text": text}).encode("utf-8") + b"\n")
+                write_transaction(transaction)
+    logger.info(f"Exported {len(text_ids)} distinct query texts to {output_directory}/{texts_filename}")
+
+
+def transaction_time_range(transaction):
+    """ When the first query of a transaction dict starts and the last one ends, as replay orders
+        them: by their start_time, or their record_time if they don't have one """
+    start_times = [query["start_time"] or query["record_time"] for query in transaction["queries"]]
+    end_times = [query["end_time"] or query["record_time"] for query in transaction["queries"]]
+    return datetime.datetime.fromisoformat(min(start_times)), datetime.datetime.fromisoformat(max(end_times))
+
+
+class WorkloadShards:
+    """ Writes the transactions of a workload to a file per shard_minutes, by when they start, so
+        replay can load them as it goes. SQL_shards.json lists the files of each shard along with
+        its transactions, queries, time range and the connections (by database, user and pid) it
+        has transactions of, with the start and end time and number of queries of each of their
+        transactions, so replay can assign the shards to sessions without reading them.
+
+        Transactions are written roughly in time order, so only the files of the most recently
+        written shards are kept open. A shard written to again after its file was closed gets
+        another file. """
+
+    directory = "SQL_shards"
+    index_filename = "SQL_shards.json"
+    max_open_files = 8
+
+    def __init__(self, output_directory, shard_minutes):
+        self.output_directory = output_directory
+        self.shard_interval = datetime.timedelta(minutes=shard_minutes)
+        # by shard start, the archive and gzip file being written, least recently written first
+        self.files = OrderedDict()
+        self.shards = {}
+
+    def __enter__(self):
+        if not self.output_directory.startswith("s3://"):
+            pathlib.Path(self.output_directory + "/" + self.directory).mkdir(parents=True, exist_ok=True)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        while self.files:
+            self.close_file(next(iter(self.files)), exc_type, exc_val, exc_tb)
+        if exc_type is None:
+            self.save_index()
+
+    def write(self, transaction):
+        transaction_start, transaction_end = transaction_time_range(transaction)
+        epoch = datetime.datetime(1970, 1, 1, tzinfo=transaction_start.tzinfo)
+        shard_start = epoch + (transaction_start - epoch) // self.shard_interval * self.shard_interval
+        shard = self.shards.get(shard_start)
+        if shard is None:
+            shard = self.shards[shard_start] = {
+                "start_time": shard_start, "end_time": shard_start + self.shard_interval, "files": [],
+                "transactions": 0, "queries": 0, "first_start_time": transaction_start,
+                "last_end_time": transaction_end, "connections": {},
+            }
+        shard["transactions"] += 1
+        shard["queries"] += len(transaction["queries"])
+        shard["first_start_time"] = min(shard["first_start_time"], transaction_start)
+        shard["last_end_time"] = max(shard["last_end_time"], transaction_end)
+        connection_key = f"{transaction['db']}_{transaction['user']}_{transaction['pid']}"
+        connection = shard["connections"].get(connection_key)
+        if connection is None:
+            connection = shard["connections"][connection_key] = {
+                "db": transaction["db"], "user": transaction["user"], "pid": transaction["pid"], "transactions": [],
+            }
+        connection["transactions"].append(
+            [transaction_start.isoformat(), transaction_end.isoformat(), len(transaction["queries"])]
+        )
+        self.open_file(shard_start).write(json.dumps(transaction).encode("utf-8") + b"\n")
+
+    def open_file(self, shard_start):
+        if shard_start in self.files:
+            self.files.move_to_end(shard_start)
+            return self.files[shard_start][1]
+        if len(self.files) >= self.max_open_files:
+            self.close_file(next(iter(self.files)))
+        shard = self.shards[shard_start]
+        filename = f"{self.directory}/SQLs_{shard_start.strftime('%Y-%m-%dT%H-%M-%S')}_{len(shard['files'])}.ndjson.gz"
+        shard["files"].append(filename)
+        location = self.output_directory + "/" + filename
+        if location.startswith("s3://"):
+            bucket_name, _, key = location[5:].partition("/")
+            archive = S3MultipartUpload(boto3.client("s3"), bucket_name, key)
+        else:
+            archive = open(location, "wb")
+        self.files[shard_start] = (archive, open_workload_gzip(archive))
+        return self.files[shard_start][1]
+
+    def close_file(self, shard_start, exc_type=None, exc_val=None, exc_tb=None):
+        archive, file = self.files.pop(shard_start)
+        try:
+            file.close()
+        finally:
+            archive.__exit__(exc_type, exc_val, exc_tb)
+
+    def save_index(self):
+        index = {
+            "shard_minutes": self.shard_interval.total_seconds() / 60,
+            "shards": [
+                dict(shard, **{key: shard[key].isoformat()
+                               for key in ("start_time", "end_time", "first_start_time", "last_end_time")},
+                     connections=[shard["connections"][key] for key in sorted(shard["connections"])])
+                for _, shard in sorted(self.shards.items())
+            ],
+        }
+        location = self.output_directory + "/" + self.index_filename
+        logger.info(f"Exporting {len(self.shards)} workload shards to {location}")
+        index_json = json.dumps(index, indent=2)
+        if location.startswith("s3://"):
+            bucket_name, _, key = location[5:].partition("/")
+            boto3.client("s3").put_object(Body=index_json, Bucket=bucket_name, Key=key)
+        else:
+            with open(location, "w") as index_file:
+                index_file.write(index_json)
+
+
+def save_logs(logs, last_connections, output_directory, connections, start_time, end_time, append=False,
+              workload_format="ndjson", shard_minutes=None):
+    """ Write the workload. The transactions are written to SQLs.ndjson.gz one per line as they
+        are cleaned up, or with workload_format "json" to the legacy SQLs.json.gz, which holds
+        them all in a single object. With workload_format "ndjson_texts", SQLs.ndjson.gz refers to
+        the query texts by id and each distinct text is stored once, see
+        write_text_table_transactions. With shard_minutes, the transactions are written to a file
+        per shard_minutes instead of SQLs.ndjson.gz, see WorkloadShards.
+
+        With append, the transactions are added to the workload already in output_directory,
+        connections.json is replaced (connections holds all the sessions of the workload) and
+        existing copy replacements are kept. An appended SQLs.ndjson.gz may have several lines
+        for a transaction that spans extractions. """
     num_queries = 0
     for filename, transaction in logs.items():
         num_queries += len(transaction)
@@ -559,87 +1568,71 @@ def save_logs(logs, last_connections, output_directory, connections, start_time,
         f"Exporting {len(logs)} transactions ({num_queries} queries) to {output_directory}"
     )
 
+    workload_filename = "SQLs.json.gz" if workload_format == "json" else "SQLs.ndjson.gz"
     is_s3 = True
     if output_directory.startswith("s3://"):
         output_s3_location = output_directory[5:].partition("/")
         bucket_name = output_s3_location[0]
         output_prefix = output_s3_location[2]
         s3_client = boto3.client("s3")
-        archive_filename = "/tmp/SQLs.json.gz"
     else:
         is_s3 = False
-        archive_filename = output_directory + "/SQLs.json.gz"
+        archive_filename = output_directory + "/" + workload_filename
         logger.info(f"Creating directory {output_directory} if it doesn't already exist")
         pathlib.Path(output_directory).mkdir(parents=True, exist_ok=True)
 
-    # transactions has form { "xid": xxx, "pid": xxx, etc..., queries: [] }
-    sql_json = {"transactions": OrderedDict()}
+    append = append and file_exists(output_directory + "/" + workload_filename)
+    if append:
+        logger.info(f"Appending to the workload in {output_directory}")
 
     missing_audit_log_connections = set()
 
     # Save the main logs and find replacements
     replacements = set()
 
-    for filename, queries in tqdm(logs.items(), disable=g_disable_progress_bar, unit='files', desc='Files processed', bar_format=g_bar_format):
-        for idx, query in enumerate(queries):
-            try:
-                if query.xid not in sql_json['transactions']:
-                    sql_json['transactions'][query.xid] = {"xid": query.xid,
-                                                           "pid": query.pid,
-                                                           "db": query.database_name,
-                                                           "user": query.username,
-                                                           "time_interval": True,
-                                                           "queries": []}
-                query_info = {
-                  "record_time": query.record_time.isoformat(),
-                  "start_time": query.start_time.isoformat() if query.start_time else None,
-                  "end_time": query.end_time.isoformat() if query.end_time else None
-                }
-            except AttributeError:
-                logger.error(f'Query is missing header info, skipping {filename}: {query}')
-                continue
-
-            query.text = remove_line_comments(query.text).strip()
-
-            if "copy " in query.text.lower() and "from 's3:" in query.text.lower(): #Raj
-                bucket = re.search(r"from 's3:\/\/[^']*", query.text, re.IGNORECASE).group()[6:]
-                replacements.add(bucket)
-                query.text = re.sub(
-                    r"IAM_ROLE 'arn:aws:iam::\d+:role/\S+'",
-                    f" IAM_ROLE ''",
-                    query.text,
-                    flags=re.IGNORECASE,
-                )
-            if "unload" in query.text.lower() and "to 's3:" in query.text.lower():
-                query.text = re.sub(
-                    r"IAM_ROLE 'arn:aws:iam::\d+:role/\S+'",
-                    f" IAM_ROLE ''",
-                    query.text,
-                    flags=re.IGNORECASE,
-                )
-
-            query.text = f"{query.text.strip()}"
-            if not len(query.text) == 0:
-                if not query.text.endswith(";"):
-                    query.text += ";"
-
-            if "%" in query.text:
-                # Escape modulo operator in extract for replay - RR-411
-                query_info['text'] = query.text.replace("%", "%%")
+    transactions = get_transactions(logs, last_connections, missing_audit_log_connections, replacements)
+    if workload_format == "json":
+        sql_json = {"transactions": OrderedDict()}
+        if append:
+            sql_json = retrieve_compressed_json(output_directory + "/" + workload_filename)
+        for transaction in transactions:
+            if transaction["xid"] in sql_json["transactions"]:
+                sql_json["transactions"][transaction["xid"]]["queries"].extend(transaction["queries"])
             else:
-                query_info['text'] = query.text
-
-            sql_json['transactions'][query.xid]['queries'].append(query_info)
-            if not hash((query.database_name, query.username, query.pid)) in last_connections:
-                missing_audit_log_connections.add((query.database_name, query.username, query.pid))
+                sql_json["transactions"][transaction["xid"]] = transaction
 
-    with gzip.open(archive_filename, 'wb') as f:
-        f.write(json.dumps(sql_json, indent=2).encode('utf-8'))
+    if shard_minutes:
+        with WorkloadShards(output_directory, shard_minutes) as shards:
+            if workload_format == "ndjson_texts":
+                write_text_table_transactions(shards.write, transactions, output_directory, append)
+            else:
+                for transaction in transactions:
+                    shards.write(transaction)
+    else:
+        if is_s3:
+            logger.info(f"Uploading SQL archive to {output_directory}/{workload_filename}")
+            archive = S3MultipartUpload(s3_client, bucket_name, output_prefix + "/" + workload_filename)
+        else:
+            archive = open(archive_filename, "wb" if workload_format == "json" or not append else "ab")
 
-    if is_s3:
-        dest = output_prefix + "/SQLs.json.gz"
-        logger.info("Transferring SQL archive to {dest}")
-        s3_client.upload_file(archive_filename, bucket_name, dest)
+        with archive:
+            if workload_format == "json":
+                with open_workload_gzip(archive) as f:
+                    f.write(json.dumps(sql_json, indent=2).encode('utf-8'))
+            else:
+                if append and is_s3:
+                    # s3 objects can't be appended to, so the new lines are added to a copy
+                    archive.copy_object(output_prefix + "/" + workload_filename)
+                # appending adds a gzip member, which is read as if it were part of the same stream
+                with open_workload_gzip(archive) as f:
+                    if workload_format == "ndjson_texts":
+                        write_text_table_transactions(
+                            lambda transaction: f.write(json.dumps(transaction).encode("utf-8") + b"\n"),
+                            transactions, output_directory, append,
+                        )
+                    else:
+                        for transaction in transactions:
+                            f.write(json.dumps(transaction).encode("utf-8") + b"\n")
 
     logger.info(f"Generating {len(missing_audit_log_connections)} missing connections.")
     for missing_audit_log_connection_info in missing_audit_log_connections:
@@ -652,14 +1645,16 @@ def save_logs(logs, last_connections, output_directory, connections, start_time,
         )
         pk = connection.get_pk()
         connections[pk] = connection
+        # an incremental extraction continues this session rather than making up another one
+        last_connections.add(connection)
     logger.info(
         f"Exporting a total of {len(connections.values())} connections to {output_directory}"
     )
     # Save the connections logs
     sorted_connections = connections.values()
-    connections_dict = connection_time_replacement([connection.__dict__ for connection in sorted_connections])
+    connections_dict = connection_time_replacement([connection.to_dict() for connection in sorted_connections])
     connections_string = json.dumps(
-        [connection.__dict__ for connection in sorted_connections],
+        connections_dict,
         indent=4,
         default=str,
     )
@@ -670,7 +1665,7 @@ def save_logs(logs, last_connections, output_directory, connections, start_time,
             Key=output_prefix + "/connections.json",
         )
     else:
-        connections_file = open(output_directory + "/connections.json", "x")
+        connections_file = open(output_directory + "/connections.json", "w" if append else "x")
         connections_file.write(connections_string)
         connections_file.close()
 
@@ -679,6 +1674,13 @@ def save_logs(logs, last_connections, output_directory, connections, start_time,
     replacements_string = (
         "Original location,Replacement location,Replacement IAM role\n"
     )
+    if append and file_exists(output_directory + "/copy_replacements.csv"):
+        # keep the replacements already filled in for this workload
+        existing_replacements = load_file(output_directory + "/copy_replacements.csv", decode=True)
+        for line in existing_replacements.splitlines()[1:]:
+            if line:
+                replacements_string += line + "\n"
+                replacements.discard(line.split(",")[0])
     for bucket in replacements:
         replacements_string += bucket + ",,\n"
     if is_s3:
@@ -693,6 +1695,156 @@ def save_logs(logs, last_connections, output_directory, connections, start_time,
         replacements_file.close()
 
 
+class ExtractionManifest:
+    """ The audit log files already extracted into a workload and the parser state at the end of
+        the last extraction, so the next extraction into the same workload only parses new files.
+
+        A file is only recorded once a later file of the same type starts before the end of the
+        extraction, since the last ones may still hold records after it. Those are parsed again
+        by the next extraction, which starts just after the end of this one. """
+
+    filename = "extract_manifest.json"
+
+    def __init__(self):
+        self.end_time = ""
+        self.processed_files = set()
+        self.connections = {}
+        self.last_connections = SessionIndex()
+        self.last_queries = {}
+        self.databases = set()
+
+    def parser_state(self, end_time):
+        """ Return (connections, logs, databases, last_connections) to continue parsing from,
+            with the sessions still open at the end of the last extraction kept open until
+            end_time """
+        for connection in self.connections.values():
+            if self.end_time and connection.disconnection_time == self.end_time:
+                connection.disconnection_time = end_time
+        # the last query of each transaction file, to drop duplicates and comment out FETCHes
+        # continued by the new files. These are removed again by update()
+        logs = {filename: [query] for filename, query in self.last_queries.items()}
+        return (self.connections, logs, self.databases, self.last_connections)
+
+    def update(self, connections, logs, databases, last_connections, end_time):
+        """ Keep the parser state at the end of the extraction, and remove the queries added by
+            parser_state() so only the new ones are saved """
+        self.connections = connections
+        self.last_connections = last_connections
+        self.databases = databases
+        last_queries = {}
+        for filename, queries in logs.items():
+            # records are whole seconds, so the next extraction can't add to older files
+            if queries[-1].record_time >= end_time.replace(microsecond=0):
+                last_queries[filename] = copy.copy(queries[-1])
+        for filename in self.last_queries:
+            del logs[filename][0]
+            if not logs[filename]:
+                del logs[filename]
+        self.last_queries = last_queries
+        self.end_time = end_time
+
+    def unprocessed(self, log_locations):
+        return [location for location in log_locations if location.split("/")[-1] not in self.processed_files]
+
+    def add_processed(self, log_locations, end_time):
+        log_files = collections.defaultdict(list)
+        for location in log_locations:
+            filename = location.split("/")[-1]
+            log_type = next((_ for _ in ("connectionlog", "useractivitylog", "start_node") if _ in filename), None)
+            try:
+                file_time = parse_log_filename_time(filename)
+            except (ValueError, OverflowError):
+                continue
+            if log_type:
+                log_files[log_type].append((file_time, filename))
+
+        for files in log_files.values():
+            files.sort()
+            for (_, filename), (next_file_time, _) in zip(files, files[1:]):
+                if next_file_time <= end_time:
+                    self.processed_files.add(filename)
+
+    def to_json(self):
+        def time_string(value):
+            return value.isoformat() if value else ""
+
+        connections = list(self.connections.values())
+        return json.dumps({
+            "end_time": time_string(self.end_time),
+            "processed_files": sorted(self.processed_files),
+            "databases": sorted(self.databases),
+            "connections": [
+                dict(connection.to_dict(),
+                     session_initiation_time=time_string(connection.session_initiation_time),
+                     disconnection_time=time_string(connection.disconnection_time))
+                for connection in connections
+            ],
+            "last_queries": [
+                {**query.to_dict(),
+                 "record_time": time_string(query.record_time),
+                 "start_time": time_string(query.start_time),
+                 "end_time": time_string(query.end_time)}
+                for query in self.last_queries.values()
+            ],
+        }, indent=2)
+
+    @classmethod
+    def from_json(cls, manifest_json):
+        def parse_time(value):
+            return dateutil.parser.isoparse(value) if value else ""
+
+        state = json.loads(manifest_json)
+        manifest = cls()
+        manifest.end_time = parse_time(state["end_time"])
+        manifest.processed_files = set(state["processed_files"])
+        manifest.databases = set(state["databases"])
+
+        # connection keys are hashes, which change from one run to the next
+        for connection_info in state["connections"]:
+            connection = ConnectionLog(
+                parse_time(connection_info["session_initiation_time"]),
+                parse_time(connection_info["disconnection_time"]),
+                connection_info["database_name"],
+                connection_info["username"],
+                connection_info["pid"],
+            )
+            connection.application_name = connection_info["application_name"]
+            connection.time_interval_between_transactions = connection_info["time_interval_between_transactions"]
+            connection.time_interval_between_queries = connection_info["time_interval_between_queries"]
+            manifest.connections[connection.get_pk()] = connection
+        # the sessions of every connection, which older manifests kept only the last of
+        manifest.last_connections = SessionIndex(manifest.connections.values())
+
+        for query_info in state["last_queries"]:
+            query = Log()
+            for key, value in query_info.items():
+                setattr(query, key, value)
+            query.record_time = parse_time(query_info["record_time"])
+            query.start_time = parse_time(query_info["start_time"])
+            query.end_time = parse_time(query_info["end_time"])
+            manifest.last_queries[query.get_filename()] = query
+        return manifest
+
+    @classmethod
+    def load(cls, workload_location):
+        """ Load the manifest of a workload, or None if nothing was extracted into it yet """
+        location = workload_location + "/" + cls.filename
+        if not file_exists(location):
+            return None
+        logger.info(f"Loading extraction manifest {location}")
+        return cls.from_json(load_file(location, decode=True))
+
+    def save(self, workload_location):
+        location = workload_location + "/" + self.filename
+        logger.info(f"Saving extraction manifest to {location}")
+        if location.startswith("s3://"):
+            bucket_name, _, key = location[5:].partition("/")
+            client("s3").put_object(Body=self.to_json(), Bucket=bucket_name, Key=key)
+        else:
+            with open(location, "w") as manifest_file:
+                manifest_file.write(self.to_json())
+
+
 def get_cluster_log_location(source_cluster_endpoint):
     """ Get the audit log location for the cluster via the API """
     logger.debug(f"Retrieving log location for {source_cluster_endpoint}")
@@ -709,7 +1861,77 @@ def get_cluster_log_location(source_cluster_endpoint):
     return location
 
 
-def get_logs(log_location, start_time, end_time):
+class WorkloadSampler:
+    """ Decides which sessions and transactions of the workload are extracted, as the audit logs
+        are parsed, so the rest is never held in memory.
+
+        Sessions, identified by database, user and pid, are sampled separately for each user,
+        database and application name: within each of these, every 1/connection_fraction-th
+        session is kept, starting from an offset drawn from the seed. Of the transactions of the
+        sessions kept, every transaction_interval-th is kept. Connection logs are parsed before
+        the user activity logs, so the application name of a session is known by the time its
+        first query is. """
+
+    def __init__(self, connection_fraction=None, transaction_interval=None, seed=0):
+        self.connection_fraction = connection_fraction
+        self.transaction_interval = transaction_interval
+        self.seed = seed
+        self.application_names = {}
+        self.sessions = {}
+        self.sessions_by_stratum = collections.Counter()
+        self.transactions = {}
+
+    @classmethod
+    def from_config(cls, config):
+        """ The sampler for the sample_* settings of the config, or None to extract everything """
+        if not config.get("sample_connection_fraction") and not config.get("sample_every_nth_transaction"):
+            return None
+        return cls(config.get("sample_connection_fraction"), config.get("sample_every_nth_transaction"),
+                   config.get("sample_seed") or 0)
+
+    def add_connection_event(self, connection_event):
+        (event, event_time, database_name, username, pid, application_name) = connection_event
+        if event == "set application_name ":
+            self.application_names[(database_name, username, pid.strip())] = " ".join(application_name.split())
+
+    def keep_session(self, database_name, username, pid):
+        # the pid of connection logs is padded with spaces
+        session = (database_name, username, pid.strip())
+        if session not in self.sessions:
+            if not self.connection_fraction:
+                self.sessions[session] = True
+            else:
+                stratum = (username, database_name, self.application_names.get(session, ""))
+                # the same offset for a stratum in every extraction with this seed
+                offset = random.Random(f"{self.seed}:{stratum}").random()
+                idx = self.sessions_by_stratum[stratum]
+                self.sessions_by_stratum[stratum] += 1
+                self.sessions[session] = math.floor((idx + 1) * self.connection_fraction + offset) > \
+                    math.floor(idx * self.connection_fraction + offset)
+        return self.sessions[session]
+
+    def keep_query(self, query):
+        if not self.keep_session(query.database_name, query.username, query.pid):
+            return False
+        if query.xid not in self.transactions:
+            self.transactions[query.xid] = not self.transaction_interval or \
+                len(self.transactions) % self.transaction_interval == 0
+        return self.transactions[query.xid]
+
+    def sample_connections(self, connections):
+        """ The connections of the sessions kept """
+        sampled = {
+            key: connection for key, connection in connections.items()
+            if self.keep_session(connection.database_name, connection.username, connection.pid)
+        }
+        logger.info(
+            f"Sampled {sum(self.sessions.values())} of {len(self.sessions)} sessions and "
+            f"{sum(self.transactions.values())} of {len(self.transactions)} transactions"
+        )
+        return sampled
+
+
+def get_logs(log_location, start_time, end_time, num_workers=None, manifest=None, sampler=None):
     logger.info(f"Extracting and parsing logs from {log_location}")
     logger.info(f"Time range: {start_time or '*'} to {end_time or '*'}")
     logger.info(f"This may take several minutes...")
@@ -718,50 +1940,44 @@ def get_logs(log_location, start_time, end_time):
         if not(match):
             logger.error(f"Failed to parse log location {log_location}")
             return None
-        return get_s3_logs(match.group(1), match.group(2), start_time, end_time)
+        parsed_logs = get_s3_logs(
+            match.group(1), match.group(2), start_time, end_time, num_workers, manifest, sampler
+        )
     else:
-        return get_local_logs(log_location, start_time, end_time)
+        parsed_logs = get_local_logs(log_location, start_time, end_time, num_workers, manifest, sampler)
+    if manifest:
+        manifest.update(*parsed_logs, end_time)
+    return parsed_logs
 
 
-def get_local_logs(log_directory_path, start_time, end_time):
-    connections = {}
-    last_connections = {}
-    logs = {}
-    databases = set()
+def get_local_logs(log_directory_path, start_time, end_time, num_workers=None, manifest=None, sampler=None):
+    if manifest:
+        (connections, logs, databases, last_connections) = manifest.parser_state(end_time)
+    else:
+        connections = {}
+        last_connections = SessionIndex()
+        logs = {}
+        databases = set()
 
     unsorted_list = os.listdir(log_directory_path)
     log_directory = sorted(unsorted_list)
 
-    for filename in tqdm(log_directory, disable=g_disable_progress_bar, unit='files', desc='Files processed', bar_format=g_bar_format):
-        if g_disable_progress_bar:
-            logger.info(f"Processing {filename}")
-        if "start_node" in filename:
-            log_file = gzip.open(
-                log_directory_path + "/" + filename, "rt", encoding="ISO-8859-1"
-            )
-        else:
-            log_file = gzip.open(log_directory_path + "/" + filename, "r")
-        parse_log(
-            log_file, filename, connections, last_connections, logs, databases, start_time, end_time,
-        )
-        log_file.close()
+    parse_log_files(
+        [log_directory_path + "/" + filename for filename in log_directory],
+        connections, last_connections, logs, databases, start_time, end_time, num_workers,
+        manifest=manifest, sampler=sampler,
+    )
 
     return (connections, logs, databases, last_connections)
 
 
-def get_s3_logs(log_bucket, log_prefix, start_time, end_time):
-    connections = {}
-    logs = {}
-    last_connections = {}
-    databases = set()
-
-    conn = client("s3")
-
+def list_s3_objects(conn, log_bucket, log_prefix):
+    """ List all the objects under a prefix """
     # get first set of
     response = conn.list_objects_v2(Bucket=log_bucket,
                                     Prefix=log_prefix
     )
-    bucket_objects = response["Contents"]
+    bucket_objects = response.get("Contents", [])
 
     if "NextContinuationToken" in response:
         prev_key = response["NextContinuationToken"]
@@ -770,11 +1986,92 @@ def get_s3_logs(log_bucket, log_prefix, start_time, end_time):
                                             Prefix=log_prefix,
                                             ContinuationToken=prev_key
             )
-            bucket_objects.extend(response["Contents"])
+            bucket_objects.extend(response.get("Contents", []))
             if "NextContinuationToken" not in response:
                 break
             prev_key = response["NextContinuationToken"]
 
+    return bucket_objects
+
+
+def list_s3_common_prefixes(conn, log_bucket, log_prefix):
+    """ List the "directories" directly under a prefix """
+    paginator = conn.get_paginator("list_objects_v2")
+    common_prefixes = []
+    for page in paginator.paginate(Bucket=log_bucket, Prefix=log_prefix, Delimiter="/"):
+        common_prefixes.extend(_["Prefix"] for _ in page.get("CommonPrefixes", []))
+    return common_prefixes
+
+
+def get_s3_log_region_prefixes(conn, log_bucket, log_prefix):
+    """ Find the AWSLogs/<account>/redshift/<region>/ prefixes Redshift writes audit logs under.
+        log_prefix may be the S3 key prefix of the cluster's logging configuration, or already
+        point somewhere inside this layout. Returns None if the layout isn't recognized. """
+    if "AWSLogs/" in log_prefix:
+        base, _, rest = log_prefix.partition("AWSLogs/")
+        base += "AWSLogs/"
+        given_levels = [_ for _ in rest.split("/") if _]
+    else:
+        base = log_prefix if not log_prefix or log_prefix.endswith("/") else log_prefix + "/"
+        base += "AWSLogs/"
+        given_levels = []
+
+    # the levels below AWSLogs/ are <account>/redshift/<region>/
+    if len(given_levels) > 3 or (len(given_levels) > 1 and given_levels[1] != "redshift"):
+        return None
+    prefixes = [base + "".join(level + "/" for level in given_levels)]
+    for level in range(len(given_levels), 3):
+        if level == 1:
+            prefixes = [prefix + "redshift/" for prefix in prefixes]
+        else:
+            prefixes = [_ for prefix in prefixes for _ in list_s3_common_prefixes(conn, log_bucket, prefix)]
+
+    return prefixes or None
+
+
+def list_s3_log_objects(conn, log_bucket, log_prefix, start_time, end_time):
+    """ List the audit log objects for the extraction window. Redshift writes audit logs under
+        AWSLogs/<account>/redshift/<region>/YYYY/MM/DD/, so only the days intersecting the window
+        (and a day either side, for the files padding the window) are listed, in parallel. If
+        the window is open-ended or the layout isn't recognized, everything under log_prefix is
+        listed. """
+    region_prefixes = None
+    if start_time and end_time:
+        region_prefixes = get_s3_log_region_prefixes(conn, log_bucket, log_prefix)
+    if not region_prefixes:
+        logger.debug(f"Listing all objects under s3://{log_bucket}/{log_prefix}")
+        return list_s3_objects(conn, log_bucket, log_prefix)
+
+    days = []
+    day = (start_time - datetime.timedelta(days=1)).date()
+    while day <= (end_time + datetime.timedelta(days=1)).date():
+        days.append(day)
+        day += datetime.timedelta(days=1)
+
+    day_prefixes = [f"{prefix}{day.strftime('%Y/%m/%d')}/" for prefix in region_prefixes for day in days]
+    logger.debug(f"Listing {len(day_prefixes)} daily prefixes under s3://{log_bucket}/{log_prefix}")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(day_prefixes), 16)) as executor:
+        listings = executor.map(lambda prefix: list_s3_objects(conn, log_bucket, prefix), day_prefixes)
+        bucket_objects = [log for listing in listings for log in listing]
+
+    # same order as listing the whole prefix
+    bucket_objects.sort(key=lambda log: log["Key"])
+    return bucket_objects
+
+
+def get_s3_logs(log_bucket, log_prefix, start_time, end_time, num_workers=None, manifest=None, sampler=None):
+    if manifest:
+        (connections, logs, databases, last_connections) = manifest.parser_state(end_time)
+    else:
+        connections = {}
+        logs = {}
+        last_connections = SessionIndex()
+        databases = set()
+
+    with g_stages.measure("s3_listing") as stage:
+        bucket_objects = list_s3_log_objects(client("s3"), log_bucket, log_prefix, start_time, end_time)
+        stage["records"] = len(bucket_objects)
+
     s3_connection_logs = []
     s3_user_activity_logs = []
 
@@ -796,6 +2093,9 @@ def get_s3_logs(log_bucket, log_prefix, start_time, end_time):
         logs,
         databases,
         last_connections,
+        num_workers,
+        manifest,
+        sampler,
     )
     logger.info("Parsing user activity logs")
     get_s3_audit_logs(
@@ -808,35 +2108,36 @@ def get_s3_logs(log_bucket, log_prefix, start_time, end_time):
         logs,
         databases,
         last_connections,
+        num_workers,
+        manifest,
+        sampler,
     )
     return (connections, logs, databases, last_connections)
 
 
 def get_logs_in_range(audit_objects, start_time, end_time):
-    start_idx = None
-    end_idx = None
-    filenames = []
-    for index, log in list(enumerate(audit_objects)):
-        filename = log["Key"].split("/")[-1]
-        file_datetime = dateutil.parser.parse(filename.split("_")[-1][:-3]).replace(
-            tzinfo=datetime.timezone.utc
-        )
-        if start_time and file_datetime < start_time:
-            continue
+    """ Return the keys of the audit logs in the extraction window, in timestamp order, with the
+        files just before the start and just after the end to make sure we capture everything.
+        Files sharing the timestamp of one of these padding files are all included. """
+    if not audit_objects:
+        return []
 
-        if end_time and file_datetime > end_time:
-            # make sure we've started
-            if len(filenames) > 0:
-                filenames.append(log["Key"])
-            break
+    # sort by the timestamp in the filename, then key, since the listing may be out of order
+    timed_keys = sorted((parse_log_filename_time(log["Key"].split("/")[-1]), log["Key"]) for log in audit_objects)
+    times = [file_datetime for file_datetime, _ in timed_keys]
 
-        # start with one before the first file to make sure we capture everything
-        if len(filenames) == 0 and index > 0:
-            filenames.append(audit_objects[index - 1]["Key"])
+    start_idx = bisect.bisect_left(times, start_time) if start_time else 0
+    end_idx = bisect.bisect_right(times, end_time) if end_time else len(times)
+    if start_idx >= end_idx:
+        return []
 
-        filenames.append(log["Key"])
+    # start with the file(s) before the first file in range, and end with the one(s) after
+    if start_idx > 0:
+        start_idx = bisect.bisect_left(times, times[start_idx - 1])
+    if end_idx < len(times):
+        end_idx = bisect.bisect_right(times, times[end_idx])
 
-    return filenames
+    return [key for _, key in timed_keys[start_idx:end_idx]]
 
 
 def get_s3_audit_logs(
@@ -849,37 +2150,29 @@ def get_s3_audit_logs(
     logs,
     databases,
     last_connections,
+    num_workers=None,
+    manifest=None,
+    sampler=None,
 ):
-    s3 = boto3.resource("s3")
-
     index_of_last_valid_log = len(audit_objects) - 1
 
     log_filenames = get_logs_in_range(audit_objects, start_time, end_time)
 
     logger.info(f"Processing {len(log_filenames)} files")
 
-    is_continue_parsing = True
     curr_index = index_of_last_valid_log
 
-    last = curr_index
-    for filename in tqdm(log_filenames, disable=g_disable_progress_bar, unit='files', desc='Files processed', bar_format=g_bar_format):
-          file_datetime = dateutil.parser.parse(filename.split("_")[-1][:-3]).replace(
-              tzinfo=datetime.timezone.utc
-          )
-
-          curr_connection_length = len(connections)
-          curr_logs_length = len(logs)
-
-          log_object = s3.Object(log_bucket, filename)
-          log_file = gzip.GzipFile(fileobj=log_object.get()["Body"])
-
-          parse_log(
-              log_file, filename, connections, last_connections, logs, databases, start_time, end_time,
-          )
-
-    logger.debug(
-        f'First audit log in start_time range: {audit_objects[curr_index]["Key"].split("/")[-1]}'
+    log_sizes = {f"s3://{log_bucket}/{log['Key']}": log.get("Size", 0) for log in audit_objects}
+    parse_log_files(
+        [f"s3://{log_bucket}/{filename}" for filename in log_filenames],
+        connections, last_connections, logs, databases, start_time, end_time, num_workers, log_sizes,
+        manifest, sampler,
     )
+
+    if audit_objects:
+        logger.debug(
+            f'First audit log in start_time range: {audit_objects[curr_index]["Key"].split("/")[-1]}'
+        )
     return (connections, logs, databases, last_connections)
 
 
@@ -1013,6 +2306,64 @@ def validate_config_file(config_file):
                 'Config file "end_time" value not formatted as ISO 8601. Please format "end_time" as ISO 8601 or remove its value.'
             )
             exit(-1)
+    if config_file.get("workload_format") not in (None, "", "ndjson", "json", "ndjson_texts"):
+        logger.error(
+            'Config file value for "workload_format" is not valid. Please use "ndjson", "json" or "ndjson_texts".'
+        )
+        exit(-1)
+    workload_compression_level = config_file.get("workload_compression_level")
+    if workload_compression_level and not (
+        isinstance(workload_compression_level, int) and 1 <= workload_compression_level <= 9
+    ):
+        logger.error(
+            'Config file value for "workload_compression_level" is not valid. Please use a whole number from 1 (fastest) to 9 (smallest).'
+        )
+        exit(-1)
+    workload_compression_threads = config_file.get("workload_compression_threads")
+    if workload_compression_threads and not (
+        isinstance(workload_compression_threads, int) and workload_compression_threads >= 1
+    ):
+        logger.error(
+            'Config file value for "workload_compression_threads" is not valid. Please use a whole number, e.g. 4.'
+        )
+        exit(-1)
+    workload_shard_minutes = config_file.get("workload_shard_minutes")
+    if workload_shard_minutes and not (isinstance(workload_shard_minutes, int) and workload_shard_minutes >= 1):
+        logger.error(
+            'Config file value for "workload_shard_minutes" is not valid. Please use a whole number of minutes, e.g. 15.'
+        )
+        exit(-1)
+    if workload_shard_minutes and (config_file.get("workload_format") == "json" or config_file.get("incremental")):
+        logger.error(
+            'Config file value for "workload_shard_minutes" is not supported with "workload_format" "json" or "incremental". Please remove the value of "workload_shard_minutes".'
+        )
+        exit(-1)
+    sample_connection_fraction = config_file.get("sample_connection_fraction")
+    if sample_connection_fraction and not (
+        isinstance(sample_connection_fraction, (int, float)) and 0 < sample_connection_fraction <= 1
+    ):
+        logger.error(
+            'Config file value for "sample_connection_fraction" is not valid. Please use a number between 0 and 1, e.g. 0.1 to keep 10% of the sessions.'
+        )
+        exit(-1)
+    sample_every_nth_transaction = config_file.get("sample_every_nth_transaction")
+    if sample_every_nth_transaction and not (
+        isinstance(sample_every_nth_transaction, int) and sample_every_nth_transaction >= 1
+    ):
+        logger.error(
+            'Config file value for "sample_every_nth_transaction" is not valid. Please use a whole number, e.g. 10 to keep every 10th transaction.'
+        )
+        exit(-1)
+    if config_file.get("incremental") and (sample_connection_fraction or sample_every_nth_transaction):
+        logger.error(
+            'Sampling is not supported with "incremental", since the sessions sampled by one extraction are not known to the next. Please remove the sample_* values or set "incremental" to false.'
+        )
+        exit(-1)
+    if config_file.get("incremental") and not config_file["end_time"]:
+        logger.error(
+            'Config file missing value for "end_time". Incremental extractions continue from the "end_time" of the previous one, so please provide a value for "end_time".'
+        )
+        exit(-1)
     if not config_file["workload_location"]:
         logger.error(
             'Config file missing value for "workload_location". Please provide a value for "workload_location".'
@@ -1099,6 +2450,9 @@ def main():
     level = logging.getLevelName(g_config.get('log_level', 'INFO').upper())
     set_log_level(level)
 
+    extraction_start_wall_time = time.perf_counter()
+    extraction_start_cpu_time = time.process_time()
+
     if g_config.get("logfile_level") != "none":
         level = logging.getLevelName(g_config.get('logfile_level', 'DEBUG').upper())
         log_file = 'extract.log'
@@ -1144,14 +2498,39 @@ def main():
         logger.error("Either log_location or source_cluster_endpoint must be specified.")
         exit(-1)
 
-    (connections, audit_logs, databases, last_connections) = get_logs(log_location, start_time, end_time)
+    output_directory = g_config["workload_location"] + "/" + extraction_name
+    manifest = None
+    resumed = False
+    if g_config.get("incremental"):
+        # each extraction adds to the same workload
+        output_directory = g_config["workload_location"]
+        manifest = ExtractionManifest.load(output_directory)
+        if manifest:
+            resumed = True
+            if end_time <= manifest.end_time:
+                logger.info(f"The workload in {output_directory} is already extracted up to {manifest.end_time.isoformat()}")
+                return
+            # continue just after the previous extraction, whose end is inclusive
+            if not start_time or start_time <= manifest.end_time:
+                start_time = manifest.end_time + datetime.timedelta(microseconds=1)
+                logger.info(f"Continuing the workload in {output_directory} from {start_time.isoformat()}")
+        else:
+            manifest = ExtractionManifest()
+
+    sampler = WorkloadSampler.from_config(g_config)
+    (connections, audit_logs, databases, last_connections) = get_logs(
+        log_location, start_time, end_time, g_config.get("num_workers"), manifest, sampler
+    )
 
     logger.debug(f"Found {len(connections)} connection logs, {len(audit_logs)} audit logs")
 
-    if(len(audit_logs) == 0 or len(connections) == 0):
+    if not resumed and (len(audit_logs) == 0 or len(connections) == 0):
         logger.warning("No audit logs or connections logs found. Please verify that the audit log location or cluster endpoint is correct. Note, audit logs can take several hours to start appearing in S3 after logging is first enabled.")
         exit(-1)
 
+    if sampler:
+        connections = sampler.sample_connections(connections)
+
     if g_config["source_cluster_endpoint"]:
         logger.info(f'Retrieving info from {g_config["source_cluster_endpoint"]}')
         source_cluster_urls = get_connection_string(
@@ -1160,11 +2539,15 @@ def main():
             g_config["odbc_driver"],
         )
 
-        source_cluster_statement_text_logs = retrieve_source_cluster_statement_text(
-            source_cluster_urls, databases, start_time, end_time, interface,
-        )
+        with g_stages.measure("statement_text") as stage:
+            source_cluster_statement_text_logs = retrieve_source_cluster_statement_text(
+                source_cluster_urls, databases, start_time, end_time, interface,
+            )
+            stage["records"] = sum(len(texts) for _ in source_cluster_statement_text_logs.values()
+                                   for texts in _.values())
 
-        combine_logs(audit_logs, source_cluster_statement_text_logs)
+        with g_stages.measure("combine_logs", records=sum(len(_) for _ in audit_logs.values())):
+            combine_logs(audit_logs, source_cluster_statement_text_logs)
 
         if (
             g_config["source_cluster_system_table_unload_location"]
@@ -1187,14 +2570,25 @@ def main():
                 f'Exported system tables to {g_config["source_cluster_system_table_unload_location"]}'
             )
 
-    save_logs(
-        audit_logs,
-        last_connections,
-        g_config["workload_location"] + "/" + extraction_name,
-        connections,
-        start_time,
-        end_time
-    )
+    with g_stages.measure("save_logs", records=sum(len(_) for _ in audit_logs.values())):
+        save_logs(
+            audit_logs,
+            last_connections,
+            output_directory,
+            connections,
+            start_time,
+            end_time,
+            append=resumed,
+            workload_format=g_config.get("workload_format") or "ndjson",
+            shard_minutes=g_config.get("workload_shard_minutes"),
+        )
+    if manifest:
+        manifest.save(output_directory)
+
+    g_stages.add("total", time.perf_counter() - extraction_start_wall_time,
+                 time.process_time() - extraction_start_cpu_time)
+    g_stages.log()
+    g_stages.save(output_directory)
 
 
 if __name__ == "__main__":
@@ -1,8 +1,12 @@
 import argparse
+import asyncio
+import bisect
+import concurrent.futures
 import copy
 import csv
 import datetime
 import hashlib
+import heapq
 import json
 import logging
 import multiprocessing
@@ -24,11 +28,10 @@ from collections import OrderedDict
 from contextlib import contextmanager
 from multiprocessing.managers import SyncManager
 from pathlib import Path
-from queue import Empty, Full
 from urllib.parse import urlparse
 
 from util import init_logging, set_log_level, prepend_ids_to_logs, add_logfile, log_version, db_connect, cluster_dict, \
-    load_config, load_file, retrieve_compressed_json, get_secret
+    load_config, load_file, retrieve_compressed_json_members, retrieve_compressed_ndjson, file_exists, get_secret
 from replay_analysis import run_replay_analysis
 
 import redshift_connector
@@ -47,6 +50,9 @@ g_exit = False
 
 g_copy_replacements_filename = 'copy_replacements.csv'
 
+# shards of a sharded workload kept loaded by each worker process
+g_cached_workload_shards = 3
+
 g_config = {}
 
 g_replay_timestamp = None
@@ -79,6 +85,14 @@ class ConnectionLog:
         self.time_interval_between_queries = time_interval_between_queries
         self.connection_key = connection_key
         self.transactions = []
+        # with a sharded workload, the shards the transactions are in, which start before
+        # transactions_until, and how many transactions and queries they are over which time
+        self.shards = []
+        self.transactions_until = None
+        self.transaction_count = 0
+        self.query_count = 0
+        self.first_start_time = None
+        self.last_end_time = None
 
     def __str__(self):
         return (
@@ -167,7 +181,347 @@ class Query:
         return (self.start_time - ref_time).total_seconds() * 1000.0
 
 
-class ConnectionThread(threading.Thread):
+class ShardedWorkload:
+    """ A workload extracted with workload_shard_minutes, whose transactions are loaded a shard at
+        a time as the connections get to them rather than before the replay starts. Each worker
+        process keeps the last few shards it loaded, which the connections it replays share. """
+
+    index_filename = "SQL_shards.json"
+
+    def __init__(self, workload_directory, shards, texts=None):
+        self.workload_directory = workload_directory.rstrip("/")
+        self.shards = shards
+        self.texts = texts or {}
+        # copy replacements and replay id for prepare_transactions, set once they're known
+        self.replacements = {}
+        self.replay_id = None
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # workers load their own shards
+        state = self.__dict__.copy()
+        state["cache"] = OrderedDict()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, workload_directory, texts=True):
+        """ The sharded workload in workload_directory, or None if it isn't sharded. Without texts,
+            the query texts of a workload_format "ndjson_texts" workload aren't loaded """
+        index_path = workload_directory.rstrip("/") + "/" + cls.index_filename
+        if not file_exists(index_path):
+            return None
+        shards = json.loads(load_file(index_path, decode=True))["shards"]
+        for shard in shards:
+            for key in ("start_time", "end_time", "first_start_time", "last_end_time"):
+                shard[key] = dateutil.parser.isoparse(shard[key])
+        return cls(workload_directory, shards, retrieve_workload_texts(workload_directory) if texts else None)
+
+    def transaction_dicts(self, shard_idx):
+        for filename in self.shards[shard_idx]["files"]:
+            yield from retrieve_compressed_ndjson(self.workload_directory + "/" + filename)
+
+    def shard_transactions(self, shard_idx):
+        """ The transactions of a shard that match the filters, by connection key, in the order
+            they start. The first connection to get to a shard loads it, the others wait for it
+            while the connections of other shards go on """
+        with self.lock:
+            loading = self.cache.get(shard_idx)
+            load = loading is None
+            if load:
+                loading = self.cache[shard_idx] = concurrent.futures.Future()
+                if len(self.cache) > g_cached_workload_shards:
+                    self.cache.popitem(last=False)
+            else:
+                self.cache.move_to_end(shard_idx)
+
+        if load:
+            try:
+                loading.set_result(self.load_shard(shard_idx))
+            except Exception as e:
+                loading.set_exception(e)
+                # the next connection to get to the shard tries again
+                with self.lock:
+                    if self.cache.get(shard_idx) is loading:
+                        del self.cache[shard_idx]
+        return loading.result()
+
+    def load_shard(self, shard_idx):
+        transactions = {}
+        for transaction_dict in self.transaction_dicts(shard_idx):
+            transaction = parse_transaction(transaction_dict, self.texts, g_config['filters'])
+            if transaction is not None and transaction.start_time():
+                transactions.setdefault(transaction.transaction_key, []).append(transaction)
+        for connection_transactions in transactions.values():
+            connection_transactions.sort(key=lambda transaction: (transaction.start_time(), transaction.xid))
+        return transactions
+
+    def connection_transactions(self, shard_idx, connection_log):
+        """ The transactions of a shard that belong to the connection """
+        transactions = self.shard_transactions(shard_idx).get(connection_log.connection_key, [])
+        return [
+            transaction for transaction in transactions
+            if connection_start_time(connection_log) <= transaction.start_time()
+            and (connection_log.transactions_until is None or transaction.start_time() < connection_log.transactions_until)
+        ]
+
+    def assign_shards(self, connection_logs, filters=None):
+        """ Set the shards each connection has transactions in, from the transactions of each
+            connection key listed in the index. A transaction belongs to the last connection of its
+            database, user and pid that started before it, as in assign_transactions, so sessions
+            of a reused pid only get the shards of their own transactions. Returns the number of
+            transactions that match the filters and the number of queries assigned, as
+            parse_transactions and assign_transactions do """
+        transactions_by_key = {}
+        transaction_count = 0
+        for idx, shard in enumerate(self.shards):
+            # the workers don't need the transactions of the index
+            for connection in shard.pop("connections"):
+                key_transaction = Transaction(None, connection["db"], connection["user"], connection["pid"], None, [],
+                                              None)
+                if filters is not None and not matches_filters(key_transaction, filters):
+                    continue
+                transactions = transactions_by_key.setdefault(
+                    get_connection_key(connection["db"], connection["user"], connection["pid"]), []
+                )
+                for start_time, end_time, queries in connection["transactions"]:
+                    transactions.append((dateutil.parser.isoparse(start_time), dateutil.parser.isoparse(end_time),
+                                         queries, idx))
+                transaction_count += len(connection["transactions"])
+
+        connection_logs_by_key = {}
+        for connection_log in connection_logs:
+            connection_logs_by_key.setdefault(connection_log.connection_key, []).append(connection_log)
+
+        query_count = 0
+        for connection_key, transactions in transactions_by_key.items():
+            key_connection_logs = connection_logs_by_key.get(connection_key, [])
+            start_times = [connection_start_time(connection_log) for connection_log in key_connection_logs]
+            skipped = 0
+            for start_time, end_time, queries, shard_idx in sorted(transactions):
+                idx = bisect.bisect_right(start_times, start_time)
+                if idx == 0:
+                    skipped += 1
+                    continue
+                connection_log = key_connection_logs[idx - 1]
+                if not connection_log.shards or connection_log.shards[-1] != shard_idx:
+                    connection_log.shards.append(shard_idx)
+                connection_log.transaction_count += 1
+                connection_log.query_count += queries
+                if connection_log.first_start_time is None:
+                    connection_log.first_start_time = start_time
+                connection_log.last_end_time = max(connection_log.last_end_time or end_time, end_time)
+                query_count += queries
+            if skipped:
+                logger.warning(
+                    f"Couldn't find matching connection in {len(start_times)} connections for {skipped} transactions "
+                    f"of {connection_key}, skipping")
+
+        for key_connection_logs in connection_logs_by_key.values():
+            for connection_log, next_connection_log in zip(key_connection_logs, key_connection_logs[1:]):
+                connection_log.transactions_until = connection_start_time(next_connection_log)
+            for connection_log in key_connection_logs:
+                connection_log.shards.sort()
+        return transaction_count, query_count
+
+
+def connection_start_time(connection_log):
+    """ The time from which transactions belong to a connection. The session start is truncated,
+        since query and transaction times are truncated to seconds """
+    if not connection_log.session_initiation_time:
+        return datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+    return connection_log.session_initiation_time.replace(microsecond=0)
+
+
+def assign_transactions(connection_logs, transactions):
+    """ Add each transaction to the transactions of its connection, the last connection of its
+        database, user and pid that started before it, found by bisecting the start times of the
+        connections of its key. This relies on connection_logs being sorted by their start, and
+        keeps the order of the transactions. Returns the number of queries assigned """
+    connection_logs_by_key = {}
+    start_times_by_key = {}
+    for connection_log in connection_logs:
+        connection_logs_by_key.setdefault(connection_log.connection_key, []).append(connection_log)
+        start_times_by_key.setdefault(connection_log.connection_key, []).append(connection_start_time(connection_log))
+
+    query_count = 0
+    for transaction in transactions:
+        start_times = start_times_by_key.get(transaction.transaction_key, [])
+        idx = bisect.bisect_right(start_times, transaction.start_time())
+        if idx == 0:
+            logger.warning(
+                f"Couldn't find matching connection in {len(start_times)} connections for transaction {transaction}, skipping")
+            continue
+        connection_logs_by_key[transaction.transaction_key][idx - 1].transactions.append(transaction)
+        query_count += len(transaction.queries)
+    return query_count
+
+
+class ReplayScheduler:
+    """ The clock of the replay of a worker. Connections, transactions, queries and disconnections
+        wait for their time with wait, or wait_async in an event loop, which put them on a heap of
+        due events. A timer thread wakes each as it falls due, and how late it resumes is recorded
+        in a histogram per kind of event. Times are taken from the monotonic clock, which is set
+        against the replay start once """
+
+    # upper bounds of the buckets of the lag histograms, the last bucket has the events beyond
+    lag_buckets_ms = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+    # query_interval is the time kept between the queries of a transaction, which is a delay from
+    # the end of the previous query, where the others are times of the workload
+    kinds = ("connect", "transaction", "query", "query_interval", "disconnect")
+
+    def __init__(self, replay_start):
+        elapsed_sec = (datetime.datetime.now(tz=datetime.timezone.utc) - replay_start).total_seconds()
+        self.start = time.monotonic() - elapsed_sec
+        self.events = []
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.closed = False
+        self.lag_histogram = {}
+        self.timer = threading.Thread(target=self.run, name="scheduler", daemon=True)
+        self.timer.start()
+
+    def elapsed_sec(self):
+        """ Time since the replay started """
+        return time.monotonic() - self.start
+
+    def due_at(self, offset_sec):
+        """ The time of the clock offset_sec after the replay started """
+        return self.start + offset_sec
+
+    def due_in(self, delay_sec):
+        return time.monotonic() + delay_sec
+
+    @staticmethod
+    def until(due):
+        return due - time.monotonic()
+
+    def schedule(self, due, wake):
+        """ Call wake from the timer thread once due, or right away once the scheduler is closed """
+        with self.condition:
+            if self.closed:
+                wake()
+                return
+            heapq.heappush(self.events, (due, self.sequence, wake))
+            self.sequence += 1
+            if self.events[0][0] == due:
+                self.condition.notify()
+
+    def run(self):
+        with self.condition:
+            while not self.closed:
+                if not self.events:
+                    self.condition.wait()
+                    continue
+                delay_sec = self.events[0][0] - time.monotonic()
+                if delay_sec > 0:
+                    self.condition.wait(delay_sec)
+                    continue
+                heapq.heappop(self.events)[2]()
+
+    def close(self):
+        """ Stop the timer, waking the events still waiting """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+            while self.events:
+                heapq.heappop(self.events)[2]()
+        self.timer.join()
+
+    def wait(self, kind, due):
+        """ Block the calling thread until due """
+        if due > time.monotonic():
+            event = threading.Event()
+            self.schedule(due, event.set)
+            event.wait()
+        self.record(kind, due)
+
+    async def wait_async(self, kind, due):
+        """ Wait in the running event loop until due """
+        if due > time.monotonic():
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+
+            def set_result():
+                if not future.done():
+                    future.set_result(None)
+
+            def wake():
+                # the loop may have been closed since, with the task
+                if not loop.is_closed():
+                    loop.call_soon_threadsafe(set_result)
+
+            self.schedule(due, wake)
+            await future
+        self.record(kind, due)
+
+    def record(self, kind, due):
+        lag_ms = (time.monotonic() - due) * 1000.0
+        with self.condition:
+            histogram = self.lag_histogram.setdefault(
+                kind, {"counts": [0] * (len(self.lag_buckets_ms) + 1), "events": 0, "total_ms": 0.0, "max_ms": 0.0}
+            )
+            histogram["counts"][bisect.bisect_left(self.lag_buckets_ms, lag_ms)] += 1
+            histogram["events"] += 1
+            histogram["total_ms"] += lag_ms
+            histogram["max_ms"] = max(histogram["max_ms"], lag_ms)
+
+
+def merge_lag_histograms(total, lag_histogram):
+    """ Add the counts of a lag histogram to total """
+    for kind, histogram in lag_histogram.items():
+        if kind not in total:
+            total[kind] = copy.deepcopy(histogram)
+            continue
+        total[kind]["counts"] = [a + b for a, b in zip(total[kind]["counts"], histogram["counts"])]
+        total[kind]["events"] += histogram["events"]
+        total[kind]["total_ms"] += histogram["total_ms"]
+        total[kind]["max_ms"] = max(total[kind]["max_ms"], histogram["max_ms"])
+
+
+def lag_percentile_ms(histogram, percentile):
+    """ The upper bound of the bucket of the lag histogram the percentile falls in, or None if it's
+        beyond the last bound """
+    events = 0
+    for bound, count in zip(ReplayScheduler.lag_buckets_ms + (None,), histogram["counts"]):
+        events += count
+        if events >= histogram["events"] * percentile / 100.0:
+            return bound
+    return None
+
+
+def report_lag_histogram(lag_histogram):
+    """ Log how late the events of the replay were, and save the histograms to lag_histogram.json
+        beside the query times """
+    for kind in ReplayScheduler.kinds:
+        histogram = lag_histogram.get(kind)
+        if not histogram or not histogram["events"]:
+            continue
+        percentiles = []
+        for percentile in (50, 99):
+            bound = lag_percentile_ms(histogram, percentile)
+            percentiles.append(f"p{percentile} <= {bound} ms" if bound is not None
+                               else f"p{percentile} > {ReplayScheduler.lag_buckets_ms[-1]} ms")
+        logger.info(f"Scheduling lag of {histogram['events']} {kind} events: "
+                    f"mean {histogram['total_ms'] / histogram['events']:.1f} ms, {', '.join(percentiles)}, "
+                    f"max {histogram['max_ms']:.1f} ms")
+
+    sr_dir = g_config.get("logging_dir", "simplereplay_logs") + '/' + g_replay_timestamp.isoformat()
+    Path(sr_dir).mkdir(parents=True, exist_ok=True)
+    with open(f"{sr_dir}/lag_histogram.json", "w") as fp:
+        json.dump({"buckets_ms": ReplayScheduler.lag_buckets_ms, "events": lag_histogram}, fp, indent=2)
+
+
+class ConnectionReplay:
+    """ The replay of a connection and its transactions at the times they were extracted, run on a
+        thread of its own by ConnectionThread, or as a task of the event loop of its worker by
+        ConnectionTask """
+
     def __init__(
         self,
         process_idx,
@@ -181,9 +535,10 @@ class ConnectionThread(threading.Thread):
         num_connections,
         peak_connections,
         connection_semaphore,
-        perf_lock
+        perf_lock,
+        workload=None,
+        scheduler=None,
     ):
-        threading.Thread.__init__(self)
         self.process_idx = process_idx
         self.job_id = job_id
         self.connection_log = connection_log
@@ -196,16 +551,16 @@ class ConnectionThread(threading.Thread):
         self.peak_connections = peak_connections
         self.connection_semaphore = connection_semaphore
         self.perf_lock = perf_lock
+        self.workload = workload
+        self.scheduler = scheduler
 
         prepend_ids_to_logs(self.process_idx, self.job_id + 1)
 
-    @contextmanager
-    def initiate_connection(self, username):
-        conn = None
-
-        # check if this connection is happening at the right time
+    def check_connection_time(self):
+        """ Save how far from its expected time the connection is made, and warn if it's beyond
+            connection_tolerance_sec """
         expected_elapsed_sec = (self.connection_log.session_initiation_time - self.first_event_time).total_seconds()
-        elapsed_sec = (datetime.datetime.now(tz=datetime.timezone.utc) - self.replay_start).total_seconds()
+        elapsed_sec = self.scheduler.elapsed_sec()
         connection_diff_sec = elapsed_sec - expected_elapsed_sec
         connection_duration_sec = (self.connection_log.disconnection_time -
                                    self.connection_log.session_initiation_time).total_seconds()
@@ -223,8 +578,7 @@ class ConnectionThread(threading.Thread):
             logger.warning("Connection at {} offset by {:+.3f} sec".format(self.connection_log.session_initiation_time,
                                                                            connection_diff_sec))
 
-        interface = self.default_interface
-
+    def connection_interface(self):
         if "psql" in self.connection_log.application_name.lower():
             interface = "psql"
         elif "odbc" in self.connection_log.application_name.lower() and self.odbc_driver is not None:
@@ -235,85 +589,114 @@ class ConnectionThread(threading.Thread):
             interface = "psql"
         else:
             interface = "psql"
+        return interface
 
-        credentials = get_connection_credentials(username, database=self.connection_log.database_name)
-
+    def connect(self, interface, credentials):
+        """ Connect to the database, or return None if it fails """
         try:
-            try:
-                conn = db_connect(interface,
-                                  host=credentials['host'],
-                                  port=int(credentials['port']),
-                                  username=credentials['username'],
-                                  password=credentials['password'],
-                                  database=credentials['database'],
-                                  odbc_driver=credentials['odbc_driver'],
-                                  drop_return=g_config.get('drop_return'))
-                logger.debug(f"Connected using {interface} for PID: {self.connection_log.pid}")
-                self.num_connections.value += 1
-            except Exception as err:
-                hashed_cluster_url = copy.deepcopy(credentials)
-                hashed_cluster_url["password"] = "***"
-                logger.error(
-                    f'({self.job_id + 1}) Failed to initiate connection for {self.connection_log.database_name}-'
-                    f'{self.connection_log.username}-{self.connection_log.pid} ({hashed_cluster_url}): {err}')
-                self.thread_stats['connection_error_log'][
-                    f"{self.connection_log.database_name}-{self.connection_log.username}-{self.connection_log.pid}"] = f"{self.connection_log}\n\n{err}"
-            yield conn
-        except Exception as e:
-            logger.error(f"Exception in connect: {e}")
-        finally:
-            logger.debug(f"Context closing for pid: {self.connection_log.pid}")
-            if conn is not None:
-                conn.close()
-                logger.debug(f"Disconnected for PID: {self.connection_log.pid}")
-            self.num_connections.value -= 1
-            if self.connection_semaphore is not None:
-                logger.debug(f"Releasing semaphore ({self.num_connections.value} / "
-                             f"{g_config['limit_concurrent_connections']} active connections)")
-                self.connection_semaphore.release()
+            conn = db_connect(interface,
+                              host=credentials['host'],
+                              port=int(credentials['port']),
+                              username=credentials['username'],
+                              password=credentials['password'],
+                              database=credentials['database'],
+                              odbc_driver=credentials['odbc_driver'],
+                              drop_return=g_config.get('drop_return'))
+            logger.debug(f"Connected using {interface} for PID: {self.connection_log.pid}")
+            self.num_connections.value += 1
+            return conn
+        except Exception as err:
+            hashed_cluster_url = copy.deepcopy(credentials)
+            hashed_cluster_url["password"] = "***"
+            logger.error(
+                f'({self.job_id + 1}) Failed to initiate connection for {self.connection_log.database_name}-'
+                f'{self.connection_log.username}-{self.connection_log.pid} ({hashed_cluster_url}): {err}')
+            self.thread_stats['connection_error_log'][
+                f"{self.connection_log.database_name}-{self.connection_log.username}-{self.connection_log.pid}"] = f"{self.connection_log}\n\n{err}"
+            return None
+
+    def disconnect(self, conn):
+        logger.debug(f"Context closing for pid: {self.connection_log.pid}")
+        if conn is not None:
+            conn.close()
+            logger.debug(f"Disconnected for PID: {self.connection_log.pid}")
+        self.num_connections.value -= 1
+        if self.connection_semaphore is not None:
+            logger.debug(f"Releasing semaphore ({self.num_connections.value} / "
+                         f"{g_config['limit_concurrent_connections']} active connections)")
+            self.connection_semaphore.release()
+
+    def disconnect_due(self):
+        """ When the connection disconnected in the extracted workload, if the time between
+            transactions is preserved, otherwise None """
+        if self.connection_log.time_interval_between_transactions is not True:
+            return None
+        disconnect_offset_sec = (self.connection_log.disconnection_time - self.first_event_time).total_seconds()
+        due = self.scheduler.due_at(disconnect_offset_sec)
+        logger.debug(f"Waiting to disconnect {self.scheduler.until(due):.1f} sec (pid {self.connection_log.pid})")
+        return due
+
+    def transaction_due(self, transaction):
+        """ When the transaction started in the extracted workload, relative to the first event, if
+            the time between transactions is preserved, otherwise None. It's a deadline on the
+            clock of the scheduler rather than a delay from now, so the time the previous
+            transactions took doesn't push it back """
+        if self.connection_log.time_interval_between_transactions is not True:
+            return None
+        due = self.scheduler.due_at((transaction.start_time() - self.first_event_time).total_seconds())
+        if self.scheduler.until(due) > 0.01:
+            logger.debug(f"Waiting {self.scheduler.until(due):.1f} sec for transaction to start")
+        return due
+
+    def load_shard_transactions(self, shard_idx):
+        """ The transactions of the connection in a shard of a sharded workload, ready to replay """
+        self.connection_log.transactions = self.workload.connection_transactions(shard_idx, self.connection_log)
+        prepare_transactions([self.connection_log], self.workload.replacements, self.workload.replay_id)
+        return self.connection_log.transactions
+
+    def query_due(self, query):
+        due = self.scheduler.due_at(query.offset_ms(self.first_event_time) / 1000.0)
+        truncated_query = (query.text[:60] + '...' if len(query.text) > 60 else query.text).replace("\n", " ")
+        logger.debug(f"Executing [{truncated_query}] in {self.scheduler.until(due):.1f} sec")
+        return due
+
+    def split_statements(self, query):
+        if g_config.get("split_multi", True):
+            split_statements = sqlparse.split(query.text)
+            # exclude empty statements. Some customers' queries have been
+            # found to end in multiple ; characters;
+            split_statements = [_ for _ in split_statements if _ != ';']
+        else:
+            split_statements = [query.text]
 
-    def run(self):
-        try:
-            with self.initiate_connection(self.connection_log.username) as connection:
-                if connection:
-                    self.execute_transactions(connection)
-                    if self.connection_log.time_interval_between_transactions is True:
-                        disconnect_offset_sec = (self.connection_log.disconnection_time -
-                                                 self.first_event_time).total_seconds()
-                        if disconnect_offset_sec > current_offset_ms(self.replay_start):
-                            logger.debug(f"Waiting to disconnect {time_until_disconnect_sec} sec (pid "
-                                         f"{self.connection_log.pid})")
-                            time.sleep(time_until_disconnect_sec)
-                else:
-                    logger.warning("Failed to connect")
-        except Exception as e:
-            logger.error(f"Exception thrown for pid {self.connection_log.pid}: {e}")
+        if len(split_statements) > 1:
+            self.thread_stats['multi_statements'] += 1
+        self.thread_stats['executed_queries'] += len(split_statements)
+        return split_statements
 
-    def execute_transactions(self, connection):
-        if self.connection_log.time_interval_between_transactions is True:
-            for idx, transaction in enumerate(self.connection_log.transactions):
-                # we can use this if we want to run transactions based on their offset from the start of the replay
-                # time_until_start_ms = transaction.offset_ms(self.first_event_time) -
-                # current_offset_ms(self.replay_start)
+    @staticmethod
+    def is_replayed(sql_text):
+        """ COPY and UNLOAD statements are only replayed if execute_copy_statements and
+            execute_unload_statements are set """
+        if (g_config["execute_copy_statements"] == "true" and "from 's3:" in sql_text.lower()):
+            return True
+        elif (g_config["execute_unload_statements"] == "true" and "to 's3:" in sql_text.lower() and g_config["replay_output"] is not None):
+            return True
+        elif ("from 's3:" not in sql_text.lower()) and ("to 's3:" not in sql_text.lower()): ## removed condition to exclude bind variables
+            return True
+        return False
 
-                # or use this to preserve the time between transactions
-                if idx == 0:
-                    time_until_start_ms = (transaction.start_time() -
-                                           self.connection_log.session_initiation_time).total_seconds() * 1000.0
-                else:
-                    prev_transaction = self.connection_log.transactions[idx - 1]
-                    time_until_start_ms = (transaction.start_time() -
-                                           prev_transaction.end_time()).total_seconds() * 1000.0
-
-                # wait for the transaction to start
-                if time_until_start_ms > 10:
-                    logger.debug(f"Waiting {time_until_start_ms / 1000:.1f} sec for transaction to start")
-                    time.sleep(time_until_start_ms / 1000.0)
-                self.execute_transaction(transaction, connection)
-        else:
-            for transaction in self.connection_log.transactions:
-                self.execute_transaction(transaction, connection)
+    def log_statement(self, transaction, idx, substatement_txt, status, exec_start, exec_end):
+        exec_sec = (exec_end - exec_start).total_seconds()
+        logger.debug(
+            f"{status}Replayed DB={transaction.database_name}, USER={transaction.username}, PID={transaction.pid}, XID:{transaction.xid}, Query: {idx+1}/{len(transaction.queries)}{substatement_txt} ({exec_sec} sec)"
+        )
 
+    def log_statement_error(self, transaction, idx, substatement_txt, err):
+        logger.debug(
+            f"Failed DB={transaction.database_name}, USER={transaction.username}, PID={transaction.pid}, "
+            f"XID:{transaction.xid}, Query: {idx + 1}/{len(transaction.queries)}{substatement_txt}: {err}"
+        )
 
     def save_query_stats(self, starttime, endtime, xid, query_idx):
         with self.perf_lock:
@@ -336,30 +719,82 @@ class ConnectionThread(threading.Thread):
                      "replay_start": g_replay_timestamp.isoformat()}
         return "/* {} */ {}".format(json.dumps(json_tags), query_text)
 
+    def query_done(self, success):
+        if success:
+            self.thread_stats['query_success'] += 1
+        else:
+            self.thread_stats['query_error'] += 1
+
+    def transaction_done(self, transaction, errors):
+        if self.thread_stats['query_error'] == 0:
+            self.thread_stats['transaction_success'] += 1
+        else:
+            self.thread_stats['transaction_error'] += 1
+            self.thread_stats['transaction_error_log'][transaction.get_base_filename()] = errors
+
+
+class ConnectionThread(ConnectionReplay, threading.Thread):
+    def __init__(self, *args, **kwargs):
+        threading.Thread.__init__(self)
+        ConnectionReplay.__init__(self, *args, **kwargs)
+
+    @contextmanager
+    def initiate_connection(self, username):
+        conn = None
+
+        # check if this connection is happening at the right time
+        self.check_connection_time()
+        interface = self.connection_interface()
+        credentials = get_connection_credentials(username, database=self.connection_log.database_name)
+
+        try:
+            conn = self.connect(interface, credentials)
+            yield conn
+        except Exception as e:
+            logger.error(f"Exception in connect: {e}")
+        finally:
+            self.disconnect(conn)
+
+    def run(self):
+        try:
+            with self.initiate_connection(self.connection_log.username) as connection:
+                if connection:
+                    self.execute_transactions(connection)
+                    due = self.disconnect_due()
+                    if due is not None:
+                        self.scheduler.wait("disconnect", due)
+                else:
+                    logger.warning("Failed to connect")
+        except Exception as e:
+            logger.error(f"Exception thrown for pid {self.connection_log.pid}: {e}")
+
+    def transactions(self):
+        """ The transactions of the connection. With a sharded workload, they are loaded from each
+            shard the connection has transactions in as the previous ones are executed """
+        if self.workload is None:
+            yield from self.connection_log.transactions
+            return
+        for shard_idx in self.connection_log.shards:
+            yield from self.load_shard_transactions(shard_idx)
+        self.connection_log.transactions = []
+
+    def execute_transactions(self, connection):
+        for transaction in self.transactions():
+            # wait for the transaction to start
+            due = self.transaction_due(transaction)
+            if due is not None:
+                self.scheduler.wait("transaction", due)
+            self.execute_transaction(transaction, connection)
+
     def execute_transaction(self, transaction, connection):
         errors = []
         cursor = connection.cursor()
 
         transaction_query_idx = 0
         for idx, query in enumerate(transaction.queries):
-            time_until_start_ms = query.offset_ms(self.first_event_time) - current_offset_ms(self.replay_start)
-            truncated_query = (query.text[:60] + '...' if len(query.text) > 60 else query.text).replace("\n", " ")
-            logger.debug(f"Executing [{truncated_query}] in {time_until_start_ms/1000.0:.1f} sec")
-
-            if time_until_start_ms > 10:
-                time.sleep(time_until_start_ms / 1000.0)
-
-            if g_config.get("split_multi", True):
-                split_statements = sqlparse.split(query.text)
-                # exclude empty statements. Some customers' queries have been
-                # found to end in multiple ; characters;
-                split_statements = [_ for _ in split_statements if _ != ';']
-            else:
-                split_statements = [query.text]
+            self.scheduler.wait("query", self.query_due(query))
 
-            if len(split_statements) > 1:
-                self.thread_stats['multi_statements'] += 1
-            self.thread_stats['executed_queries'] += len(split_statements)
+            split_statements = self.split_statements(query)
 
             success = True
             for s_idx, sql_text in enumerate(split_statements):
@@ -374,47 +809,136 @@ class ConnectionThread(threading.Thread):
                 exec_end = None
                 try:
                     status = ''
-                    if (g_config["execute_copy_statements"] == "true" and "from 's3:" in sql_text.lower()):
-                        cursor.execute(sql_text)
-                    elif (g_config["execute_unload_statements"] == "true" and "to 's3:" in sql_text.lower() and g_config["replay_output"] is not None):
-                        cursor.execute(sql_text)
-                    elif ("from 's3:" not in sql_text.lower()) and ("to 's3:" not in sql_text.lower()): ## removed condition to exclude bind variables
+                    if self.is_replayed(sql_text):
                         cursor.execute(sql_text)
                     else:
                         status = 'Not '
                     exec_end = datetime.datetime.now(tz=datetime.timezone.utc)
-                    exec_sec = (exec_end - exec_start).total_seconds()
-
-                    logger.debug(
-                        f"{status}Replayed DB={transaction.database_name}, USER={transaction.username}, PID={transaction.pid}, XID:{transaction.xid}, Query: {idx+1}/{len(transaction.queries)}{substatement_txt} ({exec_sec} sec)"
-                    )
-                    success = success & True
+                    self.log_statement(transaction, idx, substatement_txt, status, exec_start, exec_end)
                 except Exception as err:
                     success = False
                     errors.append([sql_text, str(err)])
-                    logger.debug(
-                        f"Failed DB={transaction.database_name}, USER={transaction.username}, PID={transaction.pid}, "
-                        f"XID:{transaction.xid}, Query: {idx + 1}/{len(transaction.queries)}{substatement_txt}: {err}"
-                    )
+                    self.log_statement_error(transaction, idx, substatement_txt, err)
 
                 self.save_query_stats(exec_start, exec_end, transaction.xid, transaction_query_idx)
-            if success:
-                self.thread_stats['query_success'] += 1
-            else:
-                self.thread_stats['query_error'] += 1
+            self.query_done(success)
 
             if query.time_interval > 0.0:
                 logger.debug(f"Waiting {query.time_interval} sec between queries")
-                time.sleep(query.time_interval)
+                self.scheduler.wait("query_interval", self.scheduler.due_in(query.time_interval))
 
         cursor.close()
         connection.commit()
+        self.transaction_done(transaction, errors)
 
-        if self.thread_stats['query_error'] == 0:
-            self.thread_stats['transaction_success'] += 1
-        else:
-            self.thread_stats['transaction_error'] += 1
-            self.thread_stats['transaction_error_log'][transaction.get_base_filename()] = errors
+
+class ConnectionTask(ConnectionReplay):
+    """ A connection replayed as a task of the event loop of its worker, with the same timing as
+        ConnectionThread. It waits with wait_async of the scheduler, and the blocking calls to the
+        driver, the credentials and the workload are run on the executor of the worker """
+
+    def __init__(self, *args, executor=None, **kwargs):
+        ConnectionReplay.__init__(self, *args, **kwargs)
+        self.executor = executor
+
+    async def call(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def run(self):
+        conn = None
+        try:
+            # check if this connection is happening at the right time
+            self.check_connection_time()
+            interface = self.connection_interface()
+            credentials = await self.call(get_connection_credentials, self.connection_log.username,
+                                          self.connection_log.database_name)
+        except Exception as e:
+            logger.error(f"Exception thrown for pid {self.connection_log.pid}: {e}")
+            return
+
+        connecting = asyncio.ensure_future(self.call(self.connect, interface, credentials))
+        try:
+            # shielded, so a connection made as the task is cancelled is still closed
+            conn = await asyncio.shield(connecting)
+            if conn:
+                await self.execute_transactions(conn)
+                due = self.disconnect_due()
+                if due is not None:
+                    await self.scheduler.wait_async("disconnect", due)
+            else:
+                logger.warning("Failed to connect")
+        except Exception as e:
+            logger.error(f"Exception in connect: {e}")
+        finally:
+            try:
+                if conn is None:
+                    conn = await connecting
+                await self.call(self.disconnect, conn)
+            except Exception as e:
+                logger.error(f"Exception thrown for pid {self.connection_log.pid}: {e}")
+
+    async def transactions(self):
+        if self.workload is None:
+            for transaction in self.connection_log.transactions:
+                yield transaction
+            return
+        for shard_idx in self.connection_log.shards:
+            for transaction in await self.call(self.load_shard_transactions, shard_idx):
+                yield transaction
+        self.connection_log.transactions = []
+
+    async def execute_transactions(self, connection):
+        async for transaction in self.transactions():
+            # wait for the transaction to start
+            due = self.transaction_due(transaction)
+            if due is not None:
+                await self.scheduler.wait_async("transaction", due)
+            await self.execute_transaction(transaction, connection)
+
+    async def execute_transaction(self, transaction, connection):
+        errors = []
+        cursor = await self.call(connection.cursor)
+
+        transaction_query_idx = 0
+        for idx, query in enumerate(transaction.queries):
+            await self.scheduler.wait_async("query", self.query_due(query))
+
+            split_statements = self.split_statements(query)
+
+            success = True
+            for s_idx, sql_text in enumerate(split_statements):
+                sql_text = self.get_tagged_sql(sql_text, transaction_query_idx, transaction, connection)
+                transaction_query_idx += 1
+
+                substatement_txt = ""
+                if len(split_statements) > 1:
+                    substatement_txt = f", Multistatement: {s_idx+1}/{len(split_statements)}"
+
+                exec_start = datetime.datetime.now(tz=datetime.timezone.utc)
+                exec_end = None
+                try:
+                    status = ''
+                    if self.is_replayed(sql_text):
+                        await self.call(cursor.execute, sql_text)
+                    else:
+                        status = 'Not '
+                    exec_end = datetime.datetime.now(tz=datetime.timezone.utc)
+                    self.log_statement(transaction, idx, substatement_txt, status, exec_start, exec_end)
+                except Exception as err:
+                    success = False
+                    errors.append([sql_text, str(err)])
+                    self.log_statement_error(transaction, idx, substatement_txt, err)
+
+                await self.call(self.save_query_stats, exec_start, exec_end, transaction.xid, transaction_query_idx)
+            self.query_done(success)
+
+            if query.time_interval > 0.0:
+                logger.debug(f"Waiting {query.time_interval} sec between queries")
+                await self.scheduler.wait_async("query_interval", self.scheduler.due_in(query.time_interval))
+
+        await self.call(cursor.close)
+        await self.call(connection.commit)
+        self.transaction_done(transaction, errors)
 
 
 # exception thrown if any filters are invalid
@@ -576,16 +1100,61 @@ def parse_connections(workload_directory, time_interval_between_transactions, ti
     return connections, total_connections
 
 
-def parse_transactions(workload_directory):
-    transactions = []
-    gz_path = workload_directory.rstrip("/") + "/SQLs.json.gz"
+def retrieve_workload_transactions(workload_directory):
+    """ Yield the transaction dicts of a workload as they are read, from SQLs.ndjson.gz, the legacy
+        SQLs.json.gz or every shard of a sharded workload. A transaction spanning incremental
+        extractions has a line per extraction in SQLs.ndjson.gz, each is yielded on its own """
+    workload_directory = workload_directory.rstrip("/")
+    ndjson_path = workload_directory + "/SQLs.ndjson.gz"
+    if file_exists(ndjson_path):
+        yield from retrieve_compressed_ndjson(ndjson_path)
+        return
 
-    sql_json = retrieve_compressed_json(gz_path)
-    for xid, transaction_dict in sql_json['transactions'].items():
-        transaction = parse_transaction(transaction_dict)
-        if transaction.start_time() and matches_filters(transaction, g_config['filters']):
-            transactions.append(transaction)
+    workload = ShardedWorkload.load(workload_directory, texts=False)
+    if workload is not None:
+        for shard_idx in range(len(workload.shards)):
+            yield from workload.transaction_dicts(shard_idx)
+    else:
+        for _, transaction_dict in retrieve_compressed_json_members(workload_directory + "/SQLs.json.gz",
+                                                                    "transactions"):
+            yield transaction_dict
+
+
+def retrieve_workload_texts(workload_directory):
+    """ Return the query texts by id of a workload extracted with workload_format "ndjson_texts",
+        or an empty dict for other workloads """
+    texts_path = workload_directory.rstrip("/") + "/SQL_texts.ndjson.gz"
+    if not file_exists(texts_path):
+        return {}
+    return {text['id']: text['text'] for text in retrieve_compressed_ndjson(texts_path)}
 
+
+def parse_transactions(workload_directory):
+    """ The transactions of a workload that match the filters, in the order they start. The
+        workload is parsed as it is read, and the transactions the filters exclude are dropped
+        without parsing their queries """
+    transactions = OrderedDict()
+    excluded_xids = set()
+
+    # queries with the same text share a single string
+    texts = retrieve_workload_texts(workload_directory)
+    for transaction_dict in retrieve_workload_transactions(workload_directory):
+        xid = transaction_dict['xid']
+        if xid in excluded_xids:
+            continue
+        if xid in transactions:
+            # the rest of a transaction spanning incremental extractions
+            transaction = transactions[xid]
+            transaction.queries.extend(parse_queries(transaction_dict['queries'], texts))
+            transaction.queries.sort(key=lambda query: query.start_time)
+            continue
+        transaction = parse_transaction(transaction_dict, texts, g_config['filters'])
+        if transaction is None:
+            excluded_xids.add(xid)
+        else:
+            transactions[xid] = transaction
+
+    transactions = [transaction for transaction in transactions.values() if transaction.start_time()]
     transactions.sort(
         key=lambda transaction: (transaction.start_time(), transaction.xid)
     )
@@ -639,22 +1208,34 @@ def get_connection_key(database_name, username, pid):
     return f"{database_name}_{username}_{pid}"
 
 
-def parse_transaction(transaction_dict):
+def parse_transaction(transaction_dict, texts=None, filters=None):
+    """ Build a Transaction from its workload dict. Queries have either a text, or the text_id
+        of their text in texts. With filters, a transaction they exclude is None, and its queries
+        aren't parsed """
+    transaction_key = get_connection_key(transaction_dict['db'], transaction_dict['user'], transaction_dict['pid'])
+    transaction = Transaction(transaction_dict['time_interval'], transaction_dict['db'], transaction_dict['user'],
+                              transaction_dict['pid'], transaction_dict['xid'], [], transaction_key)
+    if filters is not None and not matches_filters(transaction, filters):
+        return None
+    transaction.queries = parse_queries(transaction_dict['queries'], texts)
+    return transaction
+
+
+def parse_queries(query_dicts, texts=None):
+    """ The Queries of a transaction's workload dict, in the order they start """
     queries = []
 
-    for q in transaction_dict['queries']:
+    for q in query_dicts:
         start_time = dateutil.parser.isoparse(q['record_time'])
         if q['start_time'] is not None:
             start_time = dateutil.parser.isoparse(q['start_time'])
         end_time = dateutil.parser.isoparse(q['record_time'])
         if q['end_time'] is not None:
             end_time = dateutil.parser.isoparse(q['end_time'])
-        queries.append(Query(start_time, end_time, q['text']))
+        queries.append(Query(start_time, end_time, q['text'] if 'text' in q else texts[q['text_id']]))
 
     queries.sort(key=lambda query: query.start_time)
-    transaction_key = get_connection_key(transaction_dict['db'], transaction_dict['user'], transaction_dict['pid'])
-    return Transaction(transaction_dict['time_interval'], transaction_dict['db'], transaction_dict['user'],
-                       transaction_dict['pid'], transaction_dict['xid'], queries, transaction_key)
+    return queries
 
 
 def parse_transaction_old(sql_filename, sql_file_text):
@@ -780,6 +1361,12 @@ def collect_stats(aggregated_stats, stats):
         new_stats.update(stats[stat])
         aggregated_stats[stat] = new_stats
 
+    # and the histograms of how late the events of the workers were
+    if stats.get('lag_histogram'):
+        lag_histogram = aggregated_stats.get('lag_histogram', {})
+        merge_lag_histograms(lag_histogram, stats['lag_histogram'])
+        aggregated_stats['lag_histogram'] = lag_histogram
+
 
 def percent(num, den):
     if den == 0:
@@ -798,6 +1385,8 @@ def init_stats(stats_dict):
     stats_dict['transaction_error_log'] = {}  # map filename to array of transaction errors
     stats_dict['multi_statements'] = 0
     stats_dict['executed_queries'] = 0 # includes multi-statement queries
+    stats_dict['lag_histogram'] = {}  # map kind of event to the histogram of its scheduling lag
+    stats_dict['connections_processed'] = 0  # the connections a worker started
     return stats_dict
 
 
@@ -832,11 +1421,83 @@ def join_finished_threads(connection_threads, worker_stats, wait=False):
     return len(finished_threads)
 
 
-def replay_worker(process_idx, replay_start_time, first_event_time, queue, worker_stats, default_interface, odbc_driver,
+def worker_jobs(jobs, connection_semaphore, num_connections):
+    """ Yield the jobs of a worker in order. With limit_concurrent_connections, a job is only
+        started once the semaphore is acquired """
+    for job in jobs:
+        if connection_semaphore is not None:
+            logger.debug(
+                f"Checking for connection throttling ({num_connections.value} / {g_config['limit_concurrent_connections']} active connections)")
+            sem_start = time.time()
+            connection_semaphore.acquire()
+            sem_elapsed = time.time() - sem_start
+            logger.debug(f"Waited {sem_elapsed} sec for semaphore")
+
+        yield job
+
+
+def partition_connections(connection_logs, num_workers):
+    """ Split the connection jobs between the workers before the replay starts, so each replays
+        its own list in the order the connections start. Connections are placed in the order they
+        start, those starting within the same second longest first (by queries, then duration),
+        each on the worker with the fewest sessions open at its start, then the fewest queries in
+        those sessions, then the fewest queries overall. This balances the sessions each worker has
+        open at any time """
+    partitions = [[] for _ in range(num_workers)]
+    # the (disconnection time, queries) of the sessions each worker has open
+    open_sessions = [[] for _ in range(num_workers)]
+    open_queries = [0] * num_workers
+    total_queries = [0] * num_workers
+
+    def query_count(connection_log):
+        # the transactions of a sharded workload are loaded as they are replayed, the shard index
+        # counted their queries
+        if not connection_log.transactions:
+            return connection_log.query_count
+        return sum(len(transaction.queries) for transaction in connection_log.transactions)
+
+    def end_time(connection_log):
+        return connection_log.disconnection_time or datetime.datetime.max.replace(tzinfo=datetime.timezone.utc)
+
+    jobs = [{"job_id": idx, "connection": connection} for idx, connection in enumerate(connection_logs)]
+    jobs.sort(key=lambda job: (connection_start_time(job["connection"]), -query_count(job["connection"]),
+                               connection_start_time(job["connection"]) - end_time(job["connection"])))
+    for job in jobs:
+        start_time = connection_start_time(job["connection"])
+        for worker_idx, sessions in enumerate(open_sessions):
+            while sessions and sessions[0][0] <= start_time:
+                open_queries[worker_idx] -= heapq.heappop(sessions)[1]
+
+        worker_idx = min(range(num_workers),
+                         key=lambda idx: (len(open_sessions[idx]), open_queries[idx], total_queries[idx]))
+        queries = query_count(job["connection"])
+        heapq.heappush(open_sessions[worker_idx], (end_time(job["connection"]), queries))
+        open_queries[worker_idx] += queries
+        total_queries[worker_idx] += queries
+        partitions[worker_idx].append(job)
+
+    # each worker waits for its jobs in the order the connections start
+    for partition in partitions:
+        partition.sort(key=lambda job: job["job_id"])
+    return partitions
+
+
+def job_due(job, scheduler, first_event_time):
+    """ When the connection of a job is due """
+
+    # what is the time offset of this connection job relative to the first event
+    due = scheduler.due_at(job['connection'].offset_ms(first_event_time) / 1000.0)
+
+    logger.debug(
+        f"Got job {job['job_id'] + 1}, delay {scheduler.until(due):+.3f} sec (extracted connection time: {job['connection'].session_initiation_time})")
+    return due
+
+
+def replay_worker(process_idx, replay_start_time, first_event_time, jobs, worker_stats, default_interface, odbc_driver,
                   connection_semaphore,
-                  num_connections, peak_connections):
+                  num_connections, peak_connections, workload=None):
     """ Worker process to distribute the work among several processes.  Each
-        worker pulls a connection off the queue, waits until its time to start
+        worker takes the next connection of its jobs, waits until its time to start
         it, spawns a thread to execute the actual connection and associated
         transactions, and then repeats. """
 
@@ -847,6 +1508,7 @@ def replay_worker(process_idx, replay_start_time, first_event_time, queue, worke
     threading.current_thread().name = '0'
 
     perf_lock = threading.Lock()
+    scheduler = ReplayScheduler(replay_start_time)
 
     try:
         # prepend the process index to all log messages in this worker
@@ -856,66 +1518,13 @@ def replay_worker(process_idx, replay_start_time, first_event_time, queue, worke
         time.sleep(random.randrange(1, 3))
         logger.debug(f"Worker {process_idx} ready for jobs")
 
-        # time to block waiting for jobs on the queue
-        timeout_sec = 10
-
-        last_empty_queue_time = None
-
-        # get the next job off the queue and wait until its due
-        # loop terminates when a False is received over the queue
-        while True:
-            try:
-                if connection_semaphore is not None:
-                    logger.debug(
-                        f"Checking for connection throttling ({num_connections.value} / {g_config['limit_concurrent_connections']} active connections)")
-                    sem_start = time.time()
-                    connection_semaphore.acquire()
-                    sem_elapsed = time.time() - sem_start
-                    logger.debug(f"Waited {sem_elapsed} sec for semaphore")
-
-                job = queue.get(timeout=timeout_sec)
-            except Empty:
-                if connection_semaphore is not None:
-                    connection_semaphore.release()
-
-                elapsed = int(time.time() - last_empty_queue_time) if last_empty_queue_time else 0
-                # take into account the initial timeout
-                elapsed += timeout_sec
-                empty_queue_timeout_sec = g_config.get("empty_queue_timeout_sec", 120)
-                logger.debug(f"No jobs for {elapsed} seconds (timeout {empty_queue_timeout_sec})")
-                # normally processes exit when they get a False on the queue,
-                # but in case of some error we exit if the queue is empty for some time
-                if elapsed > empty_queue_timeout_sec:
-                    logger.warning(f"Queue empty for {elapsed} sec, exiting")
-                    break
-                if last_empty_queue_time is None:
-                    last_empty_queue_time = time.time()
-                continue
-
-            last_empty_queue_time = None
-
-            if job is False:
-                logger.debug("Got termination signal, finishing up.")
-                break
-
+        # get the next job and wait until its due
+        for job in worker_jobs(jobs, connection_semaphore, num_connections):
             thread_stats = init_stats({})
 
-            # how much time has elapsed since the replay started
-            time_elapsed_ms = current_offset_ms(replay_start_time)
-
-            # what is the time offset of this connection job relative to the first event
-            connection_offset_ms = job['connection'].offset_ms(first_event_time)
-            delay_sec = (connection_offset_ms - time_elapsed_ms) / 1000.0
-
-            logger.debug(
-                f"Got job {job['job_id'] + 1}, delay {delay_sec:+.3f} sec (extracted connection time: {job['connection'].session_initiation_time})")
-
-            # if connection time is more than a few ms in the future, sleep until its due.
-            # this is approximate and we use "a few ms" here due to the imprecision of
-            # sleep as well as the time for the remaining code to spawn a thread and actually
-            # make the db connection.
-            if connection_offset_ms - time_elapsed_ms > 10:
-                time.sleep(delay_sec)
+            # wait until the connection is due. the timer of the scheduler wakes us, so the
+            # time to spawn a thread and actually make the db connection is the only delay.
+            scheduler.wait("connect", job_due(job, scheduler, first_event_time))
 
             logger.debug(
                 f"Starting job {job['job_id'] + 1} (extracted connection time: {job['connection'].session_initiation_time}). {len(threading.enumerate())}, {threading.active_count()} connections active.")
@@ -932,7 +1541,9 @@ def replay_worker(process_idx, replay_start_time, first_event_time, queue, worke
                 num_connections,
                 peak_connections,
                 connection_semaphore,
-                perf_lock
+                perf_lock,
+                workload,
+                scheduler,
             )
             connection_thread.name = f"{job['job_id']}"
             connection_thread.start()
@@ -942,11 +1553,52 @@ def replay_worker(process_idx, replay_start_time, first_event_time, queue, worke
 
             connections_processed += 1
 
+    except Exception as e:
+        logger.error(f"Process {process_idx} threw exception: {e}")
+        logger.debug("".join(traceback.format_exception(*sys.exc_info())))
+    finally:
+        # the connections already started still wait for their events on the scheduler
         logger.debug(f"Waiting for {len(connection_threads)} connections to finish...")
         join_finished_threads(connection_threads, worker_stats, wait=True)
+        scheduler.close()
+        worker_stats['lag_histogram'] = scheduler.lag_histogram
+    # for the main process to check all the jobs were replayed
+    worker_stats['connections_processed'] = connections_processed
+
+    if connections_processed:
+        logger.debug(f"Max connection offset for this process: {worker_stats['connection_diff_sec']:.3f} sec")
+
+    logger.debug(f"Process {process_idx} finished")
+
+
+def async_replay_worker(process_idx, replay_start_time, first_event_time, jobs, worker_stats, default_interface,
+                        odbc_driver, connection_semaphore, num_connections, peak_connections, workload=None):
+    """ Worker process like replay_worker, which replays its connections as tasks of a single
+        event loop rather than a thread each. The blocking calls to the driver are run by a pool of
+        async_executor_threads threads, shared by the connections of the worker """
+    connections_processed = 0
+    scheduler = ReplayScheduler(replay_start_time)
+
+    try:
+        # prepend the process index to all log messages in this worker
+        prepend_ids_to_logs(process_idx)
+
+        # stagger worker startup to not hammer the get_cluster_credentials api
+        time.sleep(random.randrange(1, 3))
+        logger.debug(f"Worker {process_idx} ready for jobs")
+
+        connections_processed = asyncio.run(replay_jobs(
+            process_idx, replay_start_time, first_event_time, jobs, worker_stats, default_interface, odbc_driver,
+            connection_semaphore, num_connections, peak_connections, workload, scheduler,
+        ))
     except Exception as e:
         logger.error(f"Process {process_idx} threw exception: {e}")
         logger.debug("".join(traceback.format_exception(*sys.exc_info())))
+    finally:
+        scheduler.close()
+        worker_stats['lag_histogram'] = scheduler.lag_histogram
+    # for the main process to check all the jobs were replayed
+    worker_stats['connections_processed'] = connections_processed
 
     if connections_processed:
         logger.debug(f"Max connection offset for this process: {worker_stats['connection_diff_sec']:.3f} sec")
@@ -954,24 +1606,113 @@ def replay_worker(process_idx, replay_start_time, first_event_time, queue, worke
     logger.debug(f"Process {process_idx} finished")
 
 
-def put_and_retry(job, queue, timeout=10, non_workers=0):
-    """ Retry adding to the queue indefinitely until it succeeds. This
-        should only raise an exception and retry if the queue limit is hit. """
-    attempt = 0
-    while True:
-        try:
-            queue.put(job, block=True, timeout=timeout)
-            break
-        except Full:
-            # check to make sure child processes are alive
-            active_workers = len(multiprocessing.active_children()) - non_workers
-            if active_workers == 0:
-                logger.error("Queue full, but there don't appear to be any active workers.  Giving up.")
-                return False
-            attempt += 1
-            logger.info(f"Queue full, retrying attempt {attempt}")
+async def replay_jobs(process_idx, replay_start_time, first_event_time, jobs, worker_stats, default_interface,
+                      odbc_driver, connection_semaphore, num_connections, peak_connections, workload=None,
+                      scheduler=None):
+    """ Start a ConnectionTask for each job when it's due, and wait for them all to
+        finish. If starting a job fails, the connections already started are cancelled, which
+        closes them. Returns the number of connections started """
+    loop = asyncio.get_running_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(g_config.get("async_executor_threads") or 100)
+    # waiting for the semaphore and the stats of the worker, which are shared with the main process,
+    # have a thread each, so they neither block the event loop nor wait behind the driver
+    job_executor = concurrent.futures.ThreadPoolExecutor(1)
+    stats_executor = concurrent.futures.ThreadPoolExecutor(1)
+    perf_lock = threading.Lock()
 
-    return True
+    connection_tasks = set()
+    collected_stats = []
+    connections_processed = 0
+    worker_jobs_iter = worker_jobs(jobs, connection_semaphore, num_connections)
+    try:
+        # get the next job and wait until its due
+        while True:
+            job = await loop.run_in_executor(job_executor, next, worker_jobs_iter, None)
+            if job is None:
+                break
+            thread_stats = init_stats({})
+
+            await scheduler.wait_async("connect", job_due(job, scheduler, first_event_time))
+
+            logger.debug(
+                f"Starting job {job['job_id'] + 1} (extracted connection time: {job['connection'].session_initiation_time}). {len(connection_tasks) + 1} connections active.")
+
+            connection_task = ConnectionTask(
+                process_idx,
+                job['job_id'],
+                job['connection'],
+                default_interface,
+                odbc_driver,
+                replay_start_time,
+                first_event_time,
+                thread_stats,
+                num_connections,
+                peak_connections,
+                connection_semaphore,
+                perf_lock,
+                workload,
+                scheduler,
+                executor=executor,
+            )
+            task = asyncio.create_task(connection_task.run(), name=f"{job['job_id']}")
+            connection_tasks.add(task)
+
+            def collect_task_stats(task, thread_stats=thread_stats):
+                connection_tasks.discard(task)
+                collected_stats.append(loop.run_in_executor(stats_executor, collect_stats, worker_stats, thread_stats))
+
+            task.add_done_callback(collect_task_stats)
+            connections_processed += 1
+
+        logger.debug(f"Waiting for {len(connection_tasks)} connections to finish...")
+        while connection_tasks:
+            await asyncio.wait(connection_tasks)
+    except Exception as e:
+        logger.error(f"Process {process_idx} threw exception: {e}")
+        logger.debug("".join(traceback.format_exception(*sys.exc_info())))
+    finally:
+        # the tasks disconnect and collect their stats on the executors, before they shut down
+        for task in connection_tasks:
+            task.cancel()
+        await asyncio.gather(*connection_tasks, return_exceptions=True)
+        await asyncio.gather(*collected_stats)
+        executor.shutdown(wait=False)
+        job_executor.shutdown(wait=False)
+        stats_executor.shutdown()
+    return connections_processed
+
+
+def event_time_range(connection_logs, sharded=False):
+    """ The time of the first and last event of the connections and their transactions. With a
+        sharded workload, the times of the transactions are those assign_shards set """
+    first_event_time = datetime.datetime.now(tz=datetime.timezone.utc)
+    last_event_time = datetime.datetime.utcfromtimestamp(0).replace(
+        tzinfo=datetime.timezone.utc
+    )
+
+    for connection in connection_logs:
+        if (
+                connection.session_initiation_time
+                and connection.session_initiation_time < first_event_time
+        ):
+            first_event_time = connection.session_initiation_time
+        if (
+                connection.disconnection_time
+                and connection.disconnection_time > last_event_time
+        ):
+            last_event_time = connection.disconnection_time
+
+        if sharded:
+            first_event_time = min(first_event_time, connection.first_start_time)
+            last_event_time = max(last_event_time, connection.last_end_time)
+            continue
+        if connection.transactions[0].queries[0].start_time and connection.transactions[0].queries[
+            0].start_time < first_event_time:
+            first_event_time = connection.transactions[0].queries[0].start_time
+        if connection.transactions[-1].queries[-1].end_time and connection.transactions[-1].queries[
+            -1].end_time > last_event_time:
+            last_event_time = connection.transactions[-1].queries[-1].end_time
+    return first_event_time, last_event_time
 
 
 def sigint_handler(signum, frame):
@@ -988,10 +1729,9 @@ def sigint_handler(signum, frame):
 
 
 def start_replay(connection_logs, default_interface, odbc_driver, first_event_time, last_event_time,
-                 num_workers, manager, per_process_stats, total_transactions, total_queries):
-    """ create a queue for passing jobs to the workers.  the limit will cause
-    put() to block if the queue is full """
-    queue = manager.Queue(maxsize=1000000)
+                 num_workers, manager, per_process_stats, total_transactions, total_queries, workload=None):
+    """ Split the connections between the workers and start them. Each worker gets its own list
+    of jobs when it starts, so none go through the manager during the replay """
 
     if not num_workers:
         # get number of available cpus, leave 1 for main thread and manager
@@ -1019,32 +1759,26 @@ def start_replay(connection_logs, default_interface, odbc_driver, first_event_ti
         # create an IPC semaphore to limit the total concurrency
         connection_semaphore = manager.Semaphore(g_config.get('limit_concurrent_connections'))
 
+    # each worker replays its connections on a thread each, or as tasks of an event loop
+    worker = async_replay_worker if g_config.get("replay_engine") == "asyncio" else replay_worker
+    logger.debug(f"Replaying with the {g_config.get('replay_engine') or 'threads'} engine")
+
+    logger.debug(f"Total connections in the connection log: {len(connection_logs)}")
+    partitions = partition_connections(connection_logs, num_workers)
+
     for idx in range(num_workers):
+        logger.debug(f"Worker {idx} has {len(partitions[idx])} connections")
         per_process_stats[idx] = manager.dict()
         init_stats(per_process_stats[idx])
-        g_workers.append(multiprocessing.Process(target=replay_worker,
-                                                 args=(idx, g_replay_timestamp, first_event_time, queue,
+        g_workers.append(multiprocessing.Process(target=worker,
+                                                 args=(idx, g_replay_timestamp, first_event_time, partitions[idx],
                                                        per_process_stats[idx], default_interface, odbc_driver,
-                                                       connection_semaphore, num_connections, peak_connections)))
+                                                       connection_semaphore, num_connections, peak_connections,
+                                                       workload)))
         g_workers[-1].start()
 
     signal.signal(signal.SIGINT, sigint_handler)
 
-    logger.debug(f"Total connections in the connection log: {len(connection_logs)}")
-
-    # add all the jobs to the work queue
-    for idx, connection in enumerate(connection_logs):
-        # if idx > 5:
-        #     break
-        if not put_and_retry({"job_id": idx, "connection": connection}, queue, non_workers=initial_processes):
-            break
-
-    # and add one termination "job"/signal for each worker so signal them to exit when
-    # there is no more work
-    for idx in range(num_workers):
-        if not put_and_retry(False, queue, non_workers=initial_processes):
-            break
-
     active_processes = len(multiprocessing.active_children()) - initial_processes
     logger.debug("Active processes: {}".format(active_processes))
 
@@ -1057,12 +1791,6 @@ def start_replay(connection_logs, default_interface, odbc_driver, first_event_ti
         active_processes = len(multiprocessing.active_children()) - initial_processes
         if cnt % 60 == 0:
             logger.debug(f"Waiting for {active_processes} processes to finish")
-            try:
-                queue_length = queue.qsize()
-                logger.debug(f"Remaining connections: {queue_length - num_workers}")
-            except NotImplementedError:
-                # support for qsize is platform-dependent
-                logger.debug("Queue length not supported.")
 
         # aggregate stats across all threads so far
         try:
@@ -1078,18 +1806,16 @@ def start_replay(connection_logs, default_interface, odbc_driver, first_event_ti
 
         time.sleep(1)
 
-    # cleanup in case of error
-    remaining_events = 0
-    try:
-        # clear out the queue in case of error to prevent broken pipe
-        # exceptions from internal Queue thread
-        while not queue.empty():
-            remaining_events += 1
-            queue.get_nowait()
-    except Empty:
-        pass
-
-    if remaining_events > 0:
+    # a worker that failed or didn't exit cleanly may not have replayed all its connections
+    all_processed = True
+    for idx, worker_process in enumerate(g_workers):
+        worker_process.join()
+        connections_processed = per_process_stats[idx].get('connections_processed', 0)
+        if worker_process.exitcode != 0 or connections_processed < len(partitions[idx]):
+            logger.error(f"Worker {idx} replayed {connections_processed} of its {len(partitions[idx])} connections "
+                         f"(exit code {worker_process.exitcode})")
+            all_processed = False
+    if not all_processed:
         logger.error("Not all jobs processed, replay unsuccessful")
 
     return True
@@ -1159,6 +1885,35 @@ def export_errors(connection_errors, transaction_errors, workload_location, repl
             error_file.close()
 
 
+def prepare_transactions(connection_logs, replacements, replay_id):
+    """ Get the transactions of the connections ready to replay: COPY and UNLOAD locations and IAM
+        roles, time intervals between queries and CREATE USER passwords """
+    if g_config["execute_copy_statements"] == "true":
+        logger.debug("Configuring COPY replacements")
+        assign_copy_replacements(connection_logs, replacements)
+
+    if g_config["execute_unload_statements"] == "true":
+        if g_config["unload_iam_role"]:
+            if g_config["replay_output"].startswith("s3://"):
+                logger.debug("Configuring UNLOADs")
+                assign_unloads(
+                    connection_logs,
+                    g_config["replay_output"],
+                    replay_id,
+                    g_config["unload_iam_role"],
+                )
+            else:
+                logger.debug(
+                    'UNLOADs not configured since "replay_output" is not an S3 location.'
+                )
+
+    logger.debug("Configuring time intervals")
+    assign_time_intervals(connection_logs)
+
+    logger.debug("Configuring CREATE USER PASSWORD random replacements")
+    assign_create_user_password(connection_logs)
+
+
 def assign_copy_replacements(connection_logs, replacements):
     for connection_log in connection_logs:
         for transaction in connection_log.transactions:
@@ -1598,6 +2353,19 @@ def validate_config(config):
         )
         exit(-1)
 
+    if config.get("replay_engine") not in (None, "threads", "asyncio"):
+        logger.error(
+            'Config file value for "replay_engine" must be either "threads" or "asyncio". Please change the value for '
+            '"replay_engine" to either "threads" or "asyncio".'
+        )
+        exit(-1)
+    async_executor_threads = config.get("async_executor_threads")
+    if async_executor_threads is not None and not (isinstance(async_executor_threads, int) and async_executor_threads >= 1):
+        logger.error(
+            'Config file value for "async_executor_threads" is not valid. Please use a whole number, e.g. 100.'
+        )
+        exit(-1)
+
     config['filters'] = validate_and_normalize_filters(ConnectionLog, config.get('filters', {}))
 
 
@@ -1688,97 +2456,41 @@ def main():
         f"Loading transactions from {g_config['workload_location']}, this might take some time."
     )
 
-    # group all connections by connection key
-    connection_idx_by_key = {}
-    for idx, c in enumerate(connection_logs):
-        connection_key = get_connection_key(c.database_name, c.username, c.pid)
-        connection_idx_by_key.setdefault(connection_key, []).append(idx)
-
-    all_transactions = parse_transactions(g_config["workload_location"])
-
-    transaction_count = len(all_transactions)
-    query_count = 0
-
-    # assign the correct connection to each transaction by looking at the most
-    # recent connection prior to the transaction start. This relies on connections
-    # being sorted.
-    for idx, t in enumerate(all_transactions):
-        connection_key = get_connection_key(t.database_name, t.username, t.pid)
-        possible_connections = connection_idx_by_key[connection_key]
-        best_match_idx = None
-        for c_idx in possible_connections:
-            # truncate session start time, since query/transaction time is truncated to seconds
-            if connection_logs[c_idx].session_initiation_time.replace(microsecond=0) > t.start_time():
-                break
-            best_match_idx = c_idx
-        if best_match_idx is None:
-            logger.warning(
-                f"Couldn't find matching connection in {len(possible_connections)} connections for transaction {t}, skipping")
-            continue
-        connection_logs[best_match_idx].transactions.append(t)
-        query_count += len(t.queries)
+    # a sharded workload is loaded by the workers as they replay it
+    workload = ShardedWorkload.load(g_config["workload_location"])
+    if workload is not None:
+        logger.info(f"The workload has {len(workload.shards)} shards, which are loaded as they are replayed")
+        transaction_count, query_count = workload.assign_shards(connection_logs, g_config['filters'])
+        logger.info(f"Found {transaction_count} transactions, {query_count} queries")
+        connection_logs = [_ for _ in connection_logs if _.transaction_count > 0]
+    else:
+        all_transactions = parse_transactions(g_config["workload_location"])
+        transaction_count = len(all_transactions)
+        query_count = assign_transactions(connection_logs, all_transactions)
 
-    logger.info(f"Found {transaction_count} transactions, {query_count} queries")
-    connection_logs = [_ for _ in connection_logs if len(_.transactions) > 0]
+        logger.info(f"Found {transaction_count} transactions, {query_count} queries")
+        connection_logs = [_ for _ in connection_logs if len(_.transactions) > 0]
     logger.info(f"{len(connection_logs)} connections contain transactions and will be replayed ")
 
     global g_total_connections
     g_total_connections = len(connection_logs)
 
-    first_event_time = datetime.datetime.now(tz=datetime.timezone.utc)
-    last_event_time = datetime.datetime.utcfromtimestamp(0).replace(
-        tzinfo=datetime.timezone.utc
-    )
-
-    for connection in connection_logs:
-        if (
-                connection.session_initiation_time
-                and connection.session_initiation_time < first_event_time
-        ):
-            first_event_time = connection.session_initiation_time
-        if (
-                connection.disconnection_time
-                and connection.disconnection_time > last_event_time
-        ):
-            last_event_time = connection.disconnection_time
-
-        if connection.transactions[0].queries[0].start_time and connection.transactions[0].queries[
-            0].start_time < first_event_time:
-            first_event_time = connection.transactions[0].queries[0].start_time
-        if connection.transactions[-1].queries[-1].end_time and connection.transactions[-1].queries[
-            -1].end_time > last_event_time:
-            last_event_time = connection.transactions[-1].queries[-1].end_time
+    first_event_time, last_event_time = event_time_range(connection_logs, sharded=workload is not None)
 
     logger.info(
         "Estimated original workload execution time: "
         + str((last_event_time - first_event_time))
     )
 
+    replacements = {}
     if g_config["execute_copy_statements"] == "true":
-        logger.debug("Configuring COPY replacements")
         replacements = parse_copy_replacements(g_config["workload_location"])
-        assign_copy_replacements(connection_logs, replacements)
-
-    if g_config["execute_unload_statements"] == "true":
-        if g_config["unload_iam_role"]:
-            if g_config["replay_output"].startswith("s3://"):
-                logger.debug("Configuring UNLOADs")
-                assign_unloads(
-                    connection_logs,
-                    g_config["replay_output"],
-                    replay_id,
-                    g_config["unload_iam_role"],
-                )
-            else:
-                logger.debug(
-                    'UNLOADs not configured since "replay_output" is not an S3 location.'
-                )
-
-    logger.debug("Configuring time intervals")
-    assign_time_intervals(connection_logs)
-
-    logger.debug("Configuring CREATE USER PASSWORD random replacements")
-    assign_create_user_password(connection_logs)
+    if workload is not None:
+        # the transactions of a sharded workload are prepared as they're loaded
+        workload.replacements = replacements
+        workload.replay_id = replay_id
+    else:
+        prepare_transactions(connection_logs, replacements, replay_id)
 
     # test connection
     try:
@@ -1807,7 +2519,8 @@ def main():
                      manager,
                      per_process_stats,
                      transaction_count,
-                     query_count)
+                     query_count,
+                     workload)
         complete = True
     except KeyboardInterrupt:
         replay_id += '_INCOMPLETE'
@@ -1853,6 +2566,7 @@ def main():
     replay_summary.append(f"Replay finished in {replay_end_time - g_replay_timestamp}.")
     for line in replay_summary:
         logger.info(line)
+    report_lag_histogram(aggregated_stats['lag_histogram'])
 
     logger.info(f"Replay finished in {datetime.datetime.now(tz=datetime.timezone.utc) - g_replay_timestamp}.")
 
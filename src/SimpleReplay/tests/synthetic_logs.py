@@ -0,0 +1,129 @@
+import datetime
+import gzip
+
+LOG_PREFIX = "123456789012_redshift_us-east-1_test-cluster"
+
+
+def connection_log_line(event, event_time, pid, database_name, username, application_name=""):
+    """ Format a connection log line, see STL_CONNECTION_LOG for the columns """
+    fields = [
+        event,
+        event_time.strftime("%a, %d %b %Y %H:%M:%S:") + f"{event_time.microsecond:06d}",
+        "10.0.0.1 ",
+        "51000 ",
+        str(pid).ljust(6),
+        database_name.ljust(10),
+        username.ljust(10),
+        "password",
+        "0",
+        "TLSv1.2",
+        "ECDHE-RSA-AES256-SHA384",
+        "0",
+        "0",
+        "0",
+        "",
+        application_name.ljust(20),
+        "Linux",
+        "Redshift JDBC Driver 2.1.0.1",
+        "",
+        "2",
+        "",
+        "",
+    ]
+    return "|".join(fields) + "\n"
+
+
+def user_activity_log_record(record_time, database_name, username, pid, xid, text):
+    """ Format a user activity log record, see STL_USERLOG for the header format """
+    return (
+        f"'{record_time.strftime('%Y-%m-%dT%H:%M:%SZ')} UTC [ db={database_name} user={username} pid={pid} "
+        f"userid=100 xid={xid} ]' LOG: {text}\n"
+    )
+
+
+def start_node_log_record(record_time, database_name, username, pid, xid, text):
+    """ Format a start node log statement, with the header fields read by read_start_node_log """
+    return (
+        f"'{record_time.strftime('%Y-%m-%d %H:%M:%S')} UTC [ db={username}:{pid}@{database_name} pid={pid} "
+        f"userid=100 xid={xid} ]' LOG:  statement: {text}\n"
+    )
+
+
+def log_filename(log_type, file_time):
+    return f"{LOG_PREFIX}_{log_type}_{file_time.strftime('%Y-%m-%dT%H:%M')}.gz"
+
+
+def write_log_file(directory, log_type, file_time, lines):
+    """ Write lines to a gzipped audit log named the same way Redshift names them """
+    path = f"{directory}/{log_filename(log_type, file_time)}"
+    with gzip.open(path, "wb") as fp:
+        fp.write("".join(lines).encode("utf-8"))
+    return path
+
+
+def write_workload_logs(directory, start=datetime.datetime(2021, 9, 2, 20, 0, tzinfo=datetime.timezone.utc)):
+    """ Write a small set of connection and user activity logs exercising the rules that span
+        several files: pid reuse, JDBC duplicates and consecutive FETCHes.
+
+        Redshift only writes a user activity record once the next one starts, so the last
+        record of each user activity file is padding that is never extracted. """
+    minute = datetime.timedelta(minutes=1)
+    second = datetime.timedelta(seconds=1)
+
+    connection_files = [
+        [
+            connection_log_line("initiating session ", start + second, 1001, "dev", "alice"),
+            connection_log_line("set application_name ", start + 2 * second, 1001, "dev", "alice", "psql"),
+            connection_log_line("initiating session ", start + 3 * second, 1002, "dev", "bob"),
+            connection_log_line("disconnecting session ", start + 4 * second, 1003, "prod", "carol"),
+        ],
+        [
+            connection_log_line("disconnecting session ", start + 20 * minute, 1001, "dev", "alice"),
+            # pid 1001 is reused for a new session of the same user
+            connection_log_line("initiating session ", start + 21 * minute, 1001, "dev", "alice"),
+            connection_log_line("initiating session ", start + 22 * minute, 1004, "prod", "rdsdb"),
+        ],
+        [
+            connection_log_line("set application_name ", start + 41 * minute, 1001, "dev", "alice", "odbc"),
+            connection_log_line("set application_name ", start + 42 * minute, 1005, "dev", "dave", "jdbc"),
+            connection_log_line("disconnecting session ", start + 43 * minute, 1002, "dev", "bob"),
+            connection_log_line("disconnecting session ", start + 44 * minute, 1001, "dev", "alice"),
+        ],
+    ]
+
+    t1 = start + 5 * second
+    t2 = start + 21 * minute + second
+    activity_files = [
+        [
+            user_activity_log_record(t1, "dev", "alice", 1001, 501, "select 1;"),
+            user_activity_log_record(t1, "dev", "alice", 1001, 501, "select\n  2\n  -- two\n;"),
+            user_activity_log_record(t1, "dev", "bob", 1002, 502, "fetch next from c1;"),
+            user_activity_log_record(t1, "dev", "bob", 1002, 502, "fetch next from c1;"),
+            user_activity_log_record(t1, "dev", "bob", 1002, 503, "create table t (a int);"),
+            user_activity_log_record(t1, "dev", "alice", 1001, 504, "select 'padding';"),
+        ],
+        [
+            # JDBC duplicate of the last query of the previous file
+            user_activity_log_record(t1, "dev", "bob", 1002, 503, "create table t (a int);"),
+            user_activity_log_record(t1, "dev", "bob", 1002, 502, "fetch 100 from c1;"),
+            user_activity_log_record(t2, "dev", "alice", 1001, 601, "show search_path;"),
+            user_activity_log_record(t2, "dev", "alice", 1001, 602, "copy t from 's3://bucket/prefix/' iam_role 'arn:aws:iam::123456789012:role/r';"),
+            user_activity_log_record(t2, "prod", "carol", 1003, 603, "select * from t where a like '50%';"),
+            user_activity_log_record(t2, "dev", "alice", 1001, 604, "select 'padding';"),
+        ],
+        [
+            user_activity_log_record(t2, "prod", "carol", 1003, 603, "select * from t where a like '50%';"),
+            user_activity_log_record(t2, "dev", "dave", 1005, 701, "/* comment */ update t set a = 1;"),
+            user_activity_log_record(t2, "dev", "dave", 1005, 701, "update t set a = 1;"),
+            user_activity_log_record(t2, "dev", "rdsdb", 1006, 702, "select 1;"),
+            user_activity_log_record(t2, "dev", "alice", 1001, 703, "insert into t values (1);"),
+            user_activity_log_record(t2, "dev", "alice", 1001, 704, "select 'padding';"),
+        ],
+    ]
+
+    paths = []
+    for idx, lines in enumerate(connection_files):
+        paths.append(write_log_file(directory, "connectionlog", start + 20 * idx * minute, lines))
+    for idx, lines in enumerate(activity_files):
+        paths.append(write_log_file(directory, "useractivitylog", start + 20 * idx * minute, lines))
+    return paths
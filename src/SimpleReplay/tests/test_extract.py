@@ -0,0 +1,976 @@
+import contextlib
+import datetime
+import gzip
+import io
+import json
+import logging
+import os
+import random
+import tempfile
+import unittest
+import zlib
+from unittest import mock
+
+import boto3
+import dateutil.parser
+
+try:
+    from moto import mock_aws
+except ImportError:  # moto < 5
+    from moto import mock_s3 as mock_aws
+
+import extract
+import util
+from benchmarks.synthetic_workload import write_synthetic_logs
+from tests.synthetic_logs import connection_log_line, user_activity_log_record, write_log_file, write_workload_logs
+
+START_TIME = datetime.datetime(2021, 9, 2, 20, 0, tzinfo=datetime.timezone.utc)
+END_TIME = datetime.datetime(2021, 9, 2, 21, 0, tzinfo=datetime.timezone.utc)
+
+
+def setUpModule():
+    extract.logger = logging.getLogger("SimpleReplayLogger")
+
+
+def save_workload(output_directory, parsed_logs):
+    """ Save parsed logs with save_logs and return the content of SQLs.ndjson and connections.json """
+    connections, logs, databases, last_connections = parsed_logs
+    extract.save_logs(logs, last_connections, output_directory, connections, START_TIME, END_TIME)
+    with gzip.open(f"{output_directory}/SQLs.ndjson.gz", "rb") as fp:
+        sqls = fp.read()
+    with open(f"{output_directory}/connections.json", "rb") as fp:
+        connections_json = fp.read()
+    return sqls, connections_json
+
+
+class ParallelLogParsingTests(unittest.TestCase):
+    start_time = START_TIME
+    end_time = END_TIME
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.log_directory = f"{self.tmp.name}/logs"
+        extract.pathlib.Path(self.log_directory).mkdir()
+        write_workload_logs(self.log_directory)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def extract_workload(self, name, num_workers):
+        parsed_logs = extract.get_local_logs(self.log_directory, self.start_time, self.end_time, num_workers)
+        return save_workload(f"{self.tmp.name}/{name}", parsed_logs) + (parsed_logs[2],)
+
+    def test_parallel_output_is_identical_to_serial(self):
+        serial_sqls, serial_connections, serial_databases = self.extract_workload("serial", None)
+        parallel_sqls, parallel_connections, parallel_databases = self.extract_workload("parallel", 3)
+
+        self.assertEqual(serial_sqls, parallel_sqls)
+        self.assertEqual(serial_connections, parallel_connections)
+        self.assertEqual(serial_databases, parallel_databases)
+
+    def test_rules_spanning_files_are_applied(self):
+        connections, logs, databases, last_connections = extract.get_local_logs(
+            self.log_directory, self.start_time, self.end_time, 2
+        )
+        texts = [query.text.strip() for queries in logs.values() for query in queries]
+
+        # the JDBC duplicate at the start of the second file is dropped
+        self.assertEqual(1, texts.count("create table t (a int);"))
+        # consecutive FETCHes are commented out, including across files
+        self.assertIn("--fetch next from c1;", texts)
+        self.assertIn("--fetch 100 from c1;", texts)
+        self.assertEqual({"dev", "prod"}, databases)
+
+        # the reused pid gets its own session, and the later events attach to it
+        alice = sorted(
+            (c for c in connections.values() if c.username == "alice"),
+            key=lambda c: c.session_initiation_time,
+        )
+        self.assertEqual(2, len(alice))
+        self.assertEqual("psql", alice[0].application_name)
+        self.assertEqual(self.start_time + datetime.timedelta(minutes=20), alice[0].disconnection_time)
+        self.assertEqual("odbc", alice[1].application_name)
+        self.assertEqual(self.start_time + datetime.timedelta(minutes=44), alice[1].disconnection_time)
+
+    def test_records_share_repeated_strings(self):
+        for num_workers in (None, 2):
+            connections, logs, databases, last_connections = extract.get_local_logs(
+                self.log_directory, self.start_time, self.end_time, num_workers
+            )
+            queries = [query for queries in logs.values() for query in queries]
+            for field in ("username", "database_name", "pid"):
+                values = [getattr(query, field) for query in queries]
+                self.assertEqual(len(set(values)), len({id(_) for _ in values}), (num_workers, field))
+            self.assertFalse(hasattr(queries[0], "__dict__"))
+
+
+class SamplingTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.log_directory = self.tmp.name
+        second = datetime.timedelta(seconds=1)
+        connection_lines = []
+        activity_records = []
+        # 12 sessions of psql for alice and of jdbc for bob, 3 transactions each
+        for idx in range(24):
+            username, application_name = ("alice", "psql") if idx % 2 else ("bob", "jdbc")
+            session_time = START_TIME + idx * second
+            connection_lines += [
+                connection_log_line("initiating session ", session_time, 2000 + idx, "dev", username),
+                connection_log_line("set application_name ", session_time, 2000 + idx, "dev", username,
+                                    application_name),
+            ]
+            for transaction in range(3):
+                activity_records.append(user_activity_log_record(
+                    START_TIME + (100 + idx * 3 + transaction) * second, "dev", username, 2000 + idx,
+                    5000 + idx * 3 + transaction, f"select {idx}, {transaction};",
+                ))
+        activity_records.append(user_activity_log_record(END_TIME, "dev", "alice", 2001, 9999, "select 'padding';"))
+        write_log_file(self.log_directory, "connectionlog", START_TIME, connection_lines)
+        write_log_file(self.log_directory, "useractivitylog", START_TIME, activity_records)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def sample(self, num_workers=None, **kwargs):
+        sampler = extract.WorkloadSampler(**kwargs)
+        connections, logs, databases, last_connections = extract.get_local_logs(
+            self.log_directory, START_TIME, END_TIME, num_workers, sampler=sampler
+        )
+        return sampler.sample_connections(connections), logs
+
+    def test_sessions_are_sampled_for_each_user_and_application(self):
+        connections, logs = self.sample(connection_fraction=0.25, seed=7)
+
+        sessions = {(c.username, c.pid.strip()) for c in connections.values()}
+        self.assertEqual(3, sum(1 for username, _ in sessions if username == "alice"))
+        self.assertEqual(3, sum(1 for username, _ in sessions if username == "bob"))
+        # every transaction of a session kept is kept, and none of the others
+        queries = [query for queries in logs.values() for query in queries]
+        self.assertEqual(sessions, {(query.username, query.pid) for query in queries})
+        self.assertEqual(18, len(queries))
+
+        self.assertEqual(sessions, {(c.username, c.pid.strip()) for c in self.sample(
+            connection_fraction=0.25, seed=7, num_workers=2
+        )[0].values()})
+        self.assertNotEqual(sessions, {(c.username, c.pid.strip()) for c in self.sample(
+            connection_fraction=0.25, seed=8
+        )[0].values()})
+
+    def test_every_nth_transaction_is_kept(self):
+        connections, logs = self.sample(transaction_interval=5)
+
+        self.assertEqual(24, len(connections))
+        xids = {query.xid for queries in logs.values() for query in queries}
+        self.assertEqual({str(5000 + idx) for idx in range(0, 72, 5)}, xids)
+
+    def test_full_sample_matches_extraction(self):
+        connections, logs = self.sample(connection_fraction=1)
+        all_connections, all_logs, databases, last_connections = extract.get_local_logs(
+            self.log_directory, START_TIME, END_TIME
+        )
+
+        self.assertEqual(all_connections, connections)
+        self.assertEqual(all_logs, logs)
+
+
+class SyntheticWorkloadTests(unittest.TestCase):
+    def test_every_generated_transaction_is_extracted(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            written = write_synthetic_logs(tmp, connections=100, transactions_per_connection=5,
+                                           start_node_fraction=0.1, seed=3)
+            connections, logs, databases, last_connections = extract.get_local_logs(tmp, START_TIME, END_TIME)
+
+        self.assertEqual(4, written["start_node"]["files"])
+        self.assertEqual(100, len(connections))
+        self.assertEqual(500, len({query.xid for queries in logs.values() for query in queries}))
+        # JDBC duplicates are dropped
+        self.assertLess(sum(len(queries) for queries in logs.values()),
+                        written["useractivitylog"]["records"] + written["start_node"]["records"])
+
+
+class SessionIndexTests(unittest.TestCase):
+    def parse_connection_logs(self, directory, filenames, start_time=START_TIME, end_time=END_TIME):
+        connections = {}
+        last_connections = extract.SessionIndex()
+        for filename in filenames:
+            with gzip.open(f"{directory}/{filename}", "rb") as log_file:
+                extract.parse_log(log_file, filename, connections, last_connections, {}, set(), start_time,
+                                  end_time)
+        last_connections.resolve(connections, end_time)
+        return sorted(
+            (c.session_initiation_time, c.disconnection_time, c.application_name, c.username, c.pid.strip())
+            for c in connections.values()
+        )
+
+    def test_reused_pids_match_whatever_the_file_order(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            write_synthetic_logs(tmp, connections=300, transactions_per_connection=1, file_minutes=5,
+                                 pid_reuse=0.8, seed=5)
+            filenames = sorted(_ for _ in os.listdir(tmp) if "connectionlog" in _)
+            in_order = self.parse_connection_logs(tmp, filenames)
+            reversed_order = self.parse_connection_logs(tmp, filenames[::-1])
+            shuffled = self.parse_connection_logs(tmp, random.Random(5).sample(filenames, len(filenames)))
+            # sessions starting before the extraction, and disconnecting after it
+            window = (START_TIME + datetime.timedelta(minutes=10), END_TIME - datetime.timedelta(minutes=7))
+            window_in_order = self.parse_connection_logs(tmp, filenames, *window)
+            window_shuffled = self.parse_connection_logs(
+                tmp, random.Random(6).sample(filenames, len(filenames)), *window
+            )
+
+        self.assertEqual(300, len(in_order))
+        self.assertEqual(in_order, reversed_order)
+        self.assertEqual(in_order, shuffled)
+        self.assertIn(window[0], [_[0] for _ in window_in_order])
+        self.assertEqual(window_in_order, window_shuffled)
+
+    def test_disconnection_before_the_extraction_starts_a_session(self):
+        last_connections = extract.SessionIndex()
+        connections = {}
+        minute = datetime.timedelta(minutes=1)
+        for event, event_time in (("disconnecting session ", START_TIME + minute),
+                                  ("initiating session ", START_TIME + 2 * minute),
+                                  ("disconnecting session ", START_TIME + 3 * minute)):
+            extract.add_connection_event((event, event_time, "dev", "alice", "1000", ""), connections,
+                                         last_connections, START_TIME, END_TIME)
+
+        self.assertEqual(
+            [(START_TIME, START_TIME + minute), (START_TIME + 2 * minute, START_TIME + 3 * minute)],
+            sorted((c.session_initiation_time, c.disconnection_time) for c in connections.values()),
+        )
+
+
+class ExtractionStagesTests(unittest.TestCase):
+    def setUp(self):
+        self.stages = mock.patch.object(extract, "g_stages", extract.ExtractionStages())
+        self.stages.start()
+
+    def tearDown(self):
+        self.stages.stop()
+
+    def test_stages_of_serial_and_parallel_extractions_agree(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            written = write_synthetic_logs(tmp, connections=50, transactions_per_connection=4, seed=1)
+            extract.get_local_logs(tmp, START_TIME, END_TIME, 1)
+            serial = extract.g_stages.stages
+            extract.g_stages = extract.ExtractionStages()
+            extract.get_local_logs(tmp, START_TIME, END_TIME, 2)
+            parallel = extract.g_stages.stages
+
+        decompressed_bytes = sum(_["bytes"] for _ in written.values())
+        records = serial["parse"]["records"]
+        self.assertGreater(records, 0)
+        for stages in (serial, parallel):
+            # the padding records written at the end of each file are read too
+            self.assertGreaterEqual(stages["decompress"]["bytes"], decompressed_bytes)
+            self.assertEqual(serial["decompress"]["bytes"], stages["decompress"]["bytes"])
+            self.assertEqual(records, stages["parse"]["records"])
+            self.assertGreater(stages["parse"]["wall_time"], 0)
+        self.assertEqual(records, parallel["merge"]["records"])
+
+    def test_summary_is_saved_with_the_workload(self):
+        extract.g_stages.add("parse", wall_time=2.0, cpu_time=1.5, bytes=4 * 1024 * 1024, records=1000)
+        with extract.g_stages.measure("save_logs") as stage:
+            stage["records"] = 10
+        with tempfile.TemporaryDirectory() as tmp:
+            extract.g_stages.save(tmp)
+            with open(f"{tmp}/{extract.ExtractionStages.filename}") as fp:
+                stages = json.load(fp)["stages"]
+
+        self.assertEqual(["parse", "save_logs"], list(stages))
+        self.assertEqual(2.0, stages["parse"]["mb_per_second"])
+        self.assertEqual(500, stages["parse"]["records_per_second"])
+        self.assertEqual(10, stages["save_logs"]["records"])
+
+
+class GetTransactionsTests(unittest.TestCase):
+    def query(self, xid, record_time):
+        log = extract.Log()
+        log.record_time, log.database_name, log.username, log.pid, log.xid = record_time, "dev", "bob", "1000", xid
+        log.start_time = log.end_time = None
+        log.text = f"select {xid}"
+        return log
+
+    def test_transactions_without_queries_are_skipped(self):
+        # queries without a record time are missing their header
+        logs = {
+            "missing": [self.query("1", "")],
+            "partial": [self.query("2", START_TIME), self.query("2", "")],
+            "missing first": [self.query("3", ""), self.query("3", START_TIME)],
+        }
+        with self.assertLogs("SimpleReplayLogger", level="ERROR") as logs_output:
+            transactions = list(extract.get_transactions(logs, {("dev", "bob", "1000")}, set(), set()))
+        self.assertEqual(3, len(logs_output.output))
+        self.assertEqual([("2", ["select 2;"]), ("3", ["select 3;"])],
+                         [(t["xid"], [q["text"] for q in t["queries"]]) for t in transactions])
+
+
+class IncrementalExtractionTests(unittest.TestCase):
+    # just after the reused pid starts a session, before the queries of the second activity file
+    split_time = START_TIME + datetime.timedelta(minutes=21, microseconds=500000)
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.log_directory = f"{self.tmp.name}/logs"
+        os.mkdir(self.log_directory)
+        write_workload_logs(self.log_directory)
+        self.opened_files = []
+        open_log_file = extract.open_log_file
+
+        def record_open_log_file(location, content=None):
+            self.opened_files.append(os.path.basename(location))
+            return open_log_file(location, content)
+
+        self.open_log_file = mock.patch.object(extract, "open_log_file", side_effect=record_open_log_file)
+        self.open_log_file.start()
+
+    def tearDown(self):
+        self.open_log_file.stop()
+        self.tmp.cleanup()
+
+    def extract_incremental(self, workload, end_time):
+        """ Extract up to end_time into workload, continuing the previous extraction like main() """
+        self.opened_files = []
+        manifest = extract.ExtractionManifest.load(workload)
+        resumed = manifest is not None
+        start_time = START_TIME
+        if resumed:
+            start_time = manifest.end_time + datetime.timedelta(microseconds=1)
+        else:
+            manifest = extract.ExtractionManifest()
+        connections, logs, databases, last_connections = extract.get_logs(
+            self.log_directory, start_time, end_time, None, manifest
+        )
+        extract.save_logs(logs, last_connections, workload, connections, start_time, end_time, append=resumed,
+                          workload_format="json")
+        manifest.save(workload)
+
+    def load_workload(self, workload):
+        with gzip.open(f"{workload}/SQLs.json.gz", "rb") as fp:
+            transactions = json.load(fp)["transactions"]
+        with open(f"{workload}/connections.json") as fp:
+            connections = json.load(fp)
+        return transactions, connections
+
+    def test_incremental_workload_matches_single_extraction(self):
+        single = f"{self.tmp.name}/single"
+        connections, logs, databases, last_connections = extract.get_local_logs(self.log_directory, START_TIME, END_TIME)
+        extract.save_logs(logs, last_connections, single, connections, START_TIME, END_TIME, workload_format="json")
+        single_transactions, single_connections = self.load_workload(single)
+
+        incremental = f"{self.tmp.name}/incremental"
+        self.extract_incremental(incremental, self.split_time)
+        first_transactions, _ = self.load_workload(incremental)
+        self.extract_incremental(incremental, END_TIME)
+        transactions, connections = self.load_workload(incremental)
+
+        self.assertLess(len(first_transactions), len(transactions))
+        self.assertEqual(single_transactions, transactions)
+
+        # sessions open at the end of the first extraction are continued by the second one. Only
+        # the sessions made up for queries first seen after the split start later
+        def sessions(connections):
+            return sorted(
+                (c["username"], c["pid"], c["session_initiation_time"], c["disconnection_time"], c["application_name"])
+                for c in connections
+            )
+        resumed_time = str(self.split_time + datetime.timedelta(microseconds=1))
+        made_up = [session for session in sessions(connections) if session[2] == resumed_time]
+        self.assertEqual(["carol", "dave"], [session[0] for session in made_up])
+        self.assertEqual(
+            [s for s in sessions(single_connections) if (s[0], s[1], s[2]) not in {(m[0], m[1], str(START_TIME)) for m in made_up}],
+            [s for s in sessions(connections) if s not in made_up],
+        )
+
+    def test_only_new_files_are_parsed(self):
+        incremental = f"{self.tmp.name}/incremental"
+        self.extract_incremental(incremental, self.split_time)
+        self.assertEqual(6, len(self.opened_files))
+
+        # the files starting at 20:00 are followed by files starting before the split
+        self.extract_incremental(incremental, END_TIME)
+        self.assertEqual(4, len(self.opened_files))
+        self.assertFalse(any("T20:00" in filename for filename in self.opened_files))
+
+    def test_manifest_round_trip(self):
+        manifest = extract.ExtractionManifest()
+        extract.get_local_logs(self.log_directory, START_TIME, self.split_time, None, manifest)
+        manifest.end_time = self.split_time
+        manifest.last_queries = {"q": extract.Log()}
+        manifest.last_queries["q"].record_time = self.split_time.replace(microsecond=0)
+        manifest.last_queries["q"].text = "select 1;"
+
+        loaded = extract.ExtractionManifest.from_json(manifest.to_json())
+        self.assertEqual(manifest.end_time, loaded.end_time)
+        self.assertEqual(manifest.processed_files, loaded.processed_files)
+        self.assertEqual(manifest.databases, loaded.databases)
+        self.assertEqual(manifest.connections, loaded.connections)
+        self.assertEqual(manifest.last_connections.sessions, loaded.last_connections.sessions)
+        self.assertEqual(list(manifest.last_queries.values()), list(loaded.last_queries.values()))
+
+
+class S3PrefetchTests(unittest.TestCase):
+    bucket = "audit-logs"
+    prefix = "AWSLogs/123456789012/redshift/us-east-1/2021/09/02/"
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.env = mock.patch.dict(os.environ, {"AWS_ACCESS_KEY_ID": "testing", "AWS_SECRET_ACCESS_KEY": "testing",
+                                                "AWS_DEFAULT_REGION": "us-east-1"})
+        self.env.start()
+        self.mock_aws = mock_aws()
+        self.mock_aws.start()
+
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket=self.bucket)
+        log_directory = f"{self.tmp.name}/logs"
+        os.mkdir(log_directory)
+        for path in write_workload_logs(log_directory):
+            s3.upload_file(path, self.bucket, self.prefix + os.path.basename(path))
+
+    def tearDown(self):
+        self.mock_aws.stop()
+        self.env.stop()
+        self.tmp.cleanup()
+        extract.g_config = {}
+
+    def extract_workload(self, name, **config):
+        extract.g_config = config
+        parsed_logs = extract.get_s3_logs(self.bucket, self.prefix, START_TIME, END_TIME)
+        return save_workload(f"{self.tmp.name}/{name}", parsed_logs)
+
+    def test_prefetch_output_is_identical_to_streaming(self):
+        streaming = self.extract_workload("streaming", log_download_concurrency=1)
+        self.assertEqual(streaming, self.extract_workload("prefetch", log_download_concurrency=3))
+        self.assertEqual(streaming, self.extract_workload("capped", log_download_concurrency=3,
+                                                          log_download_max_mb=1e-6))
+
+    def test_prefetch_is_bounded_and_ordered(self):
+        locations = [f"s3://{self.bucket}/key{idx}" for idx in range(10)]
+        sizes = {location: 100 for location in locations}
+        in_flight = []
+
+        def download_log_file(s3_client, location):
+            in_flight.append(location)
+            return location.encode("utf-8")
+
+        with mock.patch.object(extract, "download_log_file", download_log_file):
+            for idx, (location, content) in enumerate(extract.prefetch_log_files(None, locations, sizes, 3, 250)):
+                self.assertEqual(locations[idx], location)
+                self.assertEqual(location.encode("utf-8"), content)
+                # the memory cap allows two files ahead of the one being parsed
+                self.assertLessEqual(len(in_flight), idx + 2)
+
+
+class S3MultipartUploadTests(unittest.TestCase):
+    bucket = "workloads"
+
+    def setUp(self):
+        self.env = mock.patch.dict(os.environ, {"AWS_ACCESS_KEY_ID": "testing", "AWS_SECRET_ACCESS_KEY": "testing",
+                                                "AWS_DEFAULT_REGION": "us-east-1"})
+        self.env.start()
+        self.mock_aws = mock_aws()
+        self.mock_aws.start()
+        self.s3 = boto3.client("s3")
+        self.s3.create_bucket(Bucket=self.bucket)
+
+    def tearDown(self):
+        self.mock_aws.stop()
+        self.env.stop()
+
+    def read_object(self, key):
+        return self.s3.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+
+    def test_parts_are_uploaded_as_they_fill(self):
+        part_size = 5 * 1024 * 1024
+        content = os.urandom(2 * part_size + 1000)
+        upload = extract.S3MultipartUpload(self.s3, self.bucket, "big", part_size=part_size, max_pending_parts=1)
+        with upload:
+            for idx in range(0, len(content), 1024 * 1024):
+                upload.write(content[idx:idx + 1024 * 1024])
+                # nothing is held back beyond the part being filled
+                self.assertLess(len(upload.buffer), part_size)
+            self.assertEqual(2, len(upload.parts) + len(upload.pending))
+
+        self.assertEqual(content, self.read_object("big"))
+        self.assertEqual([1, 2, 3], [part["PartNumber"] for part in upload.parts])
+
+    def test_small_file_is_put(self):
+        with extract.S3MultipartUpload(self.s3, self.bucket, "small") as upload:
+            upload.write(b"small")
+        self.assertIsNone(upload.upload_id)
+        self.assertEqual(b"small", self.read_object("small"))
+
+    def test_upload_is_aborted_on_error(self):
+        part_size = 5 * 1024 * 1024
+        with self.assertRaises(RuntimeError):
+            with extract.S3MultipartUpload(self.s3, self.bucket, "failed", part_size=part_size) as upload:
+                upload.write(os.urandom(part_size))
+                raise RuntimeError()
+        self.assertNotIn("Contents", self.s3.list_objects_v2(Bucket=self.bucket))
+        self.assertNotIn("Uploads", self.s3.list_multipart_uploads(Bucket=self.bucket))
+
+    def test_existing_object_is_copied(self):
+        part_size = 5 * 1024 * 1024
+        content = os.urandom(part_size + 1000)
+        self.s3.put_object(Bucket=self.bucket, Key="big", Body=content)
+        upload = extract.S3MultipartUpload(self.s3, self.bucket, "big", part_size=part_size)
+        with mock.patch.object(self.s3, "get_object", side_effect=AssertionError("downloaded")), upload:
+            upload.copy_object("big")
+            upload.write(b"appended")
+        self.assertEqual(content + b"appended", self.read_object("big"))
+        self.assertEqual([1, 2], [part["PartNumber"] for part in upload.parts])
+
+        # an object smaller than a part can't be a part of its own
+        self.s3.put_object(Bucket=self.bucket, Key="small", Body=b"small")
+        with extract.S3MultipartUpload(self.s3, self.bucket, "small", part_size=part_size) as upload:
+            upload.copy_object("small")
+            upload.write(b" appended")
+        self.assertIsNone(upload.upload_id)
+        self.assertEqual(b"small appended", self.read_object("small"))
+
+    def test_workload_is_streamed_to_s3(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.mkdir(f"{tmp}/logs")
+            write_workload_logs(f"{tmp}/logs")
+            local_sqls, local_connections = save_workload(
+                f"{tmp}/local", extract.get_local_logs(f"{tmp}/logs", START_TIME, END_TIME)
+            )
+            connections, logs, databases, last_connections = extract.get_local_logs(f"{tmp}/logs", START_TIME, END_TIME)
+            with mock.patch.object(extract.gzip, "open", side_effect=AssertionError("no local archive")):
+                extract.save_logs(logs, last_connections, f"s3://{self.bucket}/workload", connections, START_TIME, END_TIME)
+
+        self.assertEqual(local_sqls, gzip.decompress(self.read_object("workload/SQLs.ndjson.gz")))
+        self.assertEqual(local_connections, self.read_object("workload/connections.json"))
+
+
+class BlockGzipFileTests(unittest.TestCase):
+    def tearDown(self):
+        extract.g_config = {}
+
+    def test_blocks_decode_as_one_file(self):
+        rng = random.Random(0)
+        content = "".join(
+            json.dumps({"xid": idx, "text": f"select * from orders where id = {rng.randrange(10 ** 6)};"}) + "\n"
+            for idx in range(20000)
+        ).encode("utf-8")
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(f"{tmp}/SQLs.ndjson.gz", "wb") as fp:
+                with extract.BlockGzipFile(fp, compresslevel=6, threads=3, block_size=64 * 1024) as block_gzip:
+                    for idx in range(0, len(content), 10000):
+                        block_gzip.write(content[idx:idx + 10000])
+                self.assertFalse(fp.closed)
+            with open(f"{tmp}/SQLs.ndjson.gz", "rb") as fp:
+                compressed = fp.read()
+            ndjson = list(util.retrieve_compressed_ndjson(f"{tmp}/SQLs.ndjson.gz"))
+
+        self.assertEqual(content, gzip.decompress(compressed))
+        self.assertEqual([json.loads(line) for line in content.splitlines()], ndjson)
+        members = 0
+        while compressed:
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            decompressor.decompress(compressed)
+            compressed = decompressor.unused_data
+            members += 1
+        self.assertEqual(-(-len(content) // (64 * 1024)), members)
+
+    def test_workload_is_identical_with_threads(self):
+        def save_json_workload(output_directory):
+            connections, logs, databases, last_connections = extract.get_local_logs(
+                f"{tmp}/logs", START_TIME, END_TIME
+            )
+            extract.save_logs(logs, last_connections, output_directory, connections, START_TIME, END_TIME,
+                              workload_format="json")
+            return util.retrieve_compressed_json(f"{output_directory}/SQLs.json.gz")
+
+        with tempfile.TemporaryDirectory() as tmp:
+            os.mkdir(f"{tmp}/logs")
+            write_synthetic_logs(f"{tmp}/logs", connections=50, transactions_per_connection=10)
+            single = save_workload(f"{tmp}/single", extract.get_local_logs(f"{tmp}/logs", START_TIME, END_TIME))
+            single_json = save_json_workload(f"{tmp}/single_json")
+
+            extract.g_config = {"workload_compression_level": 1, "workload_compression_threads": 4}
+            with mock.patch.object(extract, "g_compress_block_size", 16 * 1024):
+                blocks = save_workload(f"{tmp}/blocks", extract.get_local_logs(f"{tmp}/logs", START_TIME, END_TIME))
+                blocks_json = save_json_workload(f"{tmp}/blocks_json")
+
+        self.assertEqual(single, blocks)
+        self.assertEqual(single_json, blocks_json)
+
+
+class S3LogListingTests(unittest.TestCase):
+    bucket = "audit-logs"
+
+    def setUp(self):
+        self.env = mock.patch.dict(os.environ, {"AWS_ACCESS_KEY_ID": "testing", "AWS_SECRET_ACCESS_KEY": "testing",
+                                                "AWS_DEFAULT_REGION": "us-east-1"})
+        self.env.start()
+        self.mock_aws = mock_aws()
+        self.mock_aws.start()
+        self.s3 = boto3.client("s3")
+        self.s3.create_bucket(Bucket=self.bucket)
+
+    def tearDown(self):
+        self.mock_aws.stop()
+        self.env.stop()
+
+    def put_logs(self, key_format, days):
+        keys = []
+        for day in days:
+            for hour in (0, 12, 23):
+                file_time = datetime.datetime(2021, 9, day, hour, 0)
+                for log_type in ("connectionlog", "useractivitylog"):
+                    key = key_format.format(file_time=file_time, log_type=log_type)
+                    self.s3.put_object(Bucket=self.bucket, Key=key, Body=b"")
+                    keys.append(key)
+        return sorted(keys)
+
+    def list_keys(self, prefix, start_time, end_time):
+        logs = extract.list_s3_log_objects(self.s3, self.bucket, prefix, start_time, end_time)
+        return [log["Key"] for log in logs]
+
+    def test_lists_days_in_window(self):
+        key_format = "cluster-logs/AWSLogs/123456789012/redshift/{region}/{file_time:%Y/%m/%d}/" \
+                     "123456789012_redshift_{region}_c_{log_type}_{file_time:%Y-%m-%dT%H:%M}.gz"
+        keys = []
+        for region in ("eu-west-1", "us-east-1"):
+            keys += self.put_logs(key_format.replace("{region}", region), range(1, 11))
+        keys.sort()
+
+        start_time = datetime.datetime(2021, 9, 4, 10, 0, tzinfo=datetime.timezone.utc)
+        end_time = datetime.datetime(2021, 9, 5, 10, 0, tzinfo=datetime.timezone.utc)
+        expected = [key for key in keys if any(f"/2021/09/0{day}/" in key for day in (3, 4, 5, 6))]
+
+        for prefix in ("cluster-logs/", "cluster-logs/AWSLogs/123456789012/",
+                       "cluster-logs/AWSLogs/123456789012/redshift/"):
+            self.assertEqual(expected, self.list_keys(prefix, start_time, end_time))
+        self.assertEqual([key for key in expected if "us-east-1" in key],
+                         self.list_keys("cluster-logs/AWSLogs/123456789012/redshift/us-east-1/", start_time, end_time))
+
+        # without an end time, everything is listed
+        self.assertEqual(keys, self.list_keys("cluster-logs/", start_time, ""))
+
+    def test_falls_back_to_full_listing(self):
+        keys = self.put_logs("flat/123456789012_redshift_us-east-1_c_{log_type}_{file_time:%Y-%m-%dT%H:%M}.gz",
+                             range(1, 11))
+        start_time = datetime.datetime(2021, 9, 4, 10, 0, tzinfo=datetime.timezone.utc)
+        end_time = datetime.datetime(2021, 9, 5, 10, 0, tzinfo=datetime.timezone.utc)
+        self.assertEqual(keys, self.list_keys("flat/", start_time, end_time))
+
+
+class GetLogsInRangeTests(unittest.TestCase):
+    start_time = datetime.datetime(2021, 9, 2, 20, 0, tzinfo=datetime.timezone.utc)
+    end_time = datetime.datetime(2021, 9, 2, 21, 0, tzinfo=datetime.timezone.utc)
+
+    @staticmethod
+    def key(timestamp, cluster="c"):
+        return f"AWSLogs/123/redshift/us-east-1/2021/09/02/123_redshift_us-east-1_{cluster}_useractivitylog_{timestamp}.gz"
+
+    def in_range(self, timestamps, start_time=None, end_time=None):
+        audit_objects = [{"Key": self.key(*_) if isinstance(_, tuple) else self.key(_)} for _ in timestamps]
+        return extract.get_logs_in_range(audit_objects, start_time or self.start_time, end_time or self.end_time)
+
+    def test_pads_window_with_one_file_either_side(self):
+        timestamps = ["2021-09-02T19:00", "2021-09-02T19:30", "2021-09-02T20:00", "2021-09-02T20:30",
+                      "2021-09-02T21:00", "2021-09-02T21:30", "2021-09-02T22:00"]
+        self.assertEqual([self.key(_) for _ in timestamps[1:6]], self.in_range(timestamps))
+
+    def test_out_of_order_listing(self):
+        timestamps = ["2021-09-02T21:30", "2021-09-02T20:30", "2021-09-02T19:00", "2021-09-02T22:00",
+                      "2021-09-02T19:30", "2021-09-02T20:10"]
+        expected = ["2021-09-02T19:30", "2021-09-02T20:10", "2021-09-02T20:30", "2021-09-02T21:30"]
+        self.assertEqual([self.key(_) for _ in expected], self.in_range(timestamps))
+
+    def test_shared_timestamps(self):
+        timestamps = [("2021-09-02T19:00", "b"), ("2021-09-02T19:30", "b"), ("2021-09-02T19:30", "a"),
+                      ("2021-09-02T20:30", "b"), ("2021-09-02T20:30", "a"), ("2021-09-02T21:30", "a"),
+                      ("2021-09-02T21:30", "b"), ("2021-09-02T22:00", "a")]
+        expected = [("2021-09-02T19:30", "a"), ("2021-09-02T19:30", "b"), ("2021-09-02T20:30", "a"),
+                    ("2021-09-02T20:30", "b"), ("2021-09-02T21:30", "a"), ("2021-09-02T21:30", "b")]
+        self.assertEqual([self.key(*_) for _ in expected], self.in_range(timestamps))
+
+    def test_window_boundaries_are_inclusive(self):
+        timestamps = ["2021-09-02T19:00", "2021-09-02T20:00", "2021-09-02T21:00", "2021-09-02T22:00"]
+        self.assertEqual([self.key(_) for _ in timestamps], self.in_range(timestamps))
+
+    def test_open_window(self):
+        timestamps = ["2021-09-02T21:00", "2021-09-02T19:00", "2021-09-02T20:00"]
+        self.assertEqual([self.key(_) for _ in sorted(timestamps)],
+                         extract.get_logs_in_range([{"Key": self.key(_)} for _ in timestamps], "", ""))
+
+    def test_no_files_in_window(self):
+        self.assertEqual([], self.in_range(["2021-09-02T19:00", "2021-09-02T22:00"]))
+        self.assertEqual([], self.in_range([]))
+
+
+def has_problem_keyword_reference(text):
+    """ The keyword checks of is_valid_log before the single pass matcher """
+    problem_keywords = [
+        "SPECTRUM INTERNAL QUERY", "context: SQL", "ERROR:", "CONTEXT:  SQL", "show ", "Undoing transaction",
+        "Undo on", "pg_terminate_backend", "pg_cancel_backend", "volt_", "pg_temp_",
+    ]
+    return any(word in text for word in problem_keywords) or ("BIND" in text and "BINDING" not in text)
+
+
+class ProblemKeywordTests(unittest.TestCase):
+    def test_agrees_with_reference(self):
+        # pieces of keywords, so the texts have near misses, overlaps and repeats
+        fragments = [" ", "\n", ";", "select 1", "BIND", "BINDING", "BINDIN", "BINDINGS", "IND", "ING"]
+        for word in extract.g_problem_keywords:
+            fragments.extend([word, word[:len(word) // 2], word[len(word) // 2:], word[:-1], word[1:]])
+
+        rng = random.Random(0)
+        for _ in range(20000):
+            text = "".join(rng.choice(fragments) for _ in range(rng.randint(0, 8)))
+            self.assertEqual(has_problem_keyword_reference(text), extract.has_problem_keyword(text), repr(text))
+
+    def test_bind(self):
+        self.assertTrue(extract.has_problem_keyword("BIND s1"))
+        self.assertFalse(extract.has_problem_keyword("BINDING"))
+        self.assertFalse(extract.has_problem_keyword("BIND s1; BINDING"))
+        self.assertTrue(extract.has_problem_keyword("BINDING; show search_path"))
+        self.assertFalse(extract.has_problem_keyword("select 'show'"))
+
+
+def remove_line_comments_reference(query):
+    """ remove_line_comments before the single pass lexer """
+    removed_string = query
+    prev_location = 0
+    while True:
+        line_comment_begin = removed_string.find('--', prev_location)
+        prev_location = line_comment_begin
+        if line_comment_begin == -1:
+            break
+        linebreak = removed_string.find('\n', line_comment_begin)
+        start_comment = removed_string.find('/*', line_comment_begin, linebreak if linebreak != -1 else len(removed_string))
+        end_comment = removed_string.find('*/', line_comment_begin, linebreak if linebreak != -1 else len(removed_string))
+        if linebreak != -1:
+            if start_comment == -1 and end_comment != -1:
+                removed_string = removed_string[:line_comment_begin] + removed_string[end_comment:]
+            else:
+                removed_string = removed_string[:line_comment_begin] + removed_string[linebreak:]
+        else:
+            if start_comment == -1 and end_comment != -1:
+                removed_string = removed_string[:line_comment_begin] + removed_string[end_comment:]
+            else:
+                removed_string = removed_string[:line_comment_begin]
+    return removed_string
+
+
+def is_duplicate_reference(first_query_text, second_query_text):
+    """ is_duplicate before query fingerprints, except that the leading comment of the first query
+        is removed using its own end rather than the end of the comment of the second query """
+    dedupe_these = ["set", "select", "create", "delete", "update", "insert", "copy", "unload", "with"]
+    first_query_text = first_query_text.strip()
+    second_query_text = second_query_text.strip()
+    first_query_text_no_semi = first_query_text.replace(";", "")
+    second_query_tex_no_semi = second_query_text.replace(";", "")
+    second_query_comment_removed = second_query_text
+    first_query_comment_removed = first_query_text
+    if second_query_text.startswith("/*"):
+        second_query_comment_removed = second_query_text[second_query_text.find('*/')+2:len(second_query_text)].strip()
+    if first_query_text.startswith("/*"):
+        first_query_comment_removed = first_query_text[first_query_text.find('*/')+2:len(first_query_text)].strip()
+    return (
+        (
+                first_query_text_no_semi == second_query_tex_no_semi
+                and any(second_query_comment_removed.startswith(word) for word in dedupe_these)
+        ) or ((second_query_comment_removed.lower().startswith('create')) and (first_query_comment_removed.lower().startswith('create')) and second_query_comment_removed.endswith(';'))
+        or ((second_query_comment_removed.lower().startswith('drop')) and (first_query_comment_removed.lower().startswith('drop')) and second_query_comment_removed.endswith(';'))
+        or ((second_query_comment_removed.lower().startswith('alter')) and (first_query_comment_removed.lower().startswith('alter')) and second_query_comment_removed.endswith(';'))
+    )
+
+
+class SqlLexerTests(unittest.TestCase):
+    fragments = ["select", " 1", "\n", " ", "-", "--", "---", " -- note", "/*", "*/", "/* c */", "*", "/",
+                 ";", "a", "\\"]
+    # literals and identifiers without comment tokens or line breaks in them
+    quoted_fragments = ["'x'", "'it''s'", "'a\\'b'", "''", '"col"', '"a""b"', "'*'", "'-'"]
+
+    def random_text(self, rng, fragments, max_fragments=12):
+        return "".join(rng.choice(fragments) for _ in range(rng.randint(0, max_fragments)))
+
+    def test_matches_reference_without_quotes(self):
+        rng = random.Random(0)
+        for _ in range(20000):
+            text = self.random_text(rng, self.fragments)
+            self.assertEqual(remove_line_comments_reference(text), extract.remove_line_comments(text), repr(text))
+
+    def test_matches_reference_with_safe_quotes(self):
+        rng = random.Random(1)
+        for _ in range(20000):
+            text = self.random_text(rng, self.fragments + self.quoted_fragments)
+            self.assertEqual(remove_line_comments_reference(text), extract.remove_line_comments(text), repr(text))
+
+    def test_quoted_text_is_kept(self):
+        self.assertEqual("select '--x' \n, 1", extract.remove_line_comments("select '--x' -- c\n, 1"))
+        self.assertEqual("select 'it''s -- no' ", extract.remove_line_comments("select 'it''s -- no' -- yes"))
+        self.assertEqual("select 'a\\'--b' ", extract.remove_line_comments("select 'a\\'--b' --c"))
+        self.assertEqual('select "a--b" ', extract.remove_line_comments('select "a--b" -- c'))
+        # quotes in comments don't start a literal
+        self.assertEqual("/* don't */ select 1 ", extract.remove_line_comments("/* don't -- */ select 1 -- x"))
+        self.assertEqual("select 1 \n, 'a'", extract.remove_line_comments("select 1 -- it's\n, 'a'"))
+
+    def test_is_duplicate_matches_reference(self):
+        fragments = ["select 1", "SELECT 1", "create table t", "CREATE", "drop", "Alter", "fetch next from c",
+                     "insert", "with", "set", "/* c */", "/*", "*/", " ", "\n", ";", "x", "\u0130", "\u03a3"]
+        rng = random.Random(2)
+        texts = [self.random_text(rng, fragments, 5) for _ in range(300)]
+        for first in texts:
+            for second in rng.sample(texts, 30) + [first, first + ";", " " + first]:
+                self.assertEqual(is_duplicate_reference(first, second), extract.is_duplicate(first, second),
+                                 repr((first, second)))
+
+    def test_hash_collision_is_not_a_duplicate(self):
+        with mock.patch.object(extract, "hash", lambda text: 0, create=True):
+            self.assertTrue(extract.is_duplicate("select 1;", "select 1"))
+            self.assertFalse(extract.is_duplicate("select 1;", "select 2"))
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+        self.fetch_sizes = []
+
+    def execute(self, query):
+        self.query = query
+
+    def fetchmany(self, size):
+        self.fetch_sizes.append(size)
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+
+class FakeConnection:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def cursor(self):
+        return FakeCursor(list(self.rows))
+
+
+def statement_text_row(start_time, pid, xid, text, sequence=0):
+    """ A SVL_STATEMENTTEXT row as returned by the driver, without time zone """
+    start_time = start_time.replace(tzinfo=None)
+    return (start_time, start_time + datetime.timedelta(seconds=1), 100, pid, xid, text, sequence)
+
+
+class StatementTextTests(unittest.TestCase):
+    def retrieve(self, rows_by_database):
+        @contextlib.contextmanager
+        def initiate_connection(cluster_urls, interface, database_name):
+            yield FakeConnection(rows_by_database[database_name])
+
+        with mock.patch.object(extract, "initiate_connection", initiate_connection), \
+                mock.patch.object(extract, "g_statement_text_fetch_size", 3):
+            return extract.retrieve_source_cluster_statement_text(
+                {}, list(rows_by_database), START_TIME, END_TIME, "psql"
+            )
+
+    def audit_log(self, record_time, pid, xid, text):
+        log = extract.Log()
+        log.record_time = record_time
+        log.pid = str(pid)
+        log.xid = str(xid)
+        log.text = text
+        return log
+
+    def test_every_chunk_is_read_and_fragments_are_joined(self):
+        query_time = START_TIME + datetime.timedelta(minutes=1, microseconds=250)
+        rows = [statement_text_row(query_time, 1001, 500 + idx, f"select {idx};") for idx in range(7)]
+        # a continued fragment of a statement started before the window
+        rows.insert(0, statement_text_row(query_time, 1001, 499, "tail", sequence=1))
+        rows.extend([
+            statement_text_row(query_time, 1002, 600, "select 'a long"),
+            statement_text_row(query_time, 1002, 600, " statement';", sequence=1),
+        ])
+
+        statement_text_logs = self.retrieve({"dev": rows, "prod": rows[:4]})
+
+        self.assertEqual({(str(500 + idx), "1001") for idx in range(7)} | {("600", "1002")},
+                         set(statement_text_logs))
+        (long_statement,) = statement_text_logs[("600", "1002")][query_time.replace(microsecond=0)]
+        self.assertEqual("select 'a long statement';", long_statement.text)
+        self.assertEqual(query_time, long_statement.start_time)
+        self.assertEqual(2, len(statement_text_logs[("502", "1001")][query_time.replace(microsecond=0)]))
+        self.assertEqual({"dev", "prod"}, {
+            _.database_name for _ in statement_text_logs[("502", "1001")][query_time.replace(microsecond=0)]
+        })
+
+    def test_combine_logs_matches_statements_by_start_second(self):
+        first_time = START_TIME + datetime.timedelta(seconds=10, microseconds=100)
+        second_time = START_TIME + datetime.timedelta(seconds=20, microseconds=200)
+        late_time = START_TIME + datetime.timedelta(seconds=31, microseconds=300)
+        statement_text_logs = self.retrieve({"dev": [
+            statement_text_row(first_time, 1001, 500, "select 1;"),
+            statement_text_row(second_time, 1001, 500, "select 1;"),
+            statement_text_row(second_time, 1001, 500, "select 2;"),
+            statement_text_row(late_time, 1001, 500, "select 3;"),
+        ]})
+        queries = [
+            self.audit_log(START_TIME + datetime.timedelta(seconds=10), 1001, 500, "select 1;"),
+            self.audit_log(START_TIME + datetime.timedelta(seconds=20), 1001, 500, "select 2;\n"),
+            self.audit_log(START_TIME + datetime.timedelta(seconds=20), 1001, 500, "select 1;"),
+            self.audit_log(START_TIME + datetime.timedelta(seconds=30), 1001, 500, "select 3;"),
+            self.audit_log(START_TIME + datetime.timedelta(seconds=30), 1001, 500, "select 4;"),
+            self.audit_log(START_TIME + datetime.timedelta(seconds=30), 1002, 500, "select 3;"),
+        ]
+
+        extract.combine_logs({"500": queries}, statement_text_logs)
+
+        self.assertEqual([first_time, second_time, second_time, late_time, "", ""],
+                         [_.start_time for _ in queries])
+        self.assertEqual(late_time + datetime.timedelta(seconds=1), queries[3].end_time)
+        self.assertEqual({}, dict(statement_text_logs[("500", "1001")]))
+
+
+class ReadLinesTests(unittest.TestCase):
+    def test_matches_readlines(self):
+        text = "'2021-09-02T20:00:05Z UTC [ db=dev ]' LOG: select 1\r\nfrom t;\n\nselect 'é\r';\nlast line"
+        data = gzip.compress(text.encode("utf-8"))
+        expected = [line.decode("utf-8") for line in gzip.GzipFile(fileobj=io.BytesIO(data)).readlines()]
+
+        default_buffer_size = extract.g_read_buffer_size
+        try:
+            # a tiny buffer makes lines and multi-byte characters straddle reads
+            extract.g_read_buffer_size = 7
+            lines = list(extract.read_lines(gzip.GzipFile(fileobj=io.BytesIO(data))))
+        finally:
+            extract.g_read_buffer_size = default_buffer_size
+
+        self.assertEqual(expected, lines)
+
+
+class TimestampParsingTests(unittest.TestCase):
+    def test_audit_log_time_matches_dateutil(self):
+        for timestamp in ("2021-09-02T20:00:05Z", "2021-12-31T23:59:59Z", "2021-09-02 20:00:05 UTC"):
+            self.assertEqual(dateutil.parser.parse(timestamp), extract.parse_audit_log_time(timestamp))
+
+    def test_audit_log_time_falls_back_to_dateutil(self):
+        self.assertEqual(dateutil.parser.parse("2021-09-02T20:00:05.123+01:00"),
+                         extract.parse_audit_log_time("2021-09-02T20:00:05.123+01:00"))
+
+    def test_connection_log_time_matches_strptime(self):
+        for timestamp in ("Thu, 02 Sep 2021 20:16:34:123", "Fri, 3 Sep 2021 01:02:03:5",
+                          "Fri, 03 Dec 2021 01:02:03:123456"):
+            expected = datetime.datetime.strptime(timestamp, "%a, %d %b %Y %H:%M:%S:%f").replace(
+                tzinfo=datetime.timezone.utc
+            )
+            self.assertEqual(expected, extract.parse_connection_log_time(timestamp))
+
+    def test_connection_log_time_falls_back_to_strptime(self):
+        with self.assertRaises(ValueError):
+            extract.parse_connection_log_time("Thu, 02 Foo 2021 20:16:34:123")
+        with self.assertRaises(ValueError):
+            extract.parse_connection_log_time("Thu, 02 Sep 2021 20:16:34:1234567")
+
+    def test_log_filename_time(self):
+        for filename in ("123_redshift_us-east-1_c_useractivitylog_2021-09-02T20:16.gz",
+                         "123_redshift_us-east-1_c_connectionlog_2021-09-02T20:16:30.gz",
+                         "123_redshift_us-east-1_c_connectionlog_20210902T2016.gz"):
+            expected = dateutil.parser.parse(filename.split("_")[-1][:-3]).replace(tzinfo=datetime.timezone.utc)
+            self.assertEqual(expected, extract.parse_log_filename_time(filename))
+
+
+if __name__ == "__main__":
+    unittest.main()
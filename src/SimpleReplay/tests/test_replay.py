@@ -0,0 +1,697 @@
+import asyncio
+import datetime
+import gzip
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import extract
+import replay
+import util
+from benchmarks.synthetic_workload import USERS, write_synthetic_logs
+from tests.synthetic_logs import user_activity_log_record, write_log_file, write_workload_logs
+
+START_TIME = datetime.datetime(2021, 9, 2, 20, 0, tzinfo=datetime.timezone.utc)
+END_TIME = datetime.datetime(2021, 9, 2, 21, 0, tzinfo=datetime.timezone.utc)
+
+
+def setUpModule():
+    extract.logger = logging.getLogger("SimpleReplayLogger")
+    replay.logger = logging.getLogger("SimpleReplayLogger")
+
+
+def transaction_summary(transactions):
+    return [
+        (t.xid, t.pid, t.database_name, t.username, [(q.start_time, q.end_time, q.text) for q in t.queries])
+        for t in transactions
+    ]
+
+
+class ParseTransactionsTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.log_directory = f"{self.tmp.name}/logs"
+        os.mkdir(self.log_directory)
+        write_workload_logs(self.log_directory)
+        self.config = replay.g_config
+        replay.g_config = {"filters": {
+            "include": {f: ["*"] for f in replay.Transaction.supported_filters()},
+            "exclude": {f: [] for f in replay.Transaction.supported_filters()},
+        }}
+
+    def tearDown(self):
+        replay.g_config = self.config
+        self.tmp.cleanup()
+
+    def extract_workload(self, name, start_time=START_TIME, end_time=END_TIME, append=False, **kwargs):
+        workload = f"{self.tmp.name}/{name}"
+        connections, logs, databases, last_connections = extract.get_local_logs(
+            self.log_directory, start_time, end_time
+        )
+        extract.save_logs(logs, last_connections, workload, connections, start_time, end_time, append, **kwargs)
+        return workload
+
+    def test_ndjson_matches_legacy_json(self):
+        legacy = replay.parse_transactions(self.extract_workload("legacy", workload_format="json"))
+        ndjson = replay.parse_transactions(self.extract_workload("ndjson"))
+
+        self.assertTrue(os.path.exists(f"{self.tmp.name}/ndjson/SQLs.ndjson.gz"))
+        self.assertFalse(os.path.exists(f"{self.tmp.name}/ndjson/SQLs.json.gz"))
+        self.assertEqual(transaction_summary(legacy), transaction_summary(ndjson))
+        self.assertEqual(7, len(ndjson))
+
+    def test_json_members_are_streamed(self):
+        content = {
+            "version": [1, {"nested": "}"}],
+            "transactions": {
+                str(idx): {"xid": idx, "text": f"select '\u00e9\\\"{{' || {idx} -- {'x' * idx}", "time": 1.5e3}
+                for idx in range(200)
+            },
+            "count": 200,
+        }
+        path = f"{self.tmp.name}/SQLs.json.gz"
+        for indent in (None, 2):
+            with gzip.open(path, "wt", encoding="utf-8") as fp:
+                json.dump(content, fp, indent=indent, ensure_ascii=False)
+            # chunks much smaller than the values, which are split anywhere including within a character
+            members = list(util.retrieve_compressed_json_members(path, "transactions", chunk_size=7))
+            self.assertEqual(list(content["transactions"].items()), members)
+
+        # numbers at the top level of the members, split by the chunks anywhere within them
+        with gzip.open(path, "wt") as fp:
+            fp.write('{"transactions": {"1": 1.5e3, "2": "abc", "3": 12, "4": -0.25, "5": 123456, "6": 7}}')
+        for chunk_size in range(1, 8):
+            self.assertEqual(
+                [("1", 1.5e3), ("2", "abc"), ("3", 12), ("4", -0.25), ("5", 123456), ("6", 7)],
+                list(util.retrieve_compressed_json_members(path, "transactions", chunk_size=chunk_size)),
+            )
+
+        with gzip.open(path, "wt") as fp:
+            fp.write('{"transactions": {}, "count": 12}')
+        self.assertEqual([], list(util.retrieve_compressed_json_members(path, "transactions", chunk_size=3)))
+        with gzip.open(path, "wt") as fp:
+            fp.write('{"transactions": {"1": {"xid": 1}')
+        with self.assertRaises(json.JSONDecodeError):
+            list(util.retrieve_compressed_json_members(path, "transactions"))
+
+    def test_filters_are_applied_while_parsing(self):
+        workload = self.extract_workload("legacy", workload_format="json")
+        everything = replay.parse_transactions(workload)
+        replay.g_config["filters"]["exclude"]["username"] = ["bob"]
+
+        with mock.patch.object(replay, "parse_queries", wraps=replay.parse_queries) as parse_queries:
+            filtered = replay.parse_transactions(workload)
+        self.assertEqual(
+            transaction_summary([transaction for transaction in everything if transaction.username != "bob"]),
+            transaction_summary(filtered),
+        )
+        self.assertLess(len(filtered), len(everything))
+        self.assertEqual(len(filtered), parse_queries.call_count)
+
+    def test_text_table_matches_ndjson(self):
+        ndjson = replay.parse_transactions(self.extract_workload("ndjson"))
+        text_table = replay.parse_transactions(self.extract_workload("texts", workload_format="ndjson_texts"))
+
+        self.assertEqual(transaction_summary(ndjson), transaction_summary(text_table))
+        with gzip.open(f"{self.tmp.name}/texts/SQLs.ndjson.gz", "rt") as fp:
+            queries = [query for line in fp for query in json.loads(line)["queries"]]
+        with gzip.open(f"{self.tmp.name}/texts/SQL_texts.ndjson.gz", "rt") as fp:
+            texts = [json.loads(line) for line in fp]
+        self.assertNotIn("text", queries[0])
+        self.assertEqual(len(texts), len({text["id"] for text in texts}))
+        self.assertEqual({query["text_id"] for query in queries}, {text["id"] for text in texts})
+
+        # queries with the same text share the string
+        by_text = {}
+        for transaction in text_table:
+            for query in transaction.queries:
+                self.assertIs(by_text.setdefault(query.text, query.text), query.text)
+
+    def test_appended_text_table_keeps_texts_once(self):
+        split_time = START_TIME + datetime.timedelta(minutes=30)
+        single = replay.parse_transactions(self.extract_workload("single", workload_format="ndjson_texts"))
+        self.extract_workload("appended", end_time=split_time, workload_format="ndjson_texts")
+        appended = self.extract_workload("appended", start_time=split_time + datetime.timedelta(microseconds=1),
+                                         append=True, workload_format="ndjson_texts")
+
+        self.assertEqual(transaction_summary(single), transaction_summary(replay.parse_transactions(appended)))
+        with gzip.open(f"{appended}/SQL_texts.ndjson.gz", "rt") as fp:
+            text_ids = [json.loads(line)["id"] for line in fp]
+        self.assertEqual(len(text_ids), len(set(text_ids)))
+
+    def test_appended_transactions_are_merged(self):
+        # continue xid 502 after the split
+        later = START_TIME + datetime.timedelta(minutes=50)
+        write_log_file(self.log_directory, "useractivitylog", later, [
+            user_activity_log_record(later, "dev", "bob", 1002, 502, "close c1;"),
+            user_activity_log_record(later, "dev", "bob", 1002, 801, "select 'padding';"),
+        ])
+        single = replay.parse_transactions(self.extract_workload("single"))
+
+        split_time = START_TIME + datetime.timedelta(minutes=30)
+        self.extract_workload("appended", end_time=split_time)
+        appended = self.extract_workload("appended", start_time=split_time + datetime.timedelta(microseconds=1),
+                                         append=True)
+        with gzip.open(f"{appended}/SQLs.ndjson.gz", "rt") as fp:
+            self.assertLess(len(single), len(fp.readlines()))
+
+        self.assertEqual(transaction_summary(single), transaction_summary(replay.parse_transactions(appended)))
+
+
+class ShardedWorkloadTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.log_directory = f"{self.tmp.name}/logs"
+        write_synthetic_logs(self.log_directory, connections=60, transactions_per_connection=5, pid_reuse=0.5,
+                             seed=2)
+        self.config = replay.g_config
+        replay.g_config = {"filters": {
+            "include": {f: ["*"] for f in replay.Transaction.supported_filters()},
+            "exclude": {f: [] for f in replay.Transaction.supported_filters()},
+        }}
+
+    def tearDown(self):
+        replay.g_config = self.config
+        self.tmp.cleanup()
+
+    def extract_workload(self, name, **kwargs):
+        workload = f"{self.tmp.name}/{name}"
+        connections, logs, databases, last_connections = extract.get_local_logs(
+            self.log_directory, START_TIME, END_TIME
+        )
+        extract.save_logs(logs, last_connections, workload, connections, START_TIME, END_TIME, **kwargs)
+        return workload
+
+    def test_shards_match_ndjson(self):
+        ndjson = replay.parse_transactions(self.extract_workload("ndjson"))
+        # the few open files are closed and reopened as transactions are written out of order
+        with mock.patch.object(extract.WorkloadShards, "max_open_files", 2):
+            sharded = self.extract_workload("sharded", shard_minutes=5)
+        texts = self.extract_workload("texts", workload_format="ndjson_texts", shard_minutes=5)
+
+        self.assertFalse(os.path.exists(f"{sharded}/SQLs.ndjson.gz"))
+        self.assertEqual(transaction_summary(ndjson), transaction_summary(replay.parse_transactions(sharded)))
+        self.assertEqual(transaction_summary(ndjson), transaction_summary(replay.parse_transactions(texts)))
+
+        workload = replay.ShardedWorkload.load(sharded)
+        self.assertEqual(12, len(workload.shards))
+        for shard_idx, shard in enumerate(workload.shards):
+            connections = {replay.get_connection_key(c["db"], c["user"], c["pid"]): c["transactions"]
+                           for c in shard["connections"]}
+            for transaction_dict in workload.transaction_dicts(shard_idx):
+                transaction = replay.parse_transaction(transaction_dict)
+                self.assertTrue(shard["start_time"] <= transaction.start_time() < shard["end_time"])
+                self.assertIn([transaction.start_time().isoformat(), transaction.end_time().isoformat(),
+                               len(transaction.queries)], connections[transaction.transaction_key])
+        self.assertGreater(sum(len(shard["files"]) for shard in workload.shards), len(workload.shards))
+
+    def test_connections_load_the_transactions_assigned_to_them(self):
+        ndjson = self.extract_workload("ndjson")
+        sharded = self.extract_workload("sharded", shard_minutes=5)
+
+        # as replay.assign_transactions assigns them
+        connection_logs, _ = replay.parse_connections(ndjson, "", "")
+        expected = {}
+        for transaction in replay.parse_transactions(ndjson):
+            matches = [idx for idx, c in enumerate(connection_logs)
+                       if c.connection_key == transaction.transaction_key
+                       and c.session_initiation_time.replace(microsecond=0) <= transaction.start_time()]
+            if matches:
+                expected.setdefault(matches[-1], []).append(transaction.xid)
+
+        workload = replay.ShardedWorkload.load(sharded)
+        connection_logs, _ = replay.parse_connections(sharded, "", "")
+        # a session of a reused pid after the last transaction of the pid has none
+        last_session = max((c for c in connection_logs if c.connection_key == connection_logs[0].connection_key),
+                           key=lambda c: c.session_initiation_time)
+        connection_logs.append(replay.ConnectionLog(
+            END_TIME - datetime.timedelta(seconds=1), END_TIME, "psql", last_session.database_name,
+            last_session.username, last_session.pid, True, "all on", last_session.connection_key,
+        ))
+        workload.assign_shards(connection_logs)
+        self.assertEqual([], connection_logs[-1].shards)
+        self.assertEqual(0, connection_logs[-1].transaction_count)
+        connection_logs.pop()
+        loaded = {}
+        for idx, connection_log in enumerate(connection_logs):
+            for shard_idx in connection_log.shards:
+                for transaction in workload.connection_transactions(shard_idx, connection_log):
+                    loaded.setdefault(idx, []).append(transaction.xid)
+
+        self.assertEqual(expected, loaded)
+        self.assertEqual(set(expected), {idx for idx, c in enumerate(connection_logs) if c.shards})
+        self.assertEqual({idx: len(xids) for idx, xids in expected.items()},
+                         {idx: c.transaction_count for idx, c in enumerate(connection_logs) if c.transaction_count})
+        self.assertLessEqual(len(workload.cache), replay.g_cached_workload_shards)
+
+
+    def test_shards_load_at_the_same_time(self):
+        workload = replay.ShardedWorkload.load(self.extract_workload("sharded", shard_minutes=5))
+        transaction_dicts = workload.transaction_dicts
+        first_shard_read = threading.Event()
+        loaded = []
+
+        def slow_transaction_dicts(shard_idx):
+            loaded.append(shard_idx)
+            if shard_idx == 0:
+                # until the second shard is loaded
+                self.assertTrue(first_shard_read.wait(5))
+            return transaction_dicts(shard_idx)
+
+        results = {}
+
+        def load(name, shard_idx):
+            results[name] = workload.shard_transactions(shard_idx)
+
+        with mock.patch.object(workload, "transaction_dicts", slow_transaction_dicts):
+            threads = [threading.Thread(target=load, args=args) for args in (("first", 0), ("again", 0))]
+            for thread in threads:
+                thread.start()
+            load("second", 1)
+            first_shard_read.set()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual([0, 1], sorted(loaded))
+        self.assertIs(results["first"], results["again"])
+        self.assertTrue(results["second"])
+
+    def replay_workload(self, workload_directory):
+        """ The connections of a workload with their transactions, or their shards, as main() loads
+            them, with the number of transactions and queries """
+        connection_logs, _ = replay.parse_connections(workload_directory, "", "")
+        workload = replay.ShardedWorkload.load(workload_directory)
+        if workload is not None:
+            transaction_count, query_count = workload.assign_shards(connection_logs, replay.g_config["filters"])
+            connection_logs = [_ for _ in connection_logs if _.transaction_count > 0]
+        else:
+            transactions = replay.parse_transactions(workload_directory)
+            transaction_count = len(transactions)
+            query_count = replay.assign_transactions(connection_logs, transactions)
+            connection_logs = [_ for _ in connection_logs if _.transactions]
+        return connection_logs, transaction_count, query_count
+
+    def test_sharded_replay_matches_ndjson(self):
+        ndjson = self.extract_workload("ndjson")
+        sharded = self.extract_workload("sharded", shard_minutes=5)
+        replay.g_config["filters"]["include"]["username"] = [sorted(USERS)[0]]
+
+        ndjson_logs, *ndjson_counts = self.replay_workload(ndjson)
+        sharded_logs, *sharded_counts = self.replay_workload(sharded)
+        self.assertEqual(ndjson_counts, sharded_counts)
+        self.assertEqual([(c.session_initiation_time, c.pid, c.transactions[0].start_time(), len(c.transactions))
+                          for c in ndjson_logs],
+                         [(c.session_initiation_time, c.pid, c.first_start_time, c.transaction_count)
+                          for c in sharded_logs])
+        self.assertEqual(replay.event_time_range(ndjson_logs)[0],
+                         replay.event_time_range(sharded_logs, sharded=True)[0])
+
+
+def assign_transactions_reference(connection_logs, transactions):
+    """ The assignment of replay.main() before assign_transactions, scanning the connections of
+        the key of each transaction """
+    connection_idx_by_key = {}
+    for idx, c in enumerate(connection_logs):
+        connection_idx_by_key.setdefault(replay.get_connection_key(c.database_name, c.username, c.pid), []).append(idx)
+
+    query_count = 0
+    for t in transactions:
+        best_match_idx = None
+        for c_idx in connection_idx_by_key.get(t.transaction_key, []):
+            if connection_logs[c_idx].session_initiation_time.replace(microsecond=0) > t.start_time():
+                break
+            best_match_idx = c_idx
+        if best_match_idx is not None:
+            connection_logs[best_match_idx].transactions.append(t)
+            query_count += len(t.queries)
+    return query_count
+
+
+def connection_log(session_initiation_time, pid=1000, username="bob"):
+    return replay.ConnectionLog(session_initiation_time, None, "psql", "dev", username, pid, True, "all on",
+                                replay.get_connection_key("dev", username, pid))
+
+
+def transaction(xid, start_time, pid=1000, username="bob"):
+    return replay.Transaction(True, "dev", username, pid, xid, [replay.Query(start_time, start_time, "select 1;")],
+                              replay.get_connection_key("dev", username, pid))
+
+
+class AssignTransactionsTests(unittest.TestCase):
+    def setUp(self):
+        self.logger = replay.logger
+        replay.logger = logging.getLogger("SimpleReplayLogger")
+
+    def tearDown(self):
+        replay.logger = self.logger
+
+    def test_session_start_is_truncated_to_seconds(self):
+        earlier = connection_log(START_TIME)
+        later = connection_log(START_TIME + datetime.timedelta(minutes=5, microseconds=700000))
+        transactions = [
+            # logged within the second the later session started, before it by the clock
+            transaction(1, START_TIME + datetime.timedelta(minutes=5)),
+            transaction(2, START_TIME + datetime.timedelta(minutes=4, seconds=59, microseconds=999999)),
+            transaction(3, START_TIME + datetime.timedelta(microseconds=1)),
+        ]
+
+        self.assertEqual(3, replay.assign_transactions([earlier, later], transactions))
+        self.assertEqual([2, 3], [t.xid for t in earlier.transactions])
+        self.assertEqual([1], [t.xid for t in later.transactions])
+
+    def test_transactions_without_a_session_are_skipped(self):
+        session = connection_log(START_TIME + datetime.timedelta(seconds=10, microseconds=500))
+        transactions = [
+            transaction(1, START_TIME + datetime.timedelta(seconds=9, microseconds=999999)),
+            transaction(2, START_TIME + datetime.timedelta(seconds=20), pid=2000),
+            transaction(3, START_TIME + datetime.timedelta(seconds=10)),
+        ]
+
+        with self.assertLogs("SimpleReplayLogger", level="WARNING") as logs:
+            self.assertEqual(1, replay.assign_transactions([session], transactions))
+        self.assertEqual([3], [t.xid for t in session.transactions])
+        self.assertEqual(2, len(logs.output))
+
+    def test_matches_reference(self):
+        def workload():
+            # the same connections and transactions each time
+            rng = random.Random(1)
+            connection_logs = sorted(
+                (connection_log(START_TIME + datetime.timedelta(seconds=rng.randrange(3600), microseconds=rng.choice(
+                    [0, rng.randrange(1000000)])), pid=rng.randrange(3), username=rng.choice(["bob", "alice"]))
+                 for _ in range(300)),
+                key=lambda c: c.session_initiation_time,
+            )
+            transactions = [
+                transaction(xid, START_TIME + datetime.timedelta(seconds=rng.randrange(-60, 3700)),
+                            pid=rng.randrange(4), username=rng.choice(["bob", "alice"]))
+                for xid in range(3000)
+            ]
+            return connection_logs, transactions
+
+        expected_connection_logs, transactions = workload()
+        expected = assign_transactions_reference(expected_connection_logs, transactions)
+        connection_logs, transactions = workload()
+        with self.assertLogs("SimpleReplayLogger", level="WARNING"):
+            self.assertEqual(expected, replay.assign_transactions(connection_logs, transactions))
+
+        self.assertEqual(
+            [[t.xid for t in c.transactions] for c in expected_connection_logs],
+            [[t.xid for t in c.transactions] for c in connection_logs],
+        )
+
+
+class FakeDriverConnection:
+    """ A connection that records the statements executed, and fails those that ask to. The others
+        take query_sec """
+
+    def __init__(self, executed, query_sec=0):
+        self.executed = executed
+        self.query_sec = query_sec
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql_text):
+        if "fail" in sql_text:
+            raise Exception("failed")
+        self.executed.append((datetime.datetime.now(tz=datetime.timezone.utc), sql_text))
+        time.sleep(self.query_sec)
+
+    def close(self):
+        pass
+
+    def commit(self):
+        pass
+
+
+class ReplayEngineTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.config = replay.g_config
+        self.replay_timestamp = replay.g_replay_timestamp
+        replay.g_config = {"execute_copy_statements": "false", "execute_unload_statements": "false",
+                           "replay_output": None, "split_multi": True, "logging_dir": self.tmp.name}
+        replay.g_replay_timestamp = datetime.datetime.now(tz=datetime.timezone.utc)
+
+    def tearDown(self):
+        replay.g_config = self.config
+        replay.g_replay_timestamp = self.replay_timestamp
+        self.tmp.cleanup()
+
+    def connection_logs(self):
+        connection_logs = []
+        for idx in range(3):
+            start = START_TIME + datetime.timedelta(milliseconds=200 * idx)
+            pid = str(1000 + idx)
+            connection_log = replay.ConnectionLog(start, start + datetime.timedelta(seconds=1), "psql", "dev", "bob",
+                                                  pid, True, "all on", replay.get_connection_key("dev", "bob", pid))
+            for xid, (offset_ms, text) in enumerate([
+                (100, "select 1; select 2;"),
+                (300, "copy orders from 's3://bucket/orders' iam_role 'arn';"),
+                (400, "select 'fail';"),
+                (600, "select 3;"),
+            ]):
+                query_time = start + datetime.timedelta(milliseconds=offset_ms)
+                connection_log.transactions.append(replay.Transaction(
+                    True, "dev", "bob", pid, str(idx * 10 + xid), [replay.Query(query_time, query_time, text)],
+                    connection_log.connection_key,
+                ))
+            connection_logs.append(connection_log)
+        return connection_logs
+
+    def replay(self, worker, query_sec=0, **config):
+        """ Replay the connections with a worker and return the stats and the statements executed
+            with how late they were """
+        replay.g_config.update(config)
+        connection_logs = self.connection_logs()
+        jobs = [{"job_id": idx, "connection": connection_log} for idx, connection_log in enumerate(connection_logs)]
+        worker_stats = replay.init_stats({})
+        executed = []
+        credentials = {"host": "host", "port": 5439, "username": "bob", "password": "", "database": "dev",
+                       "odbc_driver": None}
+
+        replay_start = datetime.datetime.now(tz=datetime.timezone.utc)
+        with mock.patch.object(replay, "db_connect", lambda *args, **kwargs: FakeDriverConnection(executed, query_sec)), \
+                mock.patch.object(replay, "get_connection_credentials", return_value=credentials), \
+                mock.patch.object(replay.random, "randrange", return_value=0):
+            worker(0, replay_start, START_TIME, jobs, worker_stats, "psql", None, None,
+                   mock.Mock(value=0), mock.Mock(value=0))
+
+        query_times = {transaction.xid: transaction.start_time() for connection_log in connection_logs
+                       for transaction in connection_log.transactions}
+        statements = []
+        for executed_time, sql_text in executed:
+            tags = json.loads(sql_text[3:sql_text.index(" */")])
+            lag = executed_time - replay_start - (query_times[tags["xid"]] - START_TIME)
+            statements.append((tags["xid"], sql_text, lag.total_seconds()))
+        return worker_stats, statements
+
+    def test_engines_replay_the_same_statements_on_time(self):
+        thread_stats, thread_statements = self.replay(replay.replay_worker)
+        async_stats, async_statements = self.replay(replay.async_replay_worker, async_executor_threads=2)
+
+        lag_histograms = []
+        for stats in (thread_stats, async_stats):
+            self.assertLess(abs(stats.pop("connection_diff_sec")), 0.5)
+            lag_histograms.append({kind: histogram["events"] for kind, histogram in stats.pop("lag_histogram").items()})
+        self.assertEqual(thread_stats, async_stats)
+        self.assertEqual(lag_histograms[0], lag_histograms[1])
+        self.assertEqual({"connect": 3, "transaction": 12, "disconnect": 3}, {
+            kind: events for kind, events in lag_histograms[0].items() if kind != "query"
+        })
+        self.assertEqual(3, async_stats["query_error"])
+
+        # the COPY isn't replayed, the multi-statement query is split
+        self.assertEqual(sorted(_[:2] for _ in thread_statements), sorted(_[:2] for _ in async_statements))
+        self.assertEqual(9, len(async_statements))
+        self.assertFalse([_ for _ in async_statements if "copy" in _[1]])
+        for xid, sql_text, lag in thread_statements + async_statements:
+            self.assertGreater(lag, -0.05, sql_text)
+            self.assertLess(lag, 0.5, sql_text)
+
+    def test_connections_finish_when_the_worker_fails(self):
+        # the worker fails to start the second connection, while the first is replayed
+        with mock.patch.object(replay, "job_due", side_effect=[0, Exception("failed")]):
+            stats, statements = self.replay(replay.replay_worker)
+        self.assertEqual({"0", "3"}, {xid for xid, sql_text, lag in statements})
+        self.assertEqual(1, stats["query_error"])
+
+    def test_connections_are_closed_when_the_async_worker_fails(self):
+        def worker_jobs(jobs, connection_semaphore, num_connections):
+            yield jobs[0]
+            time.sleep(0.25)
+            raise Exception("failed")
+
+        # the connection started before the worker fails is cancelled part way through its transactions
+        closed = []
+        with mock.patch.object(FakeDriverConnection, "close", lambda conn: closed.append(conn)), \
+                mock.patch.object(replay, "worker_jobs", worker_jobs):
+            with self.assertLogs("SimpleReplayLogger", level="ERROR") as logs:
+                stats, statements = self.replay(replay.async_replay_worker)
+        # the fake connection is its own cursor, closed after the first transaction
+        self.assertEqual(2, len(closed))
+        self.assertEqual(["0", "0"], [xid for xid, sql_text, lag in statements])
+        self.assertEqual(1, stats["transaction_success"])
+        self.assertEqual(["failed"], [output.rsplit(" ", 1)[-1] for output in logs.output])
+
+    def test_workers_report_the_connections_they_replayed(self):
+        for worker in (replay.replay_worker, replay.async_replay_worker):
+            stats, _ = self.replay(worker)
+            self.assertEqual(3, stats["connections_processed"])
+
+            # a worker that fails part way through its jobs
+            with mock.patch.object(replay, "job_due", side_effect=[0, Exception("failed")]):
+                stats, _ = self.replay(worker)
+            self.assertEqual(1, stats["connections_processed"], worker)
+
+    def test_transactions_start_on_time_after_slow_queries(self):
+        for worker in (replay.replay_worker, replay.async_replay_worker):
+            # the two statements of the first transaction end after the next two transactions were due
+            stats, statements = self.replay(worker, query_sec=0.15)
+            lags = {xid: lag for xid, sql_text, lag in statements}
+            for idx in range(3):
+                self.assertLess(lags[str(idx * 10 + 3)], 0.1, worker)
+
+
+class ReplaySchedulerTests(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = replay.ReplayScheduler(datetime.datetime.now(tz=datetime.timezone.utc))
+
+    def tearDown(self):
+        self.scheduler.close()
+
+    def test_events_are_woken_in_order_of_due_time(self):
+        woken = []
+        threads = [
+            threading.Thread(target=lambda delay_sec=delay_sec: (
+                self.scheduler.wait("query", self.scheduler.due_in(delay_sec)), woken.append(delay_sec)
+            ))
+            for delay_sec in (0.15, 0.1, 0.05)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([0.05, 0.1, 0.15], woken)
+        self.assertEqual(3, self.scheduler.lag_histogram["query"]["events"])
+        self.assertLess(self.scheduler.lag_histogram["query"]["max_ms"], 50)
+
+    def test_tasks_wait_until_due(self):
+        async def wait(offset_sec):
+            await self.scheduler.wait_async("transaction", self.scheduler.due_at(offset_sec))
+            return self.scheduler.elapsed_sec()
+
+        async def wait_all():
+            return await asyncio.gather(*(wait(offset_sec) for offset_sec in (0.1, 0.05, -1)))
+
+        woken = asyncio.run(wait_all())
+        self.assertLess(woken[2], 0.05)
+        for elapsed_sec, offset_sec in zip(woken[:2], (0.1, 0.05)):
+            self.assertGreaterEqual(elapsed_sec, offset_sec)
+            self.assertLess(elapsed_sec, offset_sec + 0.05)
+
+        # the event due before the scheduler started is as late as the scheduler
+        histogram = self.scheduler.lag_histogram["transaction"]
+        self.assertEqual(3, histogram["events"])
+        self.assertGreaterEqual(histogram["max_ms"], 1000)
+
+    def test_close_wakes_the_events_waiting(self):
+        thread = threading.Thread(target=self.scheduler.wait, args=("query", self.scheduler.due_in(60)))
+        thread.start()
+        while not self.scheduler.events:
+            time.sleep(0.01)
+        self.scheduler.close()
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+
+        # and those that wait after it's closed don't
+        start = time.monotonic()
+        self.scheduler.wait("query", self.scheduler.due_in(60))
+        asyncio.run(self.scheduler.wait_async("query", self.scheduler.due_in(60)))
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_lag_histograms_are_merged(self):
+        buckets = len(replay.ReplayScheduler.lag_buckets_ms) + 1
+        lag_histogram = {}
+        for lag_ms in ([0.5] * 90 + [15] * 9 + [90000], [3]):
+            worker_histogram = {"counts": [0] * buckets, "events": 0, "total_ms": 0.0, "max_ms": 0.0}
+            for lag in lag_ms:
+                worker_histogram["counts"][replay.bisect.bisect_left(replay.ReplayScheduler.lag_buckets_ms, lag)] += 1
+                worker_histogram["events"] += 1
+                worker_histogram["total_ms"] += lag
+                worker_histogram["max_ms"] = max(worker_histogram["max_ms"], lag)
+            replay.merge_lag_histograms(lag_histogram, {"query": worker_histogram})
+
+        histogram = lag_histogram["query"]
+        self.assertEqual(101, histogram["events"])
+        self.assertEqual(90000, histogram["max_ms"])
+        self.assertEqual(1, replay.lag_percentile_ms(histogram, 50))
+        self.assertEqual(20, replay.lag_percentile_ms(histogram, 99))
+        self.assertIsNone(replay.lag_percentile_ms(histogram, 100))
+
+
+class PartitionConnectionsTests(unittest.TestCase):
+    def connection_log(self, start_sec, duration_sec, queries, pid):
+        start = START_TIME + datetime.timedelta(seconds=start_sec)
+        connection_log = replay.ConnectionLog(start, start + datetime.timedelta(seconds=duration_sec), "psql", "dev",
+                                              "bob", str(pid), True, "all on",
+                                              replay.get_connection_key("dev", "bob", str(pid)))
+        connection_log.transactions = [transaction(str(pid), start, pid=str(pid)) for _ in range(queries)]
+        return connection_log
+
+    def test_longest_first_within_a_second(self):
+        connection_logs = [
+            self.connection_log(0.1, 60, 1, 1000),
+            self.connection_log(0.2, 60, 10, 1001),
+            self.connection_log(0.3, 60, 5, 1002),
+            # both earlier sessions of the second worker have ended
+            self.connection_log(70, 60, 1, 1003),
+        ]
+
+        partitions = replay.partition_connections(connection_logs, 2)
+        self.assertEqual([[1], [0, 2, 3]], [[job["job_id"] for job in partition] for partition in partitions])
+        self.assertIs(connection_logs[1], partitions[0][0]["connection"])
+
+    def test_sharded_connections_are_weighed_by_their_queries(self):
+        connection_logs = [self.connection_log(0.1, 60, 1, 1000), self.connection_log(0.2, 60, 10, 1001),
+                           self.connection_log(0.3, 60, 5, 1002)]
+        expected = [[job["job_id"] for job in partition]
+                    for partition in replay.partition_connections(connection_logs, 2)]
+        for connection_log in connection_logs:
+            connection_log.query_count = len(connection_log.transactions)
+            connection_log.transactions = []
+
+        partitions = replay.partition_connections(connection_logs, 2)
+        self.assertEqual([[1], [0, 2]], expected)
+        self.assertEqual(expected, [[job["job_id"] for job in partition] for partition in partitions])
+
+    def test_open_sessions_are_balanced(self):
+        rng = random.Random(0)
+        connection_logs = sorted(
+            (self.connection_log(rng.uniform(0, 3600), rng.expovariate(1 / 300), rng.randrange(1, 50), 1000 + idx)
+             for idx in range(2000)),
+            key=lambda connection_log: connection_log.session_initiation_time,
+        )
+        num_workers = 7
+
+        partitions = replay.partition_connections(connection_logs, num_workers)
+        job_ids = sorted(job["job_id"] for partition in partitions for job in partition)
+        self.assertEqual(list(range(len(connection_logs))), job_ids)
+
+        def open_sessions(connection_logs, at):
+            return sum(1 for c in connection_logs if c.session_initiation_time <= at < c.disconnection_time)
+
+        for partition in partitions:
+            self.assertEqual(sorted(job["job_id"] for job in partition), [job["job_id"] for job in partition])
+        for connection_log in connection_logs[::20]:
+            at = connection_log.session_initiation_time
+            per_worker = [open_sessions([job["connection"] for job in partition], at) for partition in partitions]
+            # at most one session more than an even split, when each starts
+            self.assertLessEqual(max(per_worker), -(-open_sessions(connection_logs, at) // num_workers) + 1)
@@ -1,4 +1,5 @@
 import boto3
+import codecs
 import gzip
 import io
 import json
@@ -131,6 +132,121 @@ def retrieve_compressed_json(location):
     return json.loads(json_content)
 
 
+def open_compressed(location):
+    """ Open a gzipped file, either local or s3, to be read as a stream """
+    if location.startswith("s3://"):
+        url = urlparse(location, allow_fragments=False)
+        body = boto3.resource('s3').Object(url.netloc, url.path.lstrip('/')).get()["Body"]
+        return gzip.GzipFile(fileobj=body, mode='rb')
+    return gzip.open(location, 'rb')
+
+
+def retrieve_compressed_ndjson(location):
+    """ Yield each object of a gzipped newline delimited json file, either local or s3, one line
+        at a time rather than loading the whole file """
+    with open_compressed(location) as ndjson_gz:
+        for line in ndjson_gz:
+            if line.strip():
+                yield json.loads(line)
+
+
+def retrieve_compressed_json_members(location, key, chunk_size=1024 * 1024):
+    """ Yield the name and value of each member of the object at key in a gzipped json file,
+        either local or s3, decoding one member at a time as the file is read rather than loading
+        the whole file. The other values of the top level object are decoded and dropped """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    pos = 0
+    eof = False
+
+    with open_compressed(location) as json_gz:
+        def read(size=chunk_size):
+            """ Add the next size bytes of the file to the buffer, dropping what has been decoded """
+            nonlocal buffer, pos, eof
+            data = json_gz.read(size)
+            eof = not data
+            buffer = buffer[pos:] + utf8.decode(data, final=eof)
+            pos = 0
+            return not eof
+
+        def next_char():
+            """ The next character that isn't whitespace, or "" at the end of the file """
+            nonlocal pos
+            while True:
+                while pos < len(buffer) and buffer[pos] in " \t\n\r":
+                    pos += 1
+                if pos < len(buffer) or not read():
+                    return buffer[pos:pos + 1]
+
+        def expect(chars):
+            nonlocal pos
+            char = next_char()
+            if not char or char not in chars:
+                raise json.JSONDecodeError(f"Expecting one of {chars!r}", buffer, pos)
+            pos += 1
+            return char
+
+        def value():
+            nonlocal pos
+            next_char()
+            size = chunk_size
+            while True:
+                try:
+                    result, end = decoder.raw_decode(buffer, pos)
+                    # a number could carry on in the rest of the file, when the buffer ends with it or
+                    # with what is left of it, e.g. "1." of "1.5e3"
+                    truncated = end == len(buffer) or (
+                        isinstance(result, (int, float)) and not isinstance(result, bool)
+                        and buffer[end] in "+-.0123456789eE"
+                    )
+                    if eof or not truncated:
+                        pos = end
+                        return result
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                # a large value, read twice as much each time so it is decoded a bounded number of times
+                read(size)
+                size *= 2
+
+        def member_names():
+            """ Yield the name of each member of the object at the position, whose value the caller
+                then reads """
+            nonlocal pos
+            expect("{")
+            if next_char() == "}":
+                pos += 1
+                return
+            while True:
+                name = value()
+                expect(":")
+                yield name
+                if expect(",}") == "}":
+                    return
+
+        for name in member_names():
+            if name == key:
+                for member_name in member_names():
+                    yield member_name, value()
+            else:
+                value()
+
+
+def file_exists(location):
+    """ Check if a file exists, either local or s3 """
+    if location.startswith("s3://"):
+        url = urlparse(location, allow_fragments=False)
+        try:
+            boto3.client('s3').head_object(Bucket=url.netloc, Key=url.path.lstrip('/'))
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return False
+            raise
+        return True
+    return os.path.exists(location)
+
+
 def load_file(location, decode=False):
     """ load a file from s3 or local. decode if the file should be interpreted as text rather than binary """
     try: